@@ -5,3 +5,14 @@ from django.apps import AppConfig
 
 class WebsiteConfig(AppConfig):
     name = 'website'
+
+    def ready(self):
+        # Time every sql statement run through any of the engines, and
+        # record the slow ones
+        from aldjemy.core import get_engine
+        import website.metrics as metrics
+        import website.models as m
+        import website.slow_queries as slow_queries
+        for engine in [m.engine, get_engine()] + m.replica_engines:
+            metrics.instrument_engine(engine)
+            slow_queries.instrument_engine(engine)
@@ -0,0 +1,350 @@
+import datetime
+import importlib
+import json
+import os
+import platform
+import random
+import resource
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory
+from sqlalchemy import text
+
+import website.history as history
+import website.models as m
+import website.table_generator as table_generator
+import website.views as views
+
+# Values the synthetic string columns are drawn from. Repeated heavily, like real registers
+surnames = ['Smith', 'Smyth', 'MacDonald', 'McDonald', 'Tremblay', 'Gagnon', 'Roy', 'Cote',
+            'Bouchard', 'Campbell', 'Fraser', 'Murray', 'Stewart', 'Robertson', 'Boudreau',
+            'LeBlanc', 'Cormier', 'Doucet', 'Morrison', 'MacKenzie']
+given_names = ['John', 'Mary', 'William', 'Margaret', 'James', 'Catherine', 'Alexander',
+               'Ann', 'Donald', 'Elizabeth', 'Joseph', 'Marie', 'Pierre', 'Jean', 'Sarah']
+parishes = ['St. Andrews', 'St. Columba', 'Antigonish', 'Arichat', 'Pictou', 'Sydney',
+            'Port Hood', 'Mabou', 'Cheticamp', 'Baddeck', 'Guysborough', 'Truro']
+occupations = ['Farmer', 'Fisherman', 'Labourer', 'Carpenter', 'Blacksmith', 'Merchant',
+               'Miner', 'Teacher', 'Servant', 'Mariner', None]
+
+
+def generate_dataset(rows, extra_columns=0, date_columns=2, distribution='clustered',
+                     bbox=(-66.0, 43.5, -59.7, 47.0), clusters=12, seed=0):
+    """
+    Generate a synthetic genealogy dataset
+
+    Parameters:
+    rows (int) - The number of rows to generate
+    extra_columns (int) - optional. The number of additional free text columns
+    date_columns (int) - optional. The number of date columns (BIRTH_DATE, DEATH_DATE, ...)
+    distribution (str) - optional. 'uniform' spreads points evenly over bbox,
+                         'clustered' gathers them around a number of settlements
+    bbox (tuple) - optional. (min_lon, min_lat, max_lon, max_lat) of the points
+    clusters (int) - optional. The number of settlements for the clustered distribution
+    seed (int) - optional. The random seed, so runs can be reproduced
+
+    Returns:
+    df (pandas.DataFrame) - The generated dataset
+    """
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({
+        'SURNAME': rng.choice(surnames, rows),
+        'GIVEN_NAME': rng.choice(given_names, rows),
+        'SEX': rng.choice(['M', 'F'], rows),
+        'PARISH': rng.choice(parishes, rows),
+        'OCCUPATION': rng.choice(occupations, rows),
+    }, columns=['SURNAME', 'GIVEN_NAME', 'SEX', 'PARISH', 'OCCUPATION'])
+
+    start = datetime.datetime(1750, 1, 1)
+    days = rng.randint(0, 150 * 365, rows)
+    names = ['BIRTH_DATE', 'DEATH_DATE', 'MARRIAGE_DATE', 'BAPTISM_DATE']
+    for i in range(date_columns):
+        name = names[i] if i < len(names) else 'EVENT_%d_DATE' % i
+        offset = days + (rng.randint(0, 80 * 365, rows) if i else 0)
+        df[name] = pd.to_datetime(start) + pd.to_timedelta(offset, unit='D')
+
+    for i in range(extra_columns):
+        df['NOTE_%d' % i] = ['note %d' % n for n in rng.randint(0, 1000, rows)]
+
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if distribution == 'uniform':
+        df['LATITUDE'] = rng.uniform(min_lat, max_lat, rows)
+        df['LONGITUDE'] = rng.uniform(min_lon, max_lon, rows)
+    else:
+        centers = np.column_stack([
+            rng.uniform(min_lat, max_lat, clusters),
+            rng.uniform(min_lon, max_lon, clusters)
+        ])
+        picked = centers[rng.randint(0, clusters, rows)]
+        df['LATITUDE'] = picked[:, 0] + rng.normal(0, 0.05, rows)
+        df['LONGITUDE'] = picked[:, 1] + rng.normal(0, 0.05, rows)
+    return df
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process so the peak of a single
+    operation can be measured. Only supported on linux; elsewhere the peak
+    of the whole process is reported.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+
+def get_peak_rss():
+    """
+    Get the peak resident set size of this process, in megabytes
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0 if platform.system() == 'Darwin' else 1024.0)
+
+
+def measure(operation, function, rows, repeat=1):
+    """
+    Time a function and summarize its latency, throughput and memory use
+
+    Parameters:
+    operation (str) - The name of the operation being measured
+    function (function) - A function taking no arguments
+    rows (int) - The number of rows the function processes on each call
+    repeat (int) - optional. The number of times the function is called
+
+    Returns:
+    result (dict) - A JSON serializable summary of the measurements
+    """
+    durations = []
+    reset_peak_rss()
+    for i in range(repeat):
+        start = time.time()
+        function()
+        durations.append(time.time() - start)
+    durations = np.array(durations)
+    return {
+        'operation': operation,
+        'rows': rows,
+        'runs': repeat,
+        'throughput_rows_per_s': rows * repeat / durations.sum() if durations.sum() else None,
+        'latency_ms': {
+            'mean': durations.mean() * 1000,
+            'p50': np.percentile(durations, 50) * 1000,
+            'p95': np.percentile(durations, 95) * 1000,
+            'p99': np.percentile(durations, 99) * 1000,
+        },
+        'peak_rss_mb': get_peak_rss(),
+    }
+
+
+def make_request(method, path, data=None, session=None):
+    """
+    Build a request for calling a view directly, without going through a server
+
+    Parameters:
+    method (str) - 'get' or 'post'
+    path (str) - The path of the request
+    data (dict) - optional. The GET or POST data
+    session - optional. A session to attach to the request, shared across requests
+
+    Returns:
+    request (django.http.HttpRequest) - The request
+    """
+    request = getattr(RequestFactory(), method)(path, data or {})
+    if session is None:
+        session = importlib.import_module(settings.SESSION_ENGINE).SessionStore()
+    request.session = session
+    return request
+
+
+def get_dataset_uuid(filename):
+    """
+    Get the uuid of the dataset created from a file
+    """
+    session = m.get_session()
+    table_uuid = session.query(m.DATASETS.uuid).filter(
+        m.DATASETS.original_filename == filename
+    ).one()[0]
+    session.close()
+    return table_uuid
+
+
+def drop_dataset(table_uuid):
+    """
+    Remove a dataset created by the benchmark and everything referring to it
+    """
+    schema = settings.DATABASES['default']['SCHEMA']
+    with m.engine.begin() as connection:
+        for t in (m.DATASET_LINKS, m.DATASET_JOINS):
+            connection.execute(t.__table__.delete().where(
+                (t.dataset1_uuid == table_uuid) | (t.dataset2_uuid == table_uuid)
+            ))
+        for t in (m.DATASET_KEYS, m.GEOSPATIAL_COLUMNS, m.DATASET_TRANSACTIONS, m.METADATA,
+                  m.SLOW_QUERIES, m.INDEX_BUILDS):
+            connection.execute(t.__table__.delete().where(t.dataset_uuid == table_uuid))
+        connection.execute(m.DATASETS.__table__.delete().where(m.DATASETS.uuid == table_uuid))
+        connection.execute(text('DROP TABLE IF EXISTS "%s"."%s"' % (schema, table_uuid)))
+        connection.execute(text('DROP TABLE IF EXISTS "%s"."%s"' % (schema, history.get_history_table_name(table_uuid))))
+    for name in (table_uuid, history.get_history_table_name(table_uuid)):
+        if '%s.%s' % (schema, name) in m.m.tables:
+            m.m.remove(m.m.tables['%s.%s' % (schema, name)])
+    m.refresh()
+
+
+def run_size(rows, options):
+    """
+    Run every benchmark at a single dataset size
+
+    Parameters:
+    rows (int) - The number of rows in the generated dataset
+    options (dict) - The options given to run_benchmarks()
+
+    Returns:
+    results (list) - A list of summaries returned by measure()
+    """
+    results = []
+    df = generate_dataset(rows, options['extra_columns'], options['date_columns'],
+                          options['distribution'], seed=options['seed'])
+    csv = df.to_csv(index=False)
+    geospatial_columns = 'name=geom&lat_col=LATITUDE&lon_col=LONGITUDE&srid=4326&type=latlon'
+    datatypes = ','.join(table_generator.get_readable_types_from_dataframe(df))
+    filename = 'benchmark-%d-%s.csv' % (rows, uuid.uuid4())
+    session = importlib.import_module(settings.SESSION_ENGINE).SessionStore()
+
+    def store_file():
+        upload = SimpleUploadedFile(filename, csv, content_type='text/csv')
+        views.store_file(make_request('post', '/store_file', {'file_upload': upload}, session))
+    results.append(measure('store_file', store_file, rows))
+
+    def create_table():
+        views.create_table(make_request('post', '/create_table', {
+            'datatypes': datatypes,
+            'geospatial_columns': geospatial_columns,
+        }, session))
+    results.append(measure('create_table', create_table, rows))
+    table_uuid = get_dataset_uuid(session['real_filename'])
+
+    def append_dataset():
+        views.append_dataset(make_request('post', '/manage/append/' + table_uuid, {
+            'datatypes': datatypes,
+        }, session), table_uuid)
+    results.append(measure('append_dataset', append_dataset, rows))
+
+    # Load the frame again directly, without the views around the bulk loader
+    table = getattr(m.Base.classes, table_uuid)
+    parsed = views.convert_time_columns(pd.read_csv(
+        os.path.join(os.path.dirname(views.__file__), settings.MEDIA_ROOT, session['temp_filename'])
+    ))
+    results.append(measure('insert_df', lambda: table_generator.insert_df(
+        parsed, table, table_generator.get_geospatial_columns(table_uuid)
+    ), rows))
+
+    pages = int(np.ceil(3 * rows / float(settings.DATASET_ITEMS_PER_PAGE)))
+    rng = random.Random(options['seed'])
+    page_rows = min(settings.DATASET_ITEMS_PER_PAGE, 3 * rows)
+    results.append(measure('get_dataset_page', lambda: views.get_dataset_page(
+        make_request('get', '/'), table_uuid, rng.randrange(pages)
+    ), page_rows, options['repeat']))
+    results.append(measure('get_dataset_geojson', lambda: views.get_dataset_geojson(
+        make_request('get', '/'), table_uuid, rng.randrange(pages)
+    ), page_rows, options['repeat']))
+
+    if not options['keep']:
+        drop_dataset(table_uuid)
+    for r in results:
+        r['size'] = rows
+    return results
+
+
+def get_environment():
+    """
+    Describe the environment the benchmarks ran in, so results are only compared
+    against baselines from comparable machines
+    """
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'postgres': m.engine.execute(text('SHOW server_version')).scalar(),
+        'machine': platform.machine(),
+        'node': platform.node(),
+        'date': datetime.datetime.now().isoformat(),
+    }
+
+
+def run_benchmarks(sizes, extra_columns=0, date_columns=2, distribution='clustered',
+                   repeat=20, seed=0, keep=False):
+    """
+    Run the ingest and read path benchmarks at several dataset sizes
+
+    Parameters:
+    sizes (list) - The numbers of rows to benchmark with
+    extra_columns (int) - optional. See generate_dataset()
+    date_columns (int) - optional. See generate_dataset()
+    distribution (str) - optional. See generate_dataset()
+    repeat (int) - optional. The number of calls timed for the read endpoints
+    seed (int) - optional. The random seed
+    keep (bool) - optional. Keep the generated datasets instead of dropping them
+
+    Returns:
+    report (dict) - A JSON serializable report of the options, environment and results
+    """
+    options = {
+        'sizes': sizes,
+        'extra_columns': extra_columns,
+        'date_columns': date_columns,
+        'distribution': distribution,
+        'repeat': repeat,
+        'seed': seed,
+        'keep': keep,
+    }
+    results = []
+    for rows in sizes:
+        results += run_size(rows, options)
+    return {'options': options, 'environment': get_environment(), 'results': results}
+
+
+def compare(report, baseline):
+    """
+    Compare a report against a baseline report
+
+    Parameters:
+    report (dict) - A report returned by run_benchmarks()
+    baseline (dict) - An earlier report, eg. loaded from a JSON file
+
+    Returns:
+    comparison (list) - A list of (size, operation, baseline p50, p50, ratio) tuples.
+                        A ratio above 1 means the operation got slower
+    """
+    previous = dict(((r['size'], r['operation']), r) for r in baseline['results'])
+    comparison = []
+    for r in report['results']:
+        before = previous.get((r['size'], r['operation']))
+        if before is None:
+            continue
+        p50 = r['latency_ms']['p50']
+        before_p50 = before['latency_ms']['p50']
+        comparison.append((r['size'], r['operation'], before_p50, p50,
+                           p50 / before_p50 if before_p50 else None))
+    return comparison
+
+
+def write_report(report, path):
+    """
+    Write a report returned by run_benchmarks() to a JSON file
+    """
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,200 @@
+from django.conf import settings
+from sqlalchemy import text
+
+import website.history as history
+import website.models as m
+import website.partitioning as partitions
+import website.search as search
+import website.table_generator as table_generator
+
+
+def get_qualified_name(table):
+    """
+    Get the quoted schema qualified name of an SQLAlchemy Table object
+    """
+    return '%s.%s' % (search.quote_identifier(table.schema), search.quote_identifier(table.name))
+
+
+def get_geometry_updates(geospatial_column):
+    """
+    Get the SET clause rebuilding a geospatial column, and its display copy if it has one
+    """
+    updates = '%s = %s' % (search.quote_identifier(geospatial_column['name']),
+                           table_generator.get_geometry_sql(geospatial_column))
+    display_column = table_generator.get_display_column_name(geospatial_column)
+    if display_column is not None:
+        updates += ', %s = ST_Transform(%s, %d)' % (
+            search.quote_identifier(display_column), table_generator.get_geometry_sql(geospatial_column),
+            int(geospatial_column['display_srid'])
+        )
+    return updates
+
+
+def log_changes(statement):
+    """
+    Wrap a statement returning the ids of the rows it changed, so the change is
+    logged as a single dataset transaction by the same statement. No transaction
+    is logged if no row changed.
+
+    Parameters:
+    statement (str) - An UPDATE or DELETE statement ending in RETURNING id. It is
+                      run with the transaction_id, dataset_uuid and transaction_type
+                      parameters. The transaction_id comes from history.start_transaction(),
+                      so the replaced row versions are kept under the same id
+
+    Returns:
+    statement (str) - A statement returning the id and rows_affected of the
+                      logged transaction, or nothing
+    """
+    return (
+        'WITH changed AS (%s) '
+        'INSERT INTO %s.dataset_transactions (id, dataset_uuid, transaction_type, rows_affected, affected_row_ids) '
+        'SELECT :transaction_id, :dataset_uuid, :transaction_type, count(*), array_agg(id ORDER BY id) FROM changed '
+        'HAVING count(*) > 0 '
+        'RETURNING id, rows_affected'
+    ) % (statement, search.quote_identifier(settings.DATABASES['default']['SCHEMA']))
+
+
+def remove_rows(table_uuid, ids=None, filters=None):
+    """
+    Delete the rows of a dataset with a single DELETE statement and log it as a
+    remove transaction
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    ids (list) - optional. The ids of the rows to delete
+    filters (dict) - optional. Only delete rows whose columns equal these values,
+                     eg. {'SURNAME': 'Smith'}. Combined with ids if both are given
+
+    Returns:
+    transaction_id (int) - The id of the logged transaction, or None if nothing was deleted
+    rows_affected (int) - The number of rows deleted
+    """
+    t = getattr(m.Base.classes, table_uuid).__table__
+    conditions = []
+    params = {'dataset_uuid': table_uuid, 'transaction_type': m.transaction_types[4]}
+    if ids:
+        conditions.append('id = ANY(:ids)')
+        params['ids'] = [int(i) for i in ids]
+    for i, (column, value) in enumerate(sorted((filters or {}).items())):
+        if column not in t.columns:
+            raise ValueError("unknown column: %s" % column)
+        conditions.append('%s = CAST(:filter_%d AS %s)' % (
+            search.quote_identifier(column), i, t.columns[column].type.compile(dialect=m.engine.dialect)
+        ))
+        params['filter_%d' % i] = value
+    if not conditions:
+        # Never empty a dataset by accident
+        raise ValueError("rows can only be removed by id or by filter")
+
+    with m.engine.begin() as connection:
+        params['transaction_id'] = history.start_transaction(connection)
+        res = connection.execute(text(log_changes('DELETE FROM %s WHERE %s RETURNING id' % (
+            get_qualified_name(t), ' AND '.join(conditions)
+        ))), **params).first()
+    return (res[0], res[1]) if res is not None else (None, 0)
+
+
+def get_key_columns(table_uuid, index_name):
+    """
+    Get the columns of a dataset key
+
+    Returns:
+    columns (list) - The names of the columns, or None if the dataset has no such key
+    """
+    session = m.get_session()
+    key = session.query(m.DATASET_KEYS).filter(
+        m.DATASET_KEYS.dataset_uuid == table_uuid,
+        m.DATASET_KEYS.index_name == index_name
+    ).first()
+    session.close()
+    return list(key.dataset_columns) if key is not None else None
+
+
+def modify_rows(table_uuid, df, index_name):
+    """
+    Patch the rows of a dataset from a correction file joined on a dataset key.
+    The corrections are copied into a staging table and applied by a single
+    UPDATE ... FROM statement, logged as a modify transaction. Empty cells of the
+    correction file leave the value in the dataset as it is, and rows the file
+    doesn't actually change aren't touched. When a key appears more than once,
+    its last row wins.
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    df (pandas.DataFrame) - The corrections. Holds the key columns and the columns to patch
+    index_name (str) - The name of the dataset key, as found in dataset_keys
+
+    Returns:
+    transaction_id (int) - The id of the logged transaction, or None if nothing changed
+    rows_affected (int) - The number of rows changed
+    """
+    t = getattr(m.Base.classes, table_uuid).__table__
+    key_columns = get_key_columns(table_uuid, index_name)
+    if key_columns is None:
+        raise ValueError("unknown dataset key: %s" % index_name)
+    df = df.copy()
+    df.columns = [x.replace(" ", "_") for x in df.columns]
+    missing = [c for c in key_columns if c not in df.columns]
+    if missing:
+        raise ValueError("the corrections are missing key columns: %s" % ', '.join(missing))
+
+    # Geometries and partition keys are derived from other columns, so they can't be patched
+    geospatial_columns = table_generator.get_geospatial_columns(table_uuid)
+    protected = set(['id', partitions.partition_key_column] +
+                    table_generator.get_geometry_column_names(geospatial_columns))
+    partitioning = partitions.get_partitioning(table_uuid)
+    if partitioning is not None and partitioning['strategy'] == 'date':
+        protected.add(partitioning['column'])
+    elif partitioning is not None and partitioning['strategy'] == 'cell':
+        geo = [c for c in geospatial_columns if c['name'] == partitioning['column']][0]
+        protected.update([geo['lat_col'], geo['lon_col']])
+    patch_columns = [c for c in df.columns if c not in key_columns]
+    for c in patch_columns:
+        if c not in t.columns or c in protected:
+            raise ValueError("column can't be patched: %s" % c)
+    if not patch_columns:
+        raise ValueError("the corrections have no columns to patch")
+
+    # Geometries built from patched columns are rebuilt afterwards
+    rebuilt = [c for c in geospatial_columns if set(patch_columns) & set(
+        [c.get('lat_col'), c.get('lon_col'), c.get('source_col')]
+    )]
+
+    staging = 'corrections_%s' % t.name
+    keys = ', '.join(table_generator.get_cast_sql(t, c) for c in key_columns)
+    new_values = dict((c, 'coalesce(%s, d.%s)' % (
+        table_generator.get_cast_sql(t, c, 's'), search.quote_identifier(c)
+    )) for c in patch_columns)
+    update = (
+        'UPDATE %s AS d SET %s '
+        'FROM (SELECT DISTINCT ON (%s) * FROM %s ORDER BY %s, staging_order DESC) s '
+        'WHERE %s AND (%s) RETURNING d.id'
+    ) % (
+        get_qualified_name(t),
+        ', '.join('%s = %s' % (search.quote_identifier(c), new_values[c]) for c in patch_columns),
+        keys, search.quote_identifier(staging), keys,
+        ' AND '.join('d.%s = %s' % (search.quote_identifier(c), table_generator.get_cast_sql(t, c, 's'))
+                     for c in key_columns),
+        ' OR '.join('d.%s IS DISTINCT FROM %s' % (search.quote_identifier(c), new_values[c])
+                    for c in patch_columns)
+    )
+
+    if rebuilt:
+        table_generator.create_geometry_parser()
+    with m.engine.begin() as connection:
+        table_generator.stage_df(connection, df[key_columns + patch_columns], staging)
+        res = connection.execute(text(log_changes(update)), dataset_uuid=table_uuid,
+                                 transaction_id=history.start_transaction(connection),
+                                 transaction_type=m.transaction_types[2]).first()
+        if res is not None and rebuilt:
+            # The history already holds the versions from before the corrections
+            history.stop_recording(connection)
+            connection.execute(text(
+                'UPDATE %s SET %s WHERE id = ANY((SELECT affected_row_ids FROM %s.dataset_transactions WHERE id = :id))' % (
+                    get_qualified_name(t),
+                    ', '.join(get_geometry_updates(c) for c in rebuilt),
+                    search.quote_identifier(settings.DATABASES['default']['SCHEMA'])
+                )
+            ), id=res[0])
+    return (res[0], res[1]) if res is not None else (None, 0)
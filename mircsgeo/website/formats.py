@@ -0,0 +1,211 @@
+import json
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from sqlalchemy import Integer, Float, DateTime, Boolean
+
+# Content types of the formats dataset rows can be returned in
+content_types = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'msgpack': 'application/msgpack',
+}
+
+# File extensions of the exported formats
+extensions = {
+    'json': 'json',
+    'csv': 'csv',
+    'arrow': 'arrows',
+    'msgpack': 'msgpack',
+}
+
+
+def is_available(format_name):
+    """
+    Check whether the optional package a format needs is installed
+    """
+    if format_name == 'arrow':
+        return pa is not None
+    if format_name == 'msgpack':
+        return msgpack is not None
+    return format_name in content_types
+
+
+def get_requested_format(request, default='json'):
+    """
+    Pick the format a request asks for, from its format GET parameter or
+    otherwise its Accept header
+
+    Parameters:
+    request - The Django request
+    default (str) - optional. The format used when the request doesn't ask for one
+
+    Returns:
+    format_name (str) - One of the keys of content_types, or None if the format
+                        parameter names a format that isn't available
+    """
+    if 'format' in request.GET:
+        format_name = request.GET['format']
+        return format_name if is_available(format_name) else None
+    accept = request.META.get('HTTP_ACCEPT', '')
+    for format_name in ('arrow', 'msgpack'):
+        if content_types[format_name] in accept and is_available(format_name):
+            return format_name
+    if 'application/x-msgpack' in accept and is_available('msgpack'):
+        return 'msgpack'
+    return default
+
+
+def get_arrow_schema(table):
+    """
+    Build the Arrow schema of an autogenerated table from its column types, so
+    every chunk of an export gets the same schema whatever values it holds
+
+    Parameters:
+    table - The automapped SQLAlchemy class of the table
+
+    Returns:
+    schema (pyarrow.Schema) - The schema. Geometries are hex encoded WKB strings
+    """
+    fields = []
+    for c in table.__table__.columns:
+        if isinstance(c.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(c.type, Float):
+            arrow_type = pa.float64()
+        elif isinstance(c.type, DateTime):
+            arrow_type = pa.timestamp('us')
+        elif isinstance(c.type, Boolean):
+            arrow_type = pa.bool_()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(c.name, arrow_type))
+    return pa.schema(fields)
+
+
+def prepare_geometries(df):
+    """
+    Replace the geometry objects returned for geometry columns with their hex
+    encoded WKB, which is what the binary formats carry
+    """
+    for c in df.columns:
+        if df[c].dtype == object:
+            first = df[c].dropna()
+            if len(first.index) and hasattr(first.iloc[0], 'desc'):
+                df[c] = df[c].map(lambda v: v if v is None else v.desc)
+    return df
+
+
+class ChunkSink(object):
+    """
+    A file-like object collecting what an Arrow stream writer writes, so it
+    can be sent out batch by batch
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_arrow(chunks, schema, metadata=None):
+    """
+    Convert DataFrames to an Arrow IPC stream, one record batch per DataFrame.
+    The columns are copied straight from the numpy arrays behind each DataFrame.
+
+    Parameters:
+    chunks (iterable) - DataFrames with the columns of the schema
+    schema (pyarrow.Schema) - The schema, as returned by get_arrow_schema()
+    metadata (dict) - optional. Extra information stored as JSON in the schema
+                      metadata under the 'mircs' key, eg. the page count
+
+    Returns:
+    stream (generator) - The bytes of the stream, chunk by chunk
+    """
+    if metadata is not None:
+        schema = schema.with_metadata({'mircs': json.dumps(metadata)})
+    sink = ChunkSink()
+    writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+    yield sink.drain()
+    for df in chunks:
+        df = prepare_geometries(df)
+        writer.write_table(pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def pack_column(series):
+    """
+    Pack a column for MessagePack. Numeric, boolean and datetime columns are
+    sent as their raw little endian numpy buffer along with its dtype, so no
+    value is converted on its own. Datetimes are nanoseconds since the epoch.
+    Other columns are sent as lists, with None for missing values.
+    """
+    if series.dtype.kind in 'iufbM':
+        values = series.values
+        if values.dtype.byteorder == '>':
+            values = values.byteswap().newbyteorder()
+        return {'dtype': values.dtype.str, 'data': values.tobytes()}
+    return series.where(series.notnull(), None).tolist()
+
+
+def to_msgpack(df, metadata=None):
+    """
+    Pack a DataFrame into MessagePack as a map of column arrays
+
+    Parameters:
+    df (pandas.DataFrame) - The rows to pack
+    metadata (dict) - optional. Extra keys of the packed map, eg. the page count
+
+    Returns:
+    packed (bytes) - A map with a columns key listing the columns in order and a
+                     data key holding each column as packed by pack_column()
+    """
+    df = prepare_geometries(df)
+    packed = dict(metadata or {})
+    packed['columns'] = df.columns.tolist()
+    packed['data'] = dict((c, pack_column(df[c])) for c in df.columns)
+    return msgpack.packb(packed, use_bin_type=True)
+
+
+def iter_msgpack(chunks):
+    """
+    Convert DataFrames to a sequence of packed maps, one per DataFrame, as
+    returned by to_msgpack(). Clients read them back with msgpack.Unpacker.
+    """
+    for df in chunks:
+        yield to_msgpack(df)
+
+
+def iter_csv(chunks):
+    """
+    Convert DataFrames to CSV, with the header only written for the first one
+    """
+    header = True
+    for df in chunks:
+        yield prepare_geometries(df).to_csv(index=False, header=header)
+        header = False
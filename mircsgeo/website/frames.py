@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+
+import website.metrics as metrics
+
+
+def get_categorical_columns(sample):
+    """
+    Pick the text columns of a file worth dictionary encoding, from a sample of
+    its rows. Columns like parish, surname or sex repeat the same few values
+    over and over.
+
+    Parameters:
+    sample (pandas.DataFrame) - The first rows of the file
+
+    Returns:
+    columns (list) - The names of the columns to read as categoricals
+    """
+    columns = []
+    for c in sample.columns:
+        if sample[c].dtype == object and len(sample.index) and \
+                sample[c].nunique() <= settings.INGEST_CATEGORY_MAX_RATIO * len(sample.index):
+            columns.append(c)
+    return columns
+
+
+def downcast(df):
+    """
+    Shrink the numeric columns of a DataFrame in place. Integers get the smallest
+    type holding their values. Floats are only made single precision when no
+    value changes, so coordinates keep all their decimals.
+
+    Returns:
+    df (pandas.DataFrame) - The same DataFrame
+    """
+    for c in df.columns:
+        kind = df[c].dtype.kind
+        if kind in 'iu':
+            df[c] = pd.to_numeric(df[c], downcast='integer')
+        elif kind == 'f' and df[c].dtype.itemsize > 4:
+            values = df[c].values
+            single = values.astype(np.float32)
+            if ((single == values) | np.isnan(values)).all():
+                df[c] = single
+    return df
+
+
+def read_csv(path_or_buffer):
+    """
+    Read an uploaded CSV file. In the compact ingest mode the repetitive text
+    columns, picked from the first settings.INGEST_SAMPLE_ROWS rows, are parsed
+    straight into categoricals so their strings are never all held in memory,
+    and the numeric columns are downcast.
+
+    Parameters:
+    path_or_buffer - A path or a file object that can be read twice
+
+    Returns:
+    df (pandas.DataFrame) - The parsed file
+    """
+    if not settings.INGEST_COMPACT_FRAMES:
+        return pd.read_csv(path_or_buffer)
+    sample = pd.read_csv(path_or_buffer, nrows=settings.INGEST_SAMPLE_ROWS)
+    if hasattr(path_or_buffer, 'seek'):
+        path_or_buffer.seek(0)
+    dtypes = dict((c, 'category') for c in get_categorical_columns(sample))
+    return downcast(pd.read_csv(path_or_buffer, dtype=dtypes))
+
+
+def to_datetime(values):
+    """
+    Convert a column to datetimes. The distinct values of categoricals are only
+    parsed once.
+    """
+    if str(values.dtype) != 'category':
+        return pd.to_datetime(values)
+    parsed = pd.to_datetime(values.cat.categories).values
+    # Missing values are coded -1, which picks the trailing NaT
+    parsed = np.append(parsed, np.datetime64('NaT'))
+    return pd.Series(parsed[values.cat.codes.values], index=values.index, name=values.name)
+
+
+def iter_chunks(df, rows=None):
+    """
+    Split a DataFrame into chunks of settings.INGEST_CHUNK_ROWS rows, so it can
+    be converted to text a chunk at a time
+    """
+    rows = rows or settings.INGEST_CHUNK_ROWS
+    for start in range(0, len(df.index), rows):
+        yield df.iloc[start:start + rows]
+
+
+class CsvReader(object):
+    """
+    A file-like object reading a DataFrame as CSV, converting a chunk of rows
+    at a time, for COPY ... FROM STDIN
+    """
+
+    def __init__(self, df):
+        self.chunks = iter_chunks(df)
+        self.buffer = b''
+        self.position = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.position < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            data = chunk.to_csv(index=False, header=False)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            # Only the unread end of the buffer is kept
+            self.buffer = self.buffer[self.position:] + data
+            self.position = 0
+        if size < 0:
+            size = len(self.buffer) - self.position
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def get_rss_mb():
+    """
+    Get the resident set size of this process, in megabytes, or None where
+    /proc isn't available
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+
+def report_memory(stage, df):
+    """
+    Record the memory used by a DataFrame at a stage of an ingest, along with
+    the resident set size of the process, as gauges on /metrics. Measuring the
+    text columns visits every value, so this is off unless INGEST_MEMORY_REPORT
+    is set for debugging.
+
+    Parameters:
+    stage (str) - The name of the stage, eg. parse or convert
+    df (pandas.DataFrame) - The DataFrame at that stage
+    """
+    if not settings.INGEST_MEMORY_REPORT:
+        return
+    labels = {'view': getattr(metrics.local, 'view', None), 'stage': stage}
+    metrics.set_gauge('mircs_ingest_dataframe_bytes', labels, int(df.memory_usage(deep=True).sum()),
+                      'Memory used by the DataFrame of the last ingest at each stage')
+    rss = get_rss_mb()
+    if rss is not None:
+        metrics.set_gauge('mircs_ingest_rss_megabytes', labels, rss,
+                          'Resident set size of the process after each stage of the last ingest')
@@ -0,0 +1,184 @@
+import collections
+import difflib
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+from sqlalchemy.util import LRUCache
+
+import website.linkage as linkage
+
+# The gazetteer loaded from settings.GAZETTEER_PATH, see get_gazetteer()
+gazetteer = None
+gazetteer_path = None
+
+# (gazetteer path, place string) -> the location found for it, for the most
+# recently geocoded places
+places = LRUCache(settings.GAZETTEER_CACHE_SIZE)
+
+
+class Gazetteer(object):
+    """
+    An in memory index of place names. Exact lookups go through a dictionary of
+    normalized names. Names without an exact match fall back to a fuzzy match
+    among the names sharing the most of their rarer trigrams with them.
+    """
+
+    def __init__(self, names, lats, lons):
+        self.locations = {}
+        for name, lat, lon in zip(names, lats, lons):
+            name = linkage.normalize_name(name)
+            # The first entry wins, gazetteers usually list the main place first
+            if name and name not in self.locations:
+                self.locations[name] = (lat, lon)
+        self.trigram_index = collections.defaultdict(list)
+        for name in self.locations:
+            for trigram in linkage.trigrams(name):
+                self.trigram_index[trigram].append(name)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def fuzzy_match(self, name):
+        """
+        Find the gazetteer name closest to a normalized name that has no exact match
+
+        Returns:
+        name (str) - The closest name, or None if none is similar enough
+        """
+        # Common trigrams, like the padded first letter, are shared by a large part
+        # of the gazetteer. Only the rarer ones are counted, rarest first, until
+        # the pool of candidates is big enough
+        postings = sorted((self.trigram_index.get(t, ()) for t in linkage.trigrams(name)), key=len)
+        shared = collections.Counter()
+        for names in postings:
+            if len(names) > settings.GAZETTEER_TRIGRAM_MAX_NAMES or \
+                    len(shared) >= settings.GAZETTEER_FUZZY_POOL:
+                break
+            shared.update(names)
+        candidates = [c for c, count in shared.most_common(settings.GAZETTEER_FUZZY_CANDIDATES)]
+        matches = difflib.get_close_matches(name, candidates, 1, settings.GAZETTEER_FUZZY_CUTOFF)
+        return matches[0] if matches else None
+
+    def lookup(self, place):
+        """
+        Find the location of a place string
+
+        Parameters:
+        place (str) - A place name as found in a dataset, eg. 'St. Mary, Lancashire'
+
+        Returns:
+        location (tuple) - (latitude, longitude), or None if the place wasn't found
+        """
+        name = linkage.normalize_name(place)
+        if not name:
+            return None
+        # Try the whole name, then the part before the first comma, which is
+        # usually the place itself followed by its county or country
+        names = [name]
+        if ',' in place:
+            names.append(linkage.normalize_name(place.split(',')[0]))
+        for n in names:
+            if n in self.locations:
+                return self.locations[n]
+        for n in names:
+            match = self.fuzzy_match(n)
+            if match is not None:
+                return self.locations[match]
+        return None
+
+
+def load_gazetteer(path):
+    """
+    Load a gazetteer file
+
+    Parameters:
+    path (str) - A CSV file with name, latitude and longitude columns. Its
+                 alternatenames column, if any, holds other names of the same
+                 place separated by commas, like in GeoNames exports
+
+    Returns:
+    gazetteer (Gazetteer) - The indexed gazetteer
+    """
+    df = pd.read_csv(path, sep=None, engine='python')
+    df = df.dropna(subset=['name', 'latitude', 'longitude'])
+    names = df['name'].tolist()
+    lats = df['latitude'].tolist()
+    lons = df['longitude'].tolist()
+    if 'alternatenames' in df.columns:
+        for alternates, lat, lon in zip(df['alternatenames'], df['latitude'], df['longitude']):
+            if isinstance(alternates, basestring):
+                for name in alternates.split(','):
+                    names.append(name)
+                    lats.append(lat)
+                    lons.append(lon)
+    return Gazetteer(names, lats, lons)
+
+
+def get_gazetteer():
+    """
+    Get the gazetteer of settings.GAZETTEER_PATH, loading it the first time
+    """
+    global gazetteer, gazetteer_path
+    if gazetteer is None or gazetteer_path != settings.GAZETTEER_PATH:
+        if not settings.GAZETTEER_PATH:
+            raise Exception("no gazetteer configured, set GAZETTEER_PATH")
+        gazetteer = load_gazetteer(settings.GAZETTEER_PATH)
+        gazetteer_path = settings.GAZETTEER_PATH
+    return gazetteer
+
+
+def geocode_places(values):
+    """
+    Geocode the distinct values of a place name column. The locations of the
+    settings.GAZETTEER_CACHE_SIZE most recently used place strings are kept, so
+    places repeated across rows and uploads are only looked up once.
+
+    Parameters:
+    values (iterable) - Distinct place strings
+
+    Returns:
+    locations (dict) - The (latitude, longitude) of each value, or None for the
+                       values that weren't found
+    """
+    g = get_gazetteer()
+    locations = {}
+    for value in values:
+        key = (settings.GAZETTEER_PATH, value)
+        location = places.get(key, False)
+        if location is False:
+            location = g.lookup(value) if isinstance(value, basestring) else None
+            places[key] = location
+        locations[value] = location
+    return locations
+
+
+def geocode_df(df, geospatial_columns):
+    """
+    Add the latitude and longitude columns of the geospatial columns built from
+    place names, before their geometries are built. Rows whose place isn't
+    found get no coordinates and so no geometry.
+
+    Parameters:
+    df (pandas.DataFrame) - The rows being loaded. The columns are added in place
+    geospatial_columns (list) - The geospatial columns of the table, as returned
+                                by get_geospatial_columns()
+
+    Returns:
+    columns (list) - The names of the columns added to the DataFrame
+    """
+    added = []
+    for c in geospatial_columns or []:
+        if 'place_col' not in c or c['lat_col'] in df.columns:
+            continue
+        codes, uniques = pd.factorize(df[c['place_col']])
+        locations = geocode_places(uniques)
+        # Look the locations up by code, so each place is only converted once
+        lats = np.array([(locations[u] or (np.nan, np.nan))[0] for u in uniques] + [np.nan])
+        lons = np.array([(locations[u] or (np.nan, np.nan))[1] for u in uniques] + [np.nan])
+        # Missing places are coded -1, which picks the trailing nan
+        df[c['lat_col']] = lats[codes]
+        df[c['lon_col']] = lons[codes]
+        added += [c['lat_col'], c['lon_col']]
+    return added
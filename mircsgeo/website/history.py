@@ -0,0 +1,171 @@
+from django.conf import settings
+from sqlalchemy import text
+
+import website.models as m
+import website.search as search
+
+# Whether the record_history SQL function has been created by this process
+history_function_created = False
+
+
+def get_history_table_name(table_uuid):
+    """
+    Get the name of the table keeping the previous versions of the rows of a dataset
+    """
+    return '%s_history' % table_uuid
+
+
+def has_history(table_uuid):
+    """
+    Whether the history of a dataset is kept. Datasets created before history
+    was kept have no history table.
+    """
+    return '%s.%s' % (settings.DATABASES['default']['SCHEMA'], get_history_table_name(table_uuid)) in m.m.tables
+
+
+def create_history_function():
+    """
+    Create the trigger function copying the rows an UPDATE or DELETE changes into
+    the history table of a dataset, tagged with the transaction that changed them.
+    The transaction id is read from the mircs.transaction_id setting, see
+    start_transaction(). Changes made without it are not recorded.
+    """
+    global history_function_created
+    if history_function_created:
+        return
+    m.engine.execute(text(
+        'CREATE OR REPLACE FUNCTION %s.record_history() RETURNS trigger AS $$\n'
+        'DECLARE\n'
+        '    transaction_id text := current_setting(\'mircs.transaction_id\', true);\n'
+        'BEGIN\n'
+        '    IF transaction_id IS NULL OR transaction_id = \'\' THEN\n'
+        '        RETURN NULL;\n'
+        '    END IF;\n'
+        '    EXECUTE format(\'INSERT INTO %%I.%%I SELECT o.*, $1 FROM old_rows o\',\n'
+        '                   TG_TABLE_SCHEMA, TG_TABLE_NAME || \'_history\') USING transaction_id::integer;\n'
+        '    RETURN NULL;\n'
+        'END;\n'
+        '$$ LANGUAGE plpgsql' % search.quote_identifier(settings.DATABASES['default']['SCHEMA'])
+    ).execution_options(autocommit=True))
+    history_function_created = True
+
+
+def enable_history(table_uuid, schema):
+    """
+    Create the history table of a dataset and the triggers filling it. Only the
+    versions replaced or removed by an UPDATE or DELETE are copied, a statement
+    at a time, so appends cost nothing.
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    schema (str) - The schema the table lives in
+    """
+    create_history_function()
+    table = '%s.%s' % (search.quote_identifier(schema), search.quote_identifier(table_uuid))
+    history = '%s.%s' % (search.quote_identifier(schema),
+                         search.quote_identifier(get_history_table_name(table_uuid)))
+    with m.engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS %s (LIKE %s, transaction_id integer NOT NULL, history_id serial PRIMARY KEY)' % (
+                history, table
+            )
+        ))
+        # Finds the version of a row that was current at a transaction
+        connection.execute(text('CREATE INDEX IF NOT EXISTS %s ON %s (id, transaction_id)' % (
+            search.quote_identifier('%s_id_transaction_idx' % get_history_table_name(table_uuid)), history
+        )))
+        for event in ('UPDATE', 'DELETE'):
+            trigger = search.quote_identifier('%s_history_%s' % (table_uuid, event.lower()))
+            connection.execute(text('DROP TRIGGER IF EXISTS %s ON %s' % (trigger, table)))
+            connection.execute(text(
+                'CREATE TRIGGER %s AFTER %s ON %s REFERENCING OLD TABLE AS old_rows '
+                'FOR EACH STATEMENT EXECUTE PROCEDURE %s.record_history()' % (
+                    trigger, event, table, search.quote_identifier(settings.DATABASES['default']['SCHEMA'])
+                )
+            ))
+
+
+def start_transaction(connection):
+    """
+    Allocate the id of a dataset transaction about to be logged, and tag the
+    row versions the open database transaction replaces or removes with it
+
+    Parameters:
+    connection - An SQLAlchemy connection with an open transaction
+
+    Returns:
+    transaction_id (int) - The id to log the dataset transaction with
+    """
+    transaction_id = connection.execute(text(
+        'SELECT nextval(pg_get_serial_sequence(:table, \'id\'))'
+    ), table='%s.dataset_transactions' % search.quote_identifier(
+        settings.DATABASES['default']['SCHEMA']
+    )).scalar()
+    connection.execute(text('SELECT set_config(\'mircs.transaction_id\', :id, true)'), id=str(transaction_id))
+    return transaction_id
+
+
+def stop_recording(connection):
+    """
+    Stop recording the row versions replaced by the rest of the open database
+    transaction, eg. while finishing an update the history already holds
+    """
+    connection.execute(text('SELECT set_config(\'mircs.transaction_id\', \'\', true)'))
+
+
+def get_max_id(table_uuid, as_of):
+    """
+    Get the highest row id a dataset had once a transaction was done. Rows
+    are only ever added with higher ids, by create and add transactions.
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    as_of (int) - The id of a dataset transaction
+
+    Returns:
+    max_id (int) - The highest id, or 0 if the dataset had no rows yet
+    """
+    return m.get_engine().execute(text(
+        'SELECT max(affected_row_ids[array_length(affected_row_ids, 1)]) FROM %s.dataset_transactions '
+        'WHERE dataset_uuid = :dataset_uuid AND id <= :as_of AND transaction_type = ANY(:types)' % (
+            search.quote_identifier(settings.DATABASES['default']['SCHEMA'])
+        )
+    ), dataset_uuid=table_uuid, as_of=as_of, types=list(m.transaction_types[:2])).scalar() or 0
+
+
+def get_as_of_statement(table, condition=None):
+    """
+    Build a statement reading the rows of a dataset as they were once a
+    transaction was done. Rows unchanged since come from the dataset table, the
+    others from the earliest of their versions replaced after the transaction.
+    Both sides are found through indexes on the row id.
+
+    Parameters:
+    table - The SQLAlchemy Table object of the dataset
+    condition (str) - optional. An extra condition on the id column, eg. a page range
+
+    Bind Parameters:
+    as_of (int) - The id of the transaction
+    max_id (int) - The highest row id at that transaction, see get_max_id()
+
+    Returns:
+    statement - An SQLAlchemy selectable with the columns of the dataset, ordered by id
+    """
+    columns = ', '.join(search.quote_identifier(c.name) for c in table.columns)
+    history = '%s.%s' % (search.quote_identifier(table.schema),
+                         search.quote_identifier(get_history_table_name(table.name)))
+    condition = ' AND %s' % condition if condition else ''
+    return text(
+        'SELECT %(columns)s FROM %(table)s d WHERE id <= :max_id%(condition)s '
+        'AND NOT EXISTS (SELECT 1 FROM %(history)s h WHERE h.id = d.id AND h.transaction_id > :as_of) '
+        'UNION ALL '
+        'SELECT %(columns)s FROM (SELECT DISTINCT ON (id) * FROM %(history)s '
+        'WHERE transaction_id > :as_of AND id <= :max_id%(condition)s '
+        'ORDER BY id, transaction_id, history_id) h '
+        'ORDER BY id' % {
+            'columns': columns,
+            'table': '%s.%s' % (search.quote_identifier(table.schema), search.quote_identifier(table.name)),
+            'history': history,
+            'condition': condition,
+        }
+    ).columns(*table.columns)
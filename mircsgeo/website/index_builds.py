@@ -0,0 +1,404 @@
+import datetime
+import re
+import threading
+
+from django.conf import settings
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import Index
+
+import website.models as m
+import website.partitioning as partitions
+import website.search as search
+import website.table_generator as table_generator
+
+
+def get_key_index_name(table_uuid, dataset_columns):
+    """
+    Build the standard name of the index behind a dataset key
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    dataset_columns (list) - The columns of the key
+
+    Returns:
+    index_name (str) - eg. <uuid>_SURNAME_GIVEN_NAME_idx
+    """
+    return table_generator.get_index_name(table_uuid, '_'.join(dataset_columns), 'idx')
+
+
+def get_advised_index_name(table_uuid, dataset_columns):
+    """
+    Build the name of an index suggested by the index advisor. It differs from
+    the key index names so a key can still be added on the same columns later.
+    """
+    return table_generator.get_index_name(table_uuid, '_'.join(dataset_columns), 'advised_idx')
+
+
+def get_stored_index_name(index_name):
+    """
+    Get the name postgres actually stores for an index, which is cut to 63 bytes.
+    Keys registered before index names were kept short still carry the full name.
+    """
+    return index_name.encode('utf-8')[:63].decode('utf-8', 'ignore')
+
+
+def start_index_build(table_uuid, dataset_columns, index_name=None, register_key=True, background=True):
+    """
+    Build an index on an autogenerated table in a background thread, with
+    CREATE INDEX CONCURRENTLY so writes to the table aren't blocked meanwhile.
+    The build is tracked in the index_builds table.
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    dataset_columns (list) - The columns to index
+    index_name (str) - optional. Defaults to the standard dataset key index name
+    register_key (bool) - optional. Add the index to dataset_keys once it is built,
+                          so it can be used for joins
+    background (bool) - optional. Build in a background thread. Otherwise wait for
+                        the build, eg. from a management command
+
+    Returns:
+    build_id (int) - The id of the index_builds row tracking the build
+    """
+    if index_name is None:
+        index_name = get_key_index_name(table_uuid, dataset_columns)
+    session = m.get_session()
+    build = m.INDEX_BUILDS(
+        dataset_uuid=table_uuid,
+        index_name=index_name,
+        dataset_columns=dataset_columns,
+        register_key=register_key,
+        status=m.index_build_statuses[0],
+        started=datetime.datetime.now(),
+    )
+    session.add(build)
+    session.commit()
+    build_id = build.id
+    session.close()
+
+    if not background:
+        build_index(build_id)
+        return build_id
+    thread = threading.Thread(target=build_index, args=(build_id,), name='index_build_%d' % build_id)
+    thread.daemon = True
+    thread.start()
+    return build_id
+
+
+def update_build(build_id, **values):
+    """
+    Update the index_builds row of a build in its own transaction, so a failure
+    elsewhere in the build can't keep its status from being saved
+    """
+    session = m.get_session()
+    try:
+        session.query(m.INDEX_BUILDS).filter(m.INDEX_BUILDS.id == build_id).update(
+            values, synchronize_session=False
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+def get_qualified_index_name(index_name):
+    return '%s.%s' % (
+        search.quote_identifier(settings.DATABASES['default']['SCHEMA']),
+        search.quote_identifier(index_name)
+    )
+
+
+def drop_invalid_index(connection, index_name):
+    """
+    Drop the invalid index a failed concurrent build leaves behind. A valid
+    index that happens to have the same name is left alone.
+
+    Parameters:
+    connection - An SQLAlchemy connection in autocommit mode
+    index_name (str) - The name of the index
+    """
+    invalid = connection.execute(text(
+        'SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'
+    ), name=get_qualified_index_name(index_name)).scalar()
+    if invalid:
+        connection.execute(text('DROP INDEX CONCURRENTLY %s' % get_qualified_index_name(index_name)))
+
+
+def build_index(build_id):
+    """
+    Run an index build queued by start_index_build(). This runs in its own thread.
+
+    Parameters:
+    build_id (int) - The id of the index_builds row tracking the build
+    """
+    session = m.get_session()
+    build = session.query(m.INDEX_BUILDS).filter(m.INDEX_BUILDS.id == build_id).one()
+    session.expunge(build)
+    session.close()
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    connection = m.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        t = getattr(m.Base.classes, build.dataset_uuid)
+        column_objects = [getattr(t.__table__.columns, col) for col in build.dataset_columns]
+        # Remember the backend running the build so its progress can be looked up
+        update_build(build_id, status=m.index_build_statuses[1],
+                     backend_pid=connection.execute(text('SELECT pg_backend_pid()')).scalar())
+
+        # Postgres can't build indexes concurrently on partitioned tables, so those
+        # builds still block writes until they finish
+        concurrently = partitions.get_partitioning(build.dataset_uuid) is None
+        Index(build.index_name, *column_objects, postgresql_concurrently=concurrently).create(connection)
+    except Exception as e:
+        try:
+            drop_invalid_index(connection, build.index_name)
+        finally:
+            connection.close()
+            update_build(build_id, status=m.index_build_statuses[3], error=str(e),
+                         finished=datetime.datetime.now())
+        return
+    connection.close()
+
+    status, error = m.index_build_statuses[2], None
+    if build.register_key:
+        session = m.get_session()
+        try:
+            session.add(m.DATASET_KEYS(
+                dataset_uuid=build.dataset_uuid,
+                index_name=build.index_name,
+                dataset_columns=build.dataset_columns
+            ))
+            session.commit()
+        except Exception as e:
+            # eg. the key was registered in the meantime. The index itself is fine
+            session.rollback()
+            status, error = m.index_build_statuses[3], 'the index was built but the key ' \
+                'could not be registered: %s' % e
+        finally:
+            session.close()
+    update_build(build_id, status=status, error=error, finished=datetime.datetime.now())
+
+
+def fail_stale_builds(table_uuid):
+    """
+    Mark the builds of a dataset that can't be running anymore as failed, eg.
+    because the process running them was restarted. A build is stale when no
+    database backend is building its index, or when it has been pending for
+    more than settings.INDEX_BUILD_PENDING_TIMEOUT seconds. The connection of a
+    build stays open until it is done, so its backend disappears with the process.
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    """
+    session = m.get_session()
+    builds = session.query(m.INDEX_BUILDS).filter(
+        m.INDEX_BUILDS.dataset_uuid == table_uuid,
+        m.INDEX_BUILDS.status.in_(m.index_build_statuses[:2])
+    ).all()
+    session.close()
+    if not builds:
+        return
+
+    running = set(r[0] for r in m.engine.execute(text(
+        'SELECT pid FROM pg_stat_activity WHERE pid = ANY(:pids)'
+    ), pids=[b.backend_pid for b in builds if b.backend_pid is not None] or [0]))
+    now = datetime.datetime.now()
+    for build in builds:
+        if build.status == m.index_build_statuses[0]:
+            if (now - build.started).total_seconds() < settings.INDEX_BUILD_PENDING_TIMEOUT:
+                continue
+            error = 'the build never started'
+        elif build.backend_pid in running:
+            continue
+        else:
+            error = 'the build was interrupted'
+            connection = m.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+            try:
+                drop_invalid_index(connection, build.index_name)
+            finally:
+                connection.close()
+        update_build(build.id, status=m.index_build_statuses[3], error=error, finished=now)
+
+
+def get_index_builds(table_uuid):
+    """
+    Get the index builds of a dataset along with the progress of the running ones
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+
+    Returns:
+    builds (list) - A list of dictionaries, most recent build first. Running builds
+                    include the phase and percentage reported by postgres
+    """
+    fail_stale_builds(table_uuid)
+    session = m.get_session()
+    builds = session.query(
+        m.INDEX_BUILDS
+    ).filter(
+        m.INDEX_BUILDS.dataset_uuid == table_uuid
+    ).order_by(
+        m.INDEX_BUILDS.id.desc()
+    ).all()
+    session.close()
+
+    # pg_stat_progress_create_index is available from postgres 12
+    progress = {}
+    pids = [b.backend_pid for b in builds if b.status == m.index_build_statuses[1]]
+    if pids:
+        res = m.engine.execute(text(
+            'SELECT pid, phase, blocks_done, blocks_total, tuples_done, tuples_total '
+            'FROM pg_stat_progress_create_index WHERE pid = ANY(:pids)'
+        ), pids=pids)
+        for r in res:
+            done, total = (r[2], r[3]) if r[3] else (r[4], r[5])
+            progress[r[0]] = {
+                'phase': r[1],
+                'percent': 100.0 * done / total if total else None
+            }
+
+    return [{
+        'id': b.id,
+        'index_name': b.index_name,
+        'dataset_columns': b.dataset_columns,
+        'status': b.status,
+        'error': b.error,
+        'started': b.started,
+        'finished': b.finished,
+        'progress': progress.get(b.backend_pid) if b.status == m.index_build_statuses[1] else None,
+    } for b in builds]
+
+
+def get_indexed_columns(table_uuid):
+    """
+    Get the columns of an autogenerated table that lead an existing valid index
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+
+    Returns:
+    columns (set) - The names of the columns that can already be looked up by index
+    """
+    indexes = inspect(m.engine).get_indexes(table_uuid, schema=settings.DATABASES['default']['SCHEMA'])
+    columns = set(['id'])
+    for index in indexes:
+        if index['column_names'] and index['column_names'][0] is not None:
+            columns.add(index['column_names'][0])
+    return columns
+
+
+def get_filter_pattern(table_uuid):
+    """
+    Build a pattern finding the columns of a table compared, sorted or joined on
+    in a recorded SQL statement
+    """
+    # The table is only quoted when its uuid starts with a digit
+    column = r'(?:"%s"|\b%s)\.(?:"([^"]+)"|(\w+))' % (table_uuid, table_uuid)
+    return re.compile(
+        column + r'\s*(?:=|<>|!=|<=|>=|<|>|\bIN\b|\bLIKE\b|\bILIKE\b|\bBETWEEN\b|\bIS\b)|' +
+        r'=\s*' + column + r'|ORDER BY\s+' + column,
+        re.IGNORECASE
+    )
+
+
+def advise_indexes(table_uuid):
+    """
+    Suggest indexes for an autogenerated table from the recorded slow queries
+    against it and the keys used by its joins. Columns already leading an
+    index are never suggested.
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+
+    Returns:
+    suggestions (list) - A list of dictionaries with the columns to index, the
+                         reason and the slow query time the index could save,
+                         most useful first
+    """
+    t = getattr(m.Base.classes, table_uuid)
+    table_columns = set(c.name for c in t.__table__.columns)
+    indexed = get_indexed_columns(table_uuid)
+    suggestions = {}
+
+    # Columns filtered or sorted on by slow queries
+    session = m.get_session()
+    pattern = get_filter_pattern(table_uuid)
+    queries = session.query(
+        m.SLOW_QUERIES.statement,
+        m.SLOW_QUERIES.duration
+    ).filter(
+        m.SLOW_QUERIES.dataset_uuid == table_uuid
+    ).all()
+    for statement, duration in queries:
+        found = set()
+        for match in pattern.finditer(statement):
+            found.update(c for c in match.groups() if c)
+        for col in found & table_columns - indexed:
+            suggestion = suggestions.setdefault((col,), {'queries': 0, 'seconds': 0.0, 'join': False})
+            suggestion['queries'] += 1
+            suggestion['seconds'] += duration
+
+    # Join keys whose index is missing, eg. because its build failed
+    joins = session.query(m.DATASET_JOINS).filter(
+        (m.DATASET_JOINS.dataset1_uuid == table_uuid) | (m.DATASET_JOINS.dataset2_uuid == table_uuid)
+    ).all()
+    key_names = set([j.index1_name for j in joins if j.dataset1_uuid == table_uuid] +
+                    [j.index2_name for j in joins if j.dataset2_uuid == table_uuid])
+    keys = session.query(m.DATASET_KEYS).filter(
+        m.DATASET_KEYS.dataset_uuid == table_uuid,
+        m.DATASET_KEYS.index_name.in_(key_names or [''])
+    ).all()
+    session.close()
+    existing = set(i['name'] for i in inspect(m.engine).get_indexes(
+        table_uuid, schema=settings.DATABASES['default']['SCHEMA']
+    ))
+    for key in keys:
+        if get_stored_index_name(key.index_name) not in existing:
+            suggestion = suggestions.setdefault(tuple(key.dataset_columns),
+                                                {'queries': 0, 'seconds': 0.0, 'join': False})
+            suggestion['join'] = True
+
+    result = []
+    for columns, suggestion in suggestions.items():
+        reasons = []
+        if suggestion['queries']:
+            reasons.append('used by %d slow queries taking %.1fs in total' % (
+                suggestion['queries'], suggestion['seconds']))
+        if suggestion['join']:
+            reasons.append('join key without an index')
+        result.append({
+            'columns': list(columns),
+            'reason': ', '.join(reasons),
+            'seconds': suggestion['seconds'],
+            'join': suggestion['join'],
+        })
+    return sorted(result, key=lambda s: (not s['join'], -s['seconds']))
+
+
+def create_advised_indexes(table_uuid, min_seconds=None, background=True):
+    """
+    Start building the indexes suggested by advise_indexes()
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    min_seconds (float) - optional. Only build indexes that could have saved at least
+                          this much slow query time. Defaults to
+                          settings.INDEX_ADVISOR_MIN_SECONDS. Missing join key
+                          indexes are always built
+    background (bool) - optional. Build in background threads instead of one by one
+
+    Returns:
+    build_ids (list) - The ids of the index_builds rows tracking the builds
+    """
+    if min_seconds is None:
+        min_seconds = settings.INDEX_ADVISOR_MIN_SECONDS
+    build_ids = []
+    for suggestion in advise_indexes(table_uuid):
+        if suggestion['join']:
+            build_ids.append(start_index_build(table_uuid, suggestion['columns'], register_key=False,
+                                               index_name=get_key_index_name(table_uuid, suggestion['columns']),
+                                               background=background))
+        elif suggestion['seconds'] >= min_seconds:
+            build_ids.append(start_index_build(table_uuid, suggestion['columns'], register_key=False,
+                                               index_name=get_advised_index_name(table_uuid, suggestion['columns']),
+                                               background=background))
+    return build_ids
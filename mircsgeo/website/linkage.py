@@ -0,0 +1,385 @@
+import multiprocessing
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+from sqlalchemy import func
+import geoalchemy2.functions as geofunc
+
+import website.models as m
+import website.table_generator as table_generator
+
+# Letter to digit mapping used by soundex(). Vowels, h, w and y are dropped
+soundex_codes = {}
+for letters, code in (('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'),
+                      ('l', '4'), ('mn', '5'), ('r', '6')):
+    for letter in letters:
+        soundex_codes[letter] = code
+
+# Weights of each similarity measure in the combined score of a candidate pair
+score_weights = {
+    'name': 0.6,
+    'date': 0.25,
+    'place': 0.15
+}
+
+
+def normalize_name(name):
+    """
+    Lowercase a name and strip accents and anything that isn't a letter or a space
+
+    Parameters:
+    name (str) - The name to be normalized
+
+    Returns:
+    name (unicode) - The normalized name
+    """
+    if not isinstance(name, unicode):
+        name = unicode(str(name), 'utf-8', 'ignore')
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').lower()
+    return ' '.join(re.sub(r'[^a-z ]', ' ', name).split())
+
+
+def soundex(name):
+    """
+    Get the soundex phonetic code of a name so spelling variants like
+    'Smith' and 'Smyth' fall in the same block
+
+    Parameters:
+    name (str) - A normalized name, as returned by normalize_name()
+
+    Returns:
+    code (str) - A four character soundex code, or '' for an empty name
+    """
+    # Block on the last word of the name, which is usually the surname
+    words = name.split()
+    if not words:
+        return ''
+    word = words[-1]
+    code = word[0].upper()
+    last = soundex_codes.get(word[0], '')
+    for letter in word[1:]:
+        digit = soundex_codes.get(letter, '')
+        if digit and digit != last:
+            code += digit
+        # h and w don't separate letters with the same code
+        if letter not in 'hw':
+            last = digit
+    return (code + '000')[:4]
+
+
+def trigrams(name):
+    """
+    Get the set of character trigrams of a padded name
+    """
+    padded = '  %s ' % name
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def name_similarity_chunk(name_pairs):
+    """
+    Compute the trigram Jaccard similarity of a chunk of name pairs. This runs
+    in the worker processes of score_names(). The trigrams of each distinct name
+    are only built once, and the intersections of every pair are counted with
+    array operations: each trigram of the first name is looked up among the
+    sorted (name, trigram) codes of the second.
+
+    Parameters:
+    name_pairs (list) - A list of (name1, name2) tuples of normalized names
+
+    Returns:
+    similarities (numpy.ndarray) - The similarity of each pair, between 0 and 1
+    """
+    if not name_pairs:
+        return np.zeros(0)
+    codes, names = pd.factorize(np.array([n for pair in name_pairs for n in pair], dtype=object))
+    codes1, codes2 = codes[0::2], codes[1::2]
+
+    # Number the trigrams and lay out those of every distinct name end to end
+    vocabulary = {}
+    name_trigrams = [[vocabulary.setdefault(t, len(vocabulary)) for t in trigrams(n)] for n in names]
+    lengths = np.array([len(t) for t in name_trigrams], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    flat = np.array([t for ts in name_trigrams for t in ts], dtype=np.int64)
+    size = len(vocabulary)
+    # (name, trigram) codes, sorted so they can be searched
+    known = np.sort(np.repeat(np.arange(len(names), dtype=np.int64), lengths) * size + flat)
+
+    # One row per trigram of the first name of each pair
+    lengths1 = lengths[codes1]
+    pair_of_row = np.repeat(np.arange(len(name_pairs)), lengths1)
+    first_row = np.concatenate([[0], np.cumsum(lengths1)[:-1]])
+    position = np.arange(len(pair_of_row)) - np.repeat(first_row, lengths1)
+    probes = codes2[pair_of_row] * size + flat[np.repeat(offsets[codes1], lengths1) + position]
+    found = known[np.minimum(np.searchsorted(known, probes), len(known) - 1)] == probes
+
+    shared = np.bincount(pair_of_row, weights=found, minlength=len(name_pairs))
+    union = lengths1 + lengths[codes2] - shared
+    with np.errstate(invalid='ignore', divide='ignore'):
+        similarities = np.where(union > 0, shared / union, 0.0)
+    similarities[codes1 == codes2] = 1.0
+    return similarities
+
+
+def load_linkage_frame(table_uuid, name_column=None, date_column=None):
+    """
+    Load the columns used for linkage from an autogenerated table
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    name_column (str) - optional. The column holding the person's name
+    date_column (str) - optional. The column holding a date, eg. the birth date
+
+    Returns:
+    df (pandas.DataFrame) - A DataFrame with an id column and any of the name,
+                            date, lat and lon columns available in the dataset
+    """
+    session = m.get_session()
+    t = getattr(m.Base.classes, table_uuid)
+
+    columns = [t.id.label('id')]
+    if name_column is not None:
+        columns.append(getattr(t, name_column).label('name'))
+    if date_column is not None:
+        columns.append(getattr(t, date_column).label('date'))
+    geospatial_columns = table_generator.get_geospatial_columns(table_uuid)
+    if geospatial_columns:
+        # Bring every point to lat/lon so datasets with different SRIDs can be compared
+        geom = geofunc.ST_Transform(getattr(t, geospatial_columns[0]['name']), 4326)
+        columns.append(func.ST_Y(geom).label('lat'))
+        columns.append(func.ST_X(geom).label('lon'))
+
+    query = session.query(*columns)
+    df = pd.read_sql(query.statement, query.session.bind)
+    session.close()
+
+    if 'name' in df:
+        # Normalize every distinct name once and map the result back
+        names = df['name'].dropna().unique()
+        normalized = dict(zip(names, [normalize_name(n) for n in names]))
+        df['name'] = df['name'].map(normalized).fillna('')
+    if 'date' in df:
+        df['date'] = pd.to_datetime(df['date'], errors='coerce')
+    return df
+
+
+def add_blocking_keys(df):
+    """
+    Add the blocking key columns to a linkage DataFrame. Only records sharing
+    all the keys of a blocking pass are ever compared.
+
+    Parameters:
+    df (pandas.DataFrame) - A DataFrame returned by load_linkage_frame()
+
+    Returns:
+    keys (list) - The names of the blocking key columns that were added. Records
+                  missing a key have it set to null
+    """
+    keys = []
+    if 'name' in df:
+        codes = dict((n, soundex(n) or None) for n in df['name'].unique())
+        df['phonetic'] = df['name'].map(codes)
+        keys.append('phonetic')
+    if 'date' in df:
+        bucket = settings.LINKAGE_YEAR_BUCKET
+        year = df['date'].dt.year
+        df['year'] = year // bucket
+        # A second, shifted set of buckets catches pairs straddling a bucket edge
+        df['year_shifted'] = (year + bucket // 2) // bucket
+        keys += ['year', 'year_shifted']
+    if 'lat' in df:
+        size = settings.LINKAGE_CELL_SIZE
+        df['cell'] = np.floor(df['lat'] / size) * 100000 + np.floor(df['lon'] / size)
+        keys.append('cell')
+    return keys
+
+
+def get_blocking_passes(keys):
+    """
+    Get the combinations of blocking keys used to generate candidate pairs
+
+    Parameters:
+    keys (list) - The blocking keys available in both datasets
+
+    Returns:
+    passes (list) - A list of lists of blocking keys
+    """
+    if 'phonetic' in keys:
+        passes = [['phonetic', k] for k in ('year', 'year_shifted', 'cell') if k in keys]
+        return passes or [['phonetic']]
+    passes = [[k, 'cell'] for k in ('year', 'year_shifted') if k in keys and 'cell' in keys]
+    return passes or [[k] for k in keys]
+
+
+def get_candidate_pairs(df1, df2, passes):
+    """
+    Join two linkage DataFrames on each blocking pass to get the pairs of
+    records worth scoring, without ever building the full cross product
+
+    Parameters:
+    df1 (pandas.DataFrame) - The first DataFrame, with blocking keys added
+    df2 (pandas.DataFrame) - The second DataFrame, with blocking keys added
+    passes (list) - The blocking passes returned by get_blocking_passes()
+
+    Returns:
+    pairs (pandas.DataFrame) - A DataFrame of unique (id1, id2) pairs
+    """
+    pairs = []
+    for keys in passes:
+        left = df1[['id'] + keys]
+        right = df2[['id'] + keys]
+        # Drop records missing a key, and blocks too large to tell records apart
+        left = left.dropna(subset=keys)
+        right = right.dropna(subset=keys)
+        sizes = pd.merge(
+            left.groupby(keys).size().rename('n1').reset_index(),
+            right.groupby(keys).size().rename('n2').reset_index(),
+            on=keys
+        )
+        sizes = sizes[sizes['n1'] * sizes['n2'] <= settings.LINKAGE_MAX_BLOCK_PAIRS]
+        left = pd.merge(left, sizes[keys], on=keys)
+        pairs.append(pd.merge(left, right, on=keys, suffixes=('1', '2'))[['id1', 'id2']])
+    if not pairs:
+        return pd.DataFrame({'id1': [], 'id2': []})
+    return pd.concat(pairs, ignore_index=True).drop_duplicates()
+
+
+def score_names(names1, names2, processes=None):
+    """
+    Compute the similarity of pairs of names across a pool of processes. Each
+    distinct pair of names is only scored once.
+
+    Parameters:
+    names1 (pandas.Series) - The names on the left side of each pair
+    names2 (pandas.Series) - The names on the right side of each pair
+    processes (int) - optional. The number of worker processes
+
+    Returns:
+    similarities (numpy.ndarray) - The similarity of each pair, between 0 and 1
+    """
+    pairs = pd.DataFrame({'name1': names1.values, 'name2': names2.values})
+    unique_pairs = pairs.drop_duplicates().reset_index(drop=True)
+    name_pairs = list(zip(unique_pairs['name1'], unique_pairs['name2']))
+
+    chunk_size = 50000
+    chunks = [name_pairs[i:i + chunk_size] for i in range(0, len(name_pairs), chunk_size)]
+    if len(chunks) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(name_similarity_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [name_similarity_chunk(c) for c in chunks]
+
+    unique_pairs['similarity'] = np.concatenate(results) if results else []
+    return pd.merge(pairs, unique_pairs, on=['name1', 'name2'], how='left')['similarity'].values
+
+
+def score_pairs(pairs, df1, df2, processes=None):
+    """
+    Score candidate pairs on name, date and place similarity
+
+    Parameters:
+    pairs (pandas.DataFrame) - The candidate pairs from get_candidate_pairs()
+    df1 (pandas.DataFrame) - The first linkage DataFrame
+    df2 (pandas.DataFrame) - The second linkage DataFrame
+    processes (int) - optional. The number of processes scoring names
+
+    Returns:
+    pairs (pandas.DataFrame) - The pairs with a score column added. Measures
+                               missing from either record are left out of the
+                               weighted average rather than counted as mismatches
+    """
+    left = df1.set_index('id').reindex(pairs['id1'].values)
+    right = df2.set_index('id').reindex(pairs['id2'].values)
+    total = np.zeros(len(pairs))
+    weights = np.zeros(len(pairs))
+
+    def add_measure(similarity, weight):
+        known = ~np.isnan(similarity)
+        total[known] += similarity[known] * weight
+        weights[known] += weight
+
+    if 'name' in left and 'name' in right:
+        similarity = score_names(left['name'], right['name'], processes)
+        similarity[(left['name'].values == '') | (right['name'].values == '')] = np.nan
+        add_measure(similarity, score_weights['name'])
+    if 'date' in left and 'date' in right:
+        days = np.abs((left['date'].values - right['date'].values) / np.timedelta64(1, 'D'))
+        add_measure(
+            1 - np.minimum(days / settings.LINKAGE_DATE_TOLERANCE_DAYS, 1),
+            score_weights['date']
+        )
+    if 'lat' in left and 'lat' in right:
+        # Haversine distance in kilometres
+        lat1, lon1, lat2, lon2 = [np.radians(s.values.astype(float)) for s in
+                                  (left['lat'], left['lon'], right['lat'], right['lon'])]
+        a = np.sin((lat2 - lat1) / 2) ** 2 + \
+            np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        km = 6371 * 2 * np.arcsin(np.sqrt(a))
+        add_measure(
+            1 - np.minimum(km / settings.LINKAGE_DISTANCE_TOLERANCE_KM, 1),
+            score_weights['place']
+        )
+
+    pairs = pairs.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pairs['score'] = np.where(weights > 0, total / weights, 0)
+    return pairs
+
+
+def link_datasets(dataset1, dataset2, name_columns=(None, None), date_columns=(None, None),
+                  threshold=None, processes=None):
+    """
+    Find records of two datasets that probably describe the same person and
+    store them in the dataset_links table, replacing any earlier links between
+    the two datasets
+
+    Parameters:
+    dataset1 (str) - The uuid of the first dataset
+    dataset2 (str) - The uuid of the second dataset
+    name_columns (tuple) - The name column of each dataset
+    date_columns (tuple) - The date column of each dataset
+    threshold (float) - optional. The minimum score of a stored link.
+                        Defaults to settings.LINKAGE_THRESHOLD
+    processes (int) - optional. The number of processes scoring names.
+                      Defaults to settings.LINKAGE_PROCESSES
+
+    Returns:
+    links (int) - The number of links stored
+    """
+    if threshold is None:
+        threshold = settings.LINKAGE_THRESHOLD
+    if processes is None:
+        processes = settings.LINKAGE_PROCESSES
+
+    df1 = load_linkage_frame(dataset1, name_columns[0], date_columns[0])
+    df2 = load_linkage_frame(dataset2, name_columns[1], date_columns[1])
+    keys1 = add_blocking_keys(df1)
+    keys2 = add_blocking_keys(df2)
+    keys = [k for k in keys1 if k in keys2]
+
+    pairs = get_candidate_pairs(df1, df2, get_blocking_passes(keys))
+    pairs = score_pairs(pairs, df1, df2, processes)
+    pairs = pairs[pairs['score'] >= threshold]
+
+    links = m.DATASET_LINKS.__table__
+    with m.engine.begin() as connection:
+        connection.execute(links.delete().where(
+            (links.c.dataset1_uuid == dataset1) & (links.c.dataset2_uuid == dataset2)
+        ))
+        records = [{
+            'dataset1_uuid': dataset1,
+            'row1_id': int(r[0]),
+            'dataset2_uuid': dataset2,
+            'row2_id': int(r[1]),
+            'score': float(r[2])
+        } for r in pairs[['id1', 'id2', 'score']].itertuples(index=False)]
+        for i in range(0, len(records), 10000):
+            connection.execute(links.insert(), records[i:i + 10000])
+    return len(records)
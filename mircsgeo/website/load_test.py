@@ -0,0 +1,376 @@
+import cookielib
+import importlib
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib
+import urllib2
+import uuid
+
+import numpy as np
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from sqlalchemy import text
+
+import website.benchmark as benchmark
+import website.metrics as metrics
+import website.models as m
+import website.table_generator as table_generator
+import website.views as views
+
+# Prefix of the files uploaded by the load test, so the datasets they create can be found again
+upload_prefix = 'load-test-'
+
+# Geospatial column of the synthetic datasets, see benchmark.generate_dataset()
+geospatial_columns = 'name=geom&lat_col=LATITUDE&lon_col=LONGITUDE&srid=4326&type=latlon'
+
+
+def start_server(port, workers=4, threads=1, timeout=60):
+    """
+    Start the application under gunicorn, with view comments turned on so the
+    database connections it holds can be told apart by view
+
+    Parameters:
+    port (int) - The port to listen on, on 127.0.0.1
+    workers (int) - optional. The number of worker processes
+    threads (int) - optional. The number of threads of each worker
+    timeout (int) - optional. Seconds to wait for the server to answer
+
+    Returns:
+    server (subprocess.Popen) - The server process
+    """
+    env = dict(os.environ, MIRCS_SQL_VIEW_COMMENTS='1')
+    server = subprocess.Popen([
+        'gunicorn', 'mircsgeo.wsgi:application',
+        '--bind', '127.0.0.1:%d' % port,
+        '--workers', str(workers),
+        '--threads', str(threads),
+        '--timeout', '300',
+    ], cwd=settings.BASE_DIR, env=env)
+    url = 'http://127.0.0.1:%d/' % port
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise Exception("gunicorn exited with status %d" % server.returncode)
+        try:
+            urllib2.urlopen(url, timeout=5).read()
+            return server
+        except (urllib2.URLError, IOError):
+            time.sleep(0.5)
+    server.terminate()
+    raise Exception("the server didn't answer within %d seconds" % timeout)
+
+
+def seed_datasets(count, rows, seed=0):
+    """
+    Create synthetic datasets to browse, through the same views as an upload
+
+    Parameters:
+    count (int) - The number of datasets
+    rows (int) - The number of rows of each dataset
+    seed (int) - optional. The random seed
+
+    Returns:
+    datasets (list) - The uuids of the created datasets
+    """
+    datasets = []
+    for i in range(count):
+        df = benchmark.generate_dataset(rows, seed=seed + i)
+        filename = '%sseed-%s.csv' % (upload_prefix, uuid.uuid4())
+        session = importlib.import_module(settings.SESSION_ENGINE).SessionStore()
+        upload = SimpleUploadedFile(filename, df.to_csv(index=False), content_type='text/csv')
+        views.store_file(benchmark.make_request('post', '/store_file', {'file_upload': upload}, session))
+        views.create_table(benchmark.make_request('post', '/create_table', {
+            'datatypes': ','.join(table_generator.get_readable_types_from_dataframe(df)),
+            'geospatial_columns': geospatial_columns,
+        }, session))
+        datasets.append(benchmark.get_dataset_uuid(filename))
+    return datasets
+
+
+def drop_load_test_datasets():
+    """
+    Drop the datasets created by the load test, seeded and uploaded alike
+    """
+    session = m.get_session()
+    datasets = [r[0] for r in session.query(m.DATASETS.uuid).filter(
+        m.DATASETS.original_filename.like(upload_prefix + '%')
+    )]
+    session.close()
+    for table_uuid in datasets:
+        benchmark.drop_dataset(table_uuid)
+
+
+def encode_multipart(fields, files):
+    """
+    Encode a multipart/form-data request body
+
+    Parameters:
+    fields (dict) - The form fields
+    files (dict) - field name -> (filename, content) of the files to send
+
+    Returns:
+    content_type (str) - The Content-Type header of the body
+    body (str) - The body
+    """
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in fields.items():
+        lines += ['--' + boundary, 'Content-Disposition: form-data; name="%s"' % name, '', str(value)]
+    for name, (filename, content) in files.items():
+        lines += ['--' + boundary,
+                  'Content-Disposition: form-data; name="%s"; filename="%s"' % (name, filename),
+                  'Content-Type: text/csv', '', content]
+    lines += ['--' + boundary + '--', '']
+    return 'multipart/form-data; boundary=%s' % boundary, '\r\n'.join(lines)
+
+
+class Client(object):
+    """
+    A simulated user, with its own cookies. Every request it makes is recorded
+    in a shared list as an (endpoint, start, seconds, error) tuple.
+    """
+
+    def __init__(self, url, results):
+        self.url = url.rstrip('/')
+        self.results = results
+        self.cookies = cookielib.CookieJar()
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cookies))
+
+    def get_csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == 'csrftoken':
+                return cookie.value
+        return ''
+
+    def request(self, endpoint, path, data=None, files=None):
+        """
+        Make a request and record how long it took
+
+        Parameters:
+        endpoint (str) - The name the request is reported under
+        path (str) - The path of the request
+        data (dict) - optional. POST data, the request is a GET without it
+        files (dict) - optional. Files to upload, see encode_multipart()
+
+        Returns:
+        body (str) - The response body, or None if the request failed
+        """
+        body = None
+        headers = {}
+        if data is not None:
+            headers['X-CSRFToken'] = self.get_csrf_token()
+            headers['Referer'] = self.url + '/'
+            if files:
+                headers['Content-Type'], body = encode_multipart(data, files)
+            else:
+                body = urllib.urlencode(data)
+        start = time.time()
+        error = None
+        content = None
+        try:
+            response = self.opener.open(urllib2.Request(self.url + path, body, headers), timeout=300)
+            content = response.read()
+        except urllib2.HTTPError as e:
+            error = 'HTTP %d' % e.code
+        except (urllib2.URLError, IOError) as e:
+            error = str(e)
+        self.results.append((endpoint, start, time.time() - start, error))
+        return content
+
+
+def browse(client, page_counts, rng, pages=5):
+    """
+    Browse the map like a visitor: the home page, then a few pages of a
+    dataset with their map features
+
+    Parameters:
+    page_counts (dict) - The number of pages of each dataset that can be browsed
+    """
+    client.request('home', '/')
+    table = rng.choice(sorted(page_counts))
+    client.request('view_dataset', '/view/%s/' % table)
+    for i in range(pages):
+        page = rng.randrange(page_counts[table])
+        client.request('get_dataset_page', '/get_dataset_page/%s/%d/' % (table, page))
+        client.request('get_dataset_geojson', '/get_dataset_geojson/%s/%d/' % (table, page))
+
+
+def upload(client, csv, datatypes):
+    """
+    Upload a file and create a dataset from it, like the upload_file page does
+    """
+    client.request('upload_file', '/upload_file')
+    filename = '%s%s.csv' % (upload_prefix, uuid.uuid4())
+    if client.request('store_file', '/store_file', {}, {'file_upload': (filename, csv)}) is None:
+        return
+    client.request('create_table', '/create_table', {
+        'datatypes': datatypes,
+        'geospatial_columns': geospatial_columns,
+    })
+
+
+class ConnectionSampler(threading.Thread):
+    """
+    Sample pg_stat_activity while the load test runs, counting the connections
+    to the database by state and by the view that last used them
+    """
+
+    def __init__(self, interval):
+        threading.Thread.__init__(self, name='connection_sampler')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples = 0
+        self.totals = {}
+        self.peaks = {}
+
+    def run(self):
+        while not self.stopped.is_set():
+            counts = {}
+            res = m.engine.execute(text(
+                'SELECT state, query FROM pg_stat_activity '
+                'WHERE datname = current_database() AND pid <> pg_backend_pid() AND backend_type = \'client backend\''
+            ))
+            for state, query in res:
+                view = metrics.get_statement_view(query) or 'other'
+                for key in ((view, state or 'unknown'), ('all', state or 'unknown'), ('all', 'total')):
+                    counts[key] = counts.get(key, 0) + 1
+            for key, count in counts.items():
+                self.totals[key] = self.totals.get(key, 0) + count
+                self.peaks[key] = max(self.peaks.get(key, 0), count)
+            self.samples += 1
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def summarize(self):
+        """
+        Returns:
+        connections (dict) - view -> state -> mean and peak number of connections
+        """
+        summary = {}
+        for (view, state), total in self.totals.items():
+            summary.setdefault(view, {})[state] = {
+                'mean': total / float(self.samples),
+                'peak': self.peaks[(view, state)],
+            }
+        return summary
+
+
+def summarize(results, duration):
+    """
+    Summarize the recorded requests by endpoint
+
+    Parameters:
+    results (list) - The (endpoint, start, seconds, error) tuples recorded by the clients
+    duration (float) - The length of the test, in seconds
+
+    Returns:
+    endpoints (dict) - endpoint -> throughput, latency percentiles and error rate
+    """
+    endpoints = {}
+    for endpoint in sorted(set(r[0] for r in results)):
+        rs = [r for r in results if r[0] == endpoint]
+        durations = np.array([r[2] for r in rs])
+        errors = [r[3] for r in rs if r[3] is not None]
+        endpoints[endpoint] = {
+            'requests': len(rs),
+            'throughput_rps': len(rs) / duration,
+            'error_rate': len(errors) / float(len(rs)),
+            'errors': sorted(set(errors))[:10],
+            'latency_ms': {
+                'mean': durations.mean() * 1000,
+                'p50': np.percentile(durations, 50) * 1000,
+                'p95': np.percentile(durations, 95) * 1000,
+                'p99': np.percentile(durations, 99) * 1000,
+            },
+        }
+    return endpoints
+
+
+def run_load_test(url, datasets, concurrency=20, duration=60, mix=None, upload_rows=1000,
+                  sample_interval=0.5, seed=0):
+    """
+    Replay a mix of map browsing and uploads against a running server with many
+    simultaneous users
+
+    Parameters:
+    url (str) - The url of the server, eg. http://127.0.0.1:8123
+    datasets (list) - The uuids of the datasets to browse
+    concurrency (int) - optional. The number of simultaneous users
+    duration (float) - optional. How long to run, in seconds
+    mix (dict) - optional. The relative weight of each scenario, eg. {'browse': 9, 'upload': 1}
+    upload_rows (int) - optional. The number of rows of the uploaded files
+    sample_interval (float) - optional. Seconds between two pg_stat_activity samples
+    seed (int) - optional. The random seed
+
+    Returns:
+    report (dict) - A JSON serializable report of the options, the endpoints and
+                    the database connections
+    """
+    mix = mix or {'browse': 9, 'upload': 1}
+    options = {
+        'url': url,
+        'datasets': datasets,
+        'concurrency': concurrency,
+        'duration': duration,
+        'mix': mix,
+        'upload_rows': upload_rows,
+        'seed': seed,
+    }
+    page_counts = dict((d, max(views.get_page_count(d), 1)) for d in datasets)
+    df = benchmark.generate_dataset(upload_rows, seed=seed)
+    csv = df.to_csv(index=False)
+    datatypes = ','.join(table_generator.get_readable_types_from_dataframe(df))
+    scenarios = sorted(mix.items())
+
+    results = []
+    deadline = time.time() + duration
+
+    def user(number):
+        rng = random.Random(seed + number)
+        client = Client(url, results)
+        while time.time() < deadline:
+            pick = rng.uniform(0, sum(w for s, w in scenarios))
+            for scenario, weight in scenarios:
+                pick -= weight
+                if pick <= 0:
+                    break
+            if scenario == 'upload':
+                upload(client, csv, datatypes)
+            else:
+                browse(client, page_counts, rng)
+
+    sampler = ConnectionSampler(sample_interval)
+    sampler.start()
+    start = time.time()
+    users = [threading.Thread(target=user, args=(i,), name='load_test_user_%d' % i) for i in range(concurrency)]
+    for u in users:
+        u.start()
+    for u in users:
+        u.join()
+    elapsed = time.time() - start
+    sampler.stop()
+
+    return {
+        'options': options,
+        'environment': benchmark.get_environment(),
+        'elapsed': elapsed,
+        'endpoints': summarize(results, elapsed),
+        'connections': sampler.summarize(),
+    }
+
+
+def write_report(report, path):
+    """
+    Write a report returned by run_load_test() to a JSON file
+    """
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+import website.index_builds as index_builds
+import website.models as m
+
+
+class Command(BaseCommand):
+    help = 'Suggest indexes for datasets from their slow queries and joins, and optionally build them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasets', nargs='*', help='uuids of the datasets, defaults to all of them')
+        parser.add_argument('--create', action='store_true',
+                            help='build the suggested indexes')
+        parser.add_argument('--min-seconds', type=float, default=None,
+                            help='only build indexes that could have saved this much slow query time')
+
+    def handle(self, *args, **options):
+        datasets = options['datasets']
+        if not datasets:
+            session = m.get_session()
+            datasets = [d.uuid for d in session.query(m.DATASETS.uuid).all()]
+            session.close()
+
+        for dataset in datasets:
+            for suggestion in index_builds.advise_indexes(dataset):
+                self.stdout.write('%s (%s): %s' % (dataset, ', '.join(suggestion['columns']), suggestion['reason']))
+            if options['create']:
+                build_ids = index_builds.create_advised_indexes(dataset, min_seconds=options['min_seconds'],
+                                                                background=False)
+                self.stdout.write('%s: built %d indexes' % (dataset, len(build_ids)))
@@ -0,0 +1,54 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+import website.benchmark as benchmark
+
+
+class Command(BaseCommand):
+    help = 'Time the ingest and read paths against synthetic datasets and write the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000,100000',
+                            help='comma separated numbers of rows to benchmark with')
+        parser.add_argument('--extra-columns', type=int, default=0,
+                            help='number of additional free text columns')
+        parser.add_argument('--date-columns', type=int, default=2,
+                            help='number of date columns')
+        parser.add_argument('--distribution', choices=['clustered', 'uniform'], default='clustered',
+                            help='how the generated points are spread')
+        parser.add_argument('--repeat', type=int, default=20,
+                            help='number of timed calls of each read endpoint')
+        parser.add_argument('--seed', type=int, default=0, help='random seed')
+        parser.add_argument('--keep', action='store_true',
+                            help='keep the generated datasets instead of dropping them')
+        parser.add_argument('--output', default='benchmark.json', help='file the results are written to')
+        parser.add_argument('--baseline', default=None,
+                            help='earlier results file to compare the new results against')
+
+    def handle(self, *args, **options):
+        report = benchmark.run_benchmarks(
+            [int(s) for s in options['sizes'].split(',')],
+            extra_columns=options['extra_columns'],
+            date_columns=options['date_columns'],
+            distribution=options['distribution'],
+            repeat=options['repeat'],
+            seed=options['seed'],
+            keep=options['keep']
+        )
+        benchmark.write_report(report, options['output'])
+
+        for r in report['results']:
+            self.stdout.write('%8d %-20s p50 %10.1f ms  p95 %10.1f ms  %12.0f rows/s  %8.1f MB' % (
+                r['size'], r['operation'], r['latency_ms']['p50'], r['latency_ms']['p95'],
+                r['throughput_rows_per_s'] or 0, r['peak_rss_mb']
+            ))
+
+        if options['baseline'] is not None:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            self.stdout.write('\nCompared to %s:' % options['baseline'])
+            for size, operation, before, after, ratio in benchmark.compare(report, baseline):
+                self.stdout.write('%8d %-20s %10.1f ms -> %10.1f ms  x%.2f' % (
+                    size, operation, before, after, ratio or 0
+                ))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+import website.linkage as linkage
+
+
+class Command(BaseCommand):
+    help = 'Find records of two datasets describing the same person and store them as links'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset1', help='uuid of the first dataset')
+        parser.add_argument('dataset2', help='uuid of the second dataset')
+        parser.add_argument('--name-columns', nargs=2, default=[None, None],
+                            metavar=('NAME1', 'NAME2'),
+                            help='name column of each dataset')
+        parser.add_argument('--date-columns', nargs=2, default=[None, None],
+                            metavar=('DATE1', 'DATE2'),
+                            help='date column of each dataset, eg. the birth dates')
+        parser.add_argument('--threshold', type=float, default=None,
+                            help='minimum score of a stored link')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='number of processes scoring names')
+
+    def handle(self, *args, **options):
+        links = linkage.link_datasets(
+            options['dataset1'],
+            options['dataset2'],
+            name_columns=options['name_columns'],
+            date_columns=options['date_columns'],
+            threshold=options['threshold'],
+            processes=options['processes']
+        )
+        self.stdout.write('Stored %d links' % links)
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+
+import website.load_test as load_test
+
+
+class Command(BaseCommand):
+    help = 'Replay map browsing and uploads with many simultaneous users and write the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=None,
+                            help='server to test. Defaults to starting the app under gunicorn')
+        parser.add_argument('--port', type=int, default=8123, help='port of the started server')
+        parser.add_argument('--workers', type=int, default=4, help='worker processes of the started server')
+        parser.add_argument('--threads', type=int, default=1, help='threads of each worker of the started server')
+        parser.add_argument('--concurrency', type=int, default=20, help='number of simultaneous users')
+        parser.add_argument('--duration', type=float, default=60, help='seconds to run for')
+        parser.add_argument('--mix', default='browse=9,upload=1',
+                            help='relative weight of each scenario, eg. browse=9,upload=1')
+        parser.add_argument('--datasets', type=int, default=2, help='number of synthetic datasets to browse')
+        parser.add_argument('--rows', type=int, default=10000, help='rows of each synthetic dataset')
+        parser.add_argument('--upload-rows', type=int, default=1000, help='rows of each uploaded file')
+        parser.add_argument('--sample-interval', type=float, default=0.5,
+                            help='seconds between two samples of the database connections')
+        parser.add_argument('--seed', type=int, default=0, help='random seed')
+        parser.add_argument('--keep', action='store_true',
+                            help='keep the generated datasets instead of dropping them')
+        parser.add_argument('--output', default='load_test.json', help='file the results are written to')
+
+    def handle(self, *args, **options):
+        mix = dict((s.split('=')[0], float(s.split('=')[1])) for s in options['mix'].split(','))
+        datasets = load_test.seed_datasets(options['datasets'], options['rows'], options['seed'])
+        server = None
+        url = options['url']
+        try:
+            if url is None:
+                server = load_test.start_server(options['port'], options['workers'], options['threads'])
+                url = 'http://127.0.0.1:%d' % options['port']
+            report = load_test.run_load_test(
+                url, datasets,
+                concurrency=options['concurrency'],
+                duration=options['duration'],
+                mix=mix,
+                upload_rows=options['upload_rows'],
+                sample_interval=options['sample_interval'],
+                seed=options['seed']
+            )
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            if not options['keep']:
+                load_test.drop_load_test_datasets()
+        load_test.write_report(report, options['output'])
+
+        for endpoint, r in sorted(report['endpoints'].items()):
+            self.stdout.write('%-20s %6d req %8.1f req/s  p50 %8.1f ms  p95 %8.1f ms  p99 %8.1f ms  %5.1f%% errors' % (
+                endpoint, r['requests'], r['throughput_rps'], r['latency_ms']['p50'],
+                r['latency_ms']['p95'], r['latency_ms']['p99'], r['error_rate'] * 100
+            ))
+        self.stdout.write('\nDatabase connections (mean / peak):')
+        for view, states in sorted(report['connections'].items()):
+            self.stdout.write('%-20s %s' % (view, '  '.join(
+                '%s %.1f / %d' % (state, s['mean'], s['peak']) for state, s in sorted(states.items())
+            )))
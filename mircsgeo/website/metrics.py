@@ -0,0 +1,273 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from sqlalchemy import event
+
+# Guards the registry below, views run in several threads
+lock = threading.Lock()
+
+# Per request state: the view being run, its sql totals and its timing spans
+local = threading.local()
+
+# name -> (type, help text, {labels: value})
+# Histogram values are [bucket counts..., sum, count]
+registry = {}
+
+# Patterns used by normalize_statement(), applied in order
+statement_patterns = [
+    (re.compile(r'\s*/\* view=[^*]* \*/$'), ''),
+    # Identifiers are only quoted when they have to be, so uuids starting with a letter are bare
+    (re.compile(r'(?:"|\b)[0-9a-f]{32}(?![0-9a-f])(?:_[a-z]+)?"?'), '"<dataset>"'),
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\([^)]+\)s|%s'), '?'),
+    (re.compile(r'\b\d+(\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize_statement(statement):
+    """
+    Reduce an SQL statement to its shape, so that the same query against
+    different datasets or with different parameters gets the same label
+
+    Parameters:
+    statement (str) - The SQL statement
+
+    Returns:
+    shape (str) - The statement with dataset tables, literals and parameters
+                  replaced by placeholders, truncated to 200 characters
+    """
+    for pattern, replacement in statement_patterns:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()[:200]
+
+
+def format_labels(labels):
+    """
+    Format a tuple of (name, value) label pairs in the prometheus text format
+    """
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in labels)
+
+
+def inc(name, labels, value=1, help_text=''):
+    """
+    Increment a counter
+
+    Parameters:
+    name (str) - The name of the metric
+    labels (dict) - The labels of the series being incremented
+    value (float) - optional. The amount to increment by
+    help_text (str) - optional. A description of the metric
+    """
+    key = tuple(sorted(labels.items()))
+    with lock:
+        series = registry.setdefault(name, ('counter', help_text, {}))[2]
+        series[key] = series.get(key, 0) + value
+
+
+def set_gauge(name, labels, value, help_text=''):
+    """
+    Set the value of a gauge
+
+    Parameters:
+    name (str) - The name of the metric
+    labels (dict) - The labels of the series being set
+    value (float) - The new value
+    help_text (str) - optional. A description of the metric
+    """
+    key = tuple(sorted(labels.items()))
+    with lock:
+        registry.setdefault(name, ('gauge', help_text, {}))[2][key] = value
+
+
+def observe(name, labels, value, help_text=''):
+    """
+    Record an observation in a histogram with settings.METRICS_BUCKETS buckets
+
+    Parameters:
+    name (str) - The name of the metric
+    labels (dict) - The labels of the series being observed
+    value (float) - The observed value, usually a duration in seconds
+    help_text (str) - optional. A description of the metric
+    """
+    key = tuple(sorted(labels.items()))
+    buckets = settings.METRICS_BUCKETS
+    with lock:
+        series = registry.setdefault(name, ('histogram', help_text, {}))[2]
+        values = series.setdefault(key, [0] * (len(buckets) + 2))
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                values[i] += 1
+        values[-2] += value
+        values[-1] += 1
+
+
+def render():
+    """
+    Render every metric in the prometheus text exposition format
+
+    Returns:
+    text (str) - The metrics, one sample per line
+    """
+    lines = []
+    with lock:
+        for name in sorted(registry):
+            metric_type, help_text, series = registry[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for key in sorted(series):
+                labels = format_labels(key)
+                if metric_type in ('counter', 'gauge'):
+                    lines.append('%s{%s} %s' % (name, labels, series[key]))
+                    continue
+                values = series[key]
+                separator = ',' if labels else ''
+                for i, bound in enumerate(settings.METRICS_BUCKETS):
+                    lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, separator, bound, values[i]))
+                lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, separator, values[-1]))
+                lines.append('%s_sum{%s} %f' % (name, labels, values[-2]))
+                lines.append('%s_count{%s} %d' % (name, labels, values[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def start_request(view):
+    """
+    Reset the per request state of the current thread
+
+    Parameters:
+    view (str) - The name of the view handling the request
+    """
+    local.view = view
+    local.sql_count = 0
+    local.sql_time = 0.0
+    local.spans = []
+
+
+def get_request_state():
+    """
+    Get the name of the current view and its timing spans, including the sql total
+
+    Returns:
+    view (str) - The view name, or None outside of a request
+    spans (list) - A list of (name, seconds) tuples
+    """
+    view = getattr(local, 'view', None)
+    if view is None:
+        return None, []
+    return view, [('sql', local.sql_time)] + local.spans
+
+
+def end_request():
+    """
+    Clear the per request state of the current thread
+    """
+    local.view = None
+
+
+def export_request_state():
+    """
+    Get the sql totals and timing spans recorded by the current thread, so a
+    worker thread can hand them back to the request it ran for
+
+    Returns:
+    state (tuple) - (sql_count, sql_time, spans), or None outside of a request
+    """
+    if getattr(local, 'view', None) is None:
+        return None
+    return local.sql_count, local.sql_time, list(local.spans)
+
+
+def merge_request_state(state):
+    """
+    Add the state returned by export_request_state() in another thread to the
+    request of the current thread
+    """
+    if state is None or getattr(local, 'view', None) is None:
+        return
+    sql_count, sql_time, spans = state
+    local.sql_count += sql_count
+    local.sql_time += sql_time
+    local.spans.extend(spans)
+
+
+@contextmanager
+def span(name):
+    """
+    Time a phase of a view, eg. converting a DataFrame or serializing a response.
+    The duration goes into the mircs_view_span_seconds histogram and the
+    Server-Timing header of the response.
+
+    Parameters:
+    name (str) - The name of the phase
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        view = getattr(local, 'view', None)
+        observe('mircs_view_span_seconds', {'view': view, 'span': name}, duration,
+                'Time spent in each phase of a view')
+        if view is not None:
+            local.spans.append((name, duration))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info['query_start_time'].pop()
+    view = getattr(local, 'view', None)
+    labels = {'view': view, 'statement': normalize_statement(statement)}
+    observe('mircs_sql_query_seconds', labels, duration, 'Time spent running sql statements')
+    if view is not None:
+        local.sql_count += 1
+        local.sql_time += duration
+
+
+# Comment added to the end of statements by add_view_comment()
+view_comment_pattern = re.compile(r'/\* view=([^*]*) \*/$')
+
+
+def add_view_comment(conn, cursor, statement, parameters, context, executemany):
+    """
+    Tag a statement with the view running it, so the connections seen in
+    pg_stat_activity can be told apart by view, eg. by the load tester
+    """
+    view = getattr(local, 'view', None)
+    if view is not None:
+        statement = '%s /* view=%s */' % (statement, view)
+    return statement, parameters
+
+
+def get_statement_view(statement):
+    """
+    Get the view a statement was tagged with by add_view_comment()
+
+    Returns:
+    view (str) - The view name, or None for untagged statements
+    """
+    match = view_comment_pattern.search(statement or '')
+    return match.group(1) if match else None
+
+
+def instrument_engine(engine):
+    """
+    Attach the timing hooks to an SQLAlchemy engine. Engines that are
+    already instrumented are left alone.
+
+    Parameters:
+    engine - The SQLAlchemy engine
+    """
+    if event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        return
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    if settings.SQL_VIEW_COMMENTS:
+        event.listen(engine, 'before_cursor_execute', add_view_comment, retval=True)
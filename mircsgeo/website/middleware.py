@@ -0,0 +1,192 @@
+import gzip
+import hashlib
+import re
+import time
+from io import BytesIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+import website.metrics as metrics
+import website.models as m
+
+
+def read_only(view_func):
+    """
+    Mark a view as only reading from the database, so ReplicaRoutingMiddleware
+    can serve its GET requests from a replica
+    """
+    view_func.read_only = True
+    return view_func
+
+
+def cache_by_dataset_version(view_func):
+    """
+    Mark a view whose response only depends on the request and the rows of the
+    dataset in its table argument, so CompressionMiddleware can cache its
+    compressed responses until the dataset changes
+    """
+    view_func.cache_by_dataset_version = True
+    return view_func
+
+
+def get_accepted_encoding(request):
+    """
+    Pick the best compression the client accepts, brotli when it is installed
+    and otherwise gzip
+
+    Returns:
+    encoding (str) - 'br', 'gzip' or None
+    """
+    accepted = set()
+    for encoding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        encoding = encoding.strip()
+        # Skip encodings the client explicitly refuses, eg. gzip;q=0
+        if not encoding or re.search(r';\s*q=0(\.0*)?$', encoding):
+            continue
+        accepted.add(encoding.split(';')[0].strip())
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    """
+    Compress a response body with gzip or brotli
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=settings.COMPRESSION_BROTLI_QUALITY)
+    buf = BytesIO()
+    with gzip.GzipFile(mode='wb', compresslevel=settings.COMPRESSION_GZIP_LEVEL, fileobj=buf) as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+class MetricsMiddleware(object):
+    """
+    Record the latency and sql usage of every view in website.metrics, and
+    optionally report them to the browser in a Server-Timing header
+    """
+
+    def process_request(self, request):
+        request.metrics_start_time = time.time()
+        metrics.start_request(None)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics.start_request(view_func.__name__)
+
+    def process_response(self, request, response):
+        start_time = getattr(request, 'metrics_start_time', None)
+        if start_time is None:
+            return response
+        duration = time.time() - start_time
+        view, spans = metrics.get_request_state()
+        view = view or 'unmatched'
+
+        metrics.observe('mircs_request_seconds', {
+            'view': view,
+            'method': request.method,
+            'status': response.status_code
+        }, duration, 'Time spent handling requests')
+        metrics.inc('mircs_sql_queries_total', {'view': view}, metrics.local.sql_count,
+                    'Number of sql statements run by each view')
+
+        if settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = ', '.join(
+                ['%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in spans] +
+                ['total;dur=%.1f' % (duration * 1000)]
+            )
+        metrics.end_request()
+        return response
+
+
+class ReplicaRoutingMiddleware(object):
+    """
+    Route the reads of views marked with read_only() to a read replica. After a
+    user writes something, their reads stay on the primary until a replica has
+    replayed that write. Has to come after SessionMiddleware.
+    """
+
+    def process_request(self, request):
+        m.use_engine(None)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not m.replica_engines or not getattr(view_func, 'read_only', False) or \
+                request.method not in ('GET', 'HEAD'):
+            return
+        write_lsn = request.session.get('write_lsn')
+        if write_lsn is not None and \
+                time.time() - request.session.get('write_time', 0) > settings.REPLICA_READ_YOUR_WRITES_SECONDS:
+            # Every replica has long caught up with that write
+            del request.session['write_lsn']
+            del request.session['write_time']
+            write_lsn = None
+        m.use_engine(m.choose_read_engine(write_lsn))
+
+    def process_response(self, request, response):
+        m.use_engine(None)
+        if m.replica_engines and request.method not in ('GET', 'HEAD', 'OPTIONS') and hasattr(request, 'session'):
+            # Remember how far the primary had got once this request's writes were done
+            request.session['write_lsn'] = m.get_write_lsn()
+            request.session['write_time'] = time.time()
+        return response
+
+
+class CompressionMiddleware(object):
+    """
+    Compress JSON responses with brotli or gzip, depending on what the client
+    accepts. The compressed responses of views marked with
+    cache_by_dataset_version() are cached until their dataset changes, and
+    served from the cache without running the view again. Has to come after
+    ReplicaRoutingMiddleware.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.compression_cache_key = None
+        if request.method != 'GET' or not getattr(view_func, 'cache_by_dataset_version', False):
+            return
+        encoding = get_accepted_encoding(request)
+        if encoding is None:
+            return
+        version = m.get_dataset_version(view_kwargs['table'])
+        if version is None:
+            return
+        # The Accept header can pick the format of the response, so it is part of the key
+        request.compression_cache_key = 'compressed:%s:%s:%s' % (encoding, version, hashlib.sha1(
+            (request.get_full_path() + '\n' + request.META.get('HTTP_ACCEPT', '')).encode('utf-8')
+        ).hexdigest())
+        cached = cache.get(request.compression_cache_key)
+        if cached is None:
+            return
+        content_type, body = cached
+        response = HttpResponse(body, content_type=content_type)
+        response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def process_response(self, request, response):
+        if response.streaming or response.status_code != 200 or response.has_header('Content-Encoding') or \
+                not response.get('Content-Type', '').startswith('application/json'):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = get_accepted_encoding(request)
+        if encoding is None or len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+
+        body = compress(response.content, encoding)
+        response.content = body
+        response['Content-Encoding'] = encoding
+        response['Content-Length'] = str(len(body))
+        cache_key = getattr(request, 'compression_cache_key', None)
+        if cache_key is not None:
+            cache.set(cache_key, (response['Content-Type'], body), settings.COMPRESSION_CACHE_TIMEOUT)
+        return response
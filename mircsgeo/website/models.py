@@ -4,10 +4,12 @@ from django.conf import settings
 
 # from django.db import models
 from sqlalchemy.ext.automap import automap_base
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Float, DateTime, ForeignKeyConstraint, ForeignKey, Enum, UniqueConstraint, Boolean
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Float, DateTime, ForeignKeyConstraint, ForeignKey, Enum, UniqueConstraint, Boolean, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.dialects.postgresql import ARRAY
 
+import random
+import threading
 import uuid
 
 import atexit
@@ -16,6 +18,10 @@ import atexit
 
 # Get a connection to the database based on the info in settings.py
 engine = create_engine(settings.SQLALCHEMY_CONNECT_STRING, echo=False)
+# Read-only endpoints can be served by replicas of that database instead
+replica_engines = [create_engine(s, echo=False) for s in settings.SQLALCHEMY_REPLICA_CONNECT_STRINGS]
+# The engine the reads of each thread are routed to. None means the primary
+routing = threading.local()
 # Create a metadata object to attach tables to
 m = MetaData(schema=settings.DATABASES['default']['SCHEMA'])
 
@@ -82,6 +88,44 @@ dataset_joins = Table('dataset_joins', m,
     )
 )
 
+dataset_links = Table('dataset_links', m,
+    Column('id', Integer, primary_key=True),
+    Column('dataset1_uuid', String, index=True),
+    Column('row1_id', Integer),
+    Column('dataset2_uuid', String, index=True),
+    Column('row2_id', Integer),
+    Column('score', Float),
+    ForeignKeyConstraint(['dataset1_uuid'], [settings.DATABASES['default']['SCHEMA'] + '.datasets.uuid']),
+    ForeignKeyConstraint(['dataset2_uuid'], [settings.DATABASES['default']['SCHEMA'] + '.datasets.uuid']),
+)
+
+slow_queries = Table('slow_queries', m,
+    Column('id', Integer, primary_key=True),
+    Column('dataset_uuid', String, index=True),
+    Column('view', String),
+    Column('statement', String),
+    Column('parameters', String),
+    Column('duration', Float),
+    Column('plan', String),
+    Column('recorded', DateTime),
+    ForeignKeyConstraint(['dataset_uuid'], [settings.DATABASES['default']['SCHEMA'] + '.datasets.uuid']),
+)
+
+index_build_statuses = ('pending', 'building', 'done', 'failed')
+index_builds = Table('index_builds', m,
+    Column('id', Integer, primary_key=True),
+    Column('dataset_uuid', String, index=True),
+    Column('index_name', String),
+    Column('dataset_columns', ARRAY(String)),
+    Column('register_key', Boolean, default=True),
+    Column('status', Enum(*index_build_statuses, name='index_build_status'), default=index_build_statuses[0]),
+    Column('backend_pid', Integer),
+    Column('error', String),
+    Column('started', DateTime),
+    Column('finished', DateTime),
+    ForeignKeyConstraint(['dataset_uuid'], [settings.DATABASES['default']['SCHEMA'] + '.datasets.uuid']),
+)
+
 # SAVAGE
 # Close your eyes
 def name_for_collection_relationship(base, local_cls, refered_cls, constraint):
@@ -102,6 +146,12 @@ DATASET_TRANSACTIONS = Base.classes.dataset_transactions
 DATASET_KEYS = Base.classes.dataset_keys
 GEOSPATIAL_COLUMNS = Base.classes.geospatial_columns
 DATASET_JOINS = Base.classes.dataset_joins
+DATASET_LINKS = Base.classes.dataset_links
+SLOW_QUERIES = Base.classes.slow_queries
+INDEX_BUILDS = Base.classes.index_builds
+
+# Bumped every time the database schema is reflected again, see statements.check_version()
+schema_version = 0
 
 
 def refresh():
@@ -109,15 +159,96 @@ def refresh():
     global Base
     global Session
     global engine
+    global schema_version
     m.reflect(engine)
     Base = automap_base(metadata=m)
     Base.prepare(name_for_collection_relationship=name_for_collection_relationship)
     Session = sessionmaker(bind=engine)
+    # Let the caches built from the reflected tables know they are out of date
+    schema_version += 1
 
 
 # Helper function for querying
 def get_session():
-    return Session()
+    return Session(bind=get_engine())
+
+
+def get_engine():
+    """
+    Get the engine the current thread reads from. This is a replica while a
+    read-only view is being served and the primary otherwise, so anything
+    writing should use engine directly.
+    """
+    return getattr(routing, 'engine', None) or engine
+
+
+def use_engine(read_engine):
+    """
+    Route the reads of the current thread to an engine, or back to the primary with None
+    """
+    routing.engine = read_engine
+
+
+def get_dataset_version(table_uuid):
+    """
+    Get a number that changes whenever the rows of a dataset change, ie. the id
+    of its latest transaction. Anything computed from the rows can be cached
+    for as long as it stays the same.
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+
+    Returns:
+    version (int) - The version, or None for an unknown dataset
+    """
+    return get_engine().execute(text(
+        'SELECT max(id) FROM %s.dataset_transactions WHERE dataset_uuid = :uuid'
+        % settings.DATABASES['default']['SCHEMA']
+    ), uuid=table_uuid).scalar()
+
+
+def get_write_lsn():
+    """
+    Get the current write position of the primary's write-ahead log. A replica
+    that has replayed up to this position sees every write made so far.
+
+    Returns:
+    lsn (str) - eg. 0/3000148
+    """
+    return engine.execute(text('SELECT pg_current_wal_lsn()::text')).scalar()
+
+
+def has_replayed(replica_engine, lsn):
+    """
+    Check whether a replica has replayed the write-ahead log up to a position.
+    Replicas that can't be reached or aren't replicating count as behind.
+    """
+    try:
+        return bool(replica_engine.execute(
+            text('SELECT pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn)'), lsn=lsn
+        ).scalar())
+    except Exception:
+        return False
+
+
+def choose_read_engine(write_lsn=None):
+    """
+    Pick a replica to serve a read-only request from
+
+    Parameters:
+    write_lsn (str) - optional. The position of the last write the reader made,
+                      as returned by get_write_lsn(). Only replicas that have
+                      replayed it are picked, so readers always see their own writes
+
+    Returns:
+    engine - A replica engine, or None if the primary has to be used
+    """
+    replicas = list(replica_engines)
+    random.shuffle(replicas)
+    for replica_engine in replicas:
+        if write_lsn is None or has_replayed(replica_engine, write_lsn):
+            return replica_engine
+    return None
 
 
 def exit_handler():
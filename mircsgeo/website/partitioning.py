@@ -0,0 +1,289 @@
+import math
+
+import pandas as pd
+
+from django.conf import settings
+from sqlalchemy import text
+
+import website.models as m
+import website.search as search
+
+# The ways an autogenerated table can be split into partitions
+partition_strategies = ('id', 'date', 'cell')
+
+# Name of the column holding the partition of each row for the date and cell strategies
+partition_key_column = 'partition_key'
+
+# partition_key of the rows without a date or a location. They are kept in the default partition
+missing_partition_key = -2147483648
+
+# Cached partitioning definitions, they never change once a table is created
+definitions = {}
+
+
+def parse_partitioning_string(partitioning_string):
+    """
+    Convert a partitioning definition string into a dictionary
+
+    Parameters:
+    partitioning_string (str) - A string defining how a table is partitioned, as
+                                posted by the upload_file page or stored in the
+                                metadata table.
+        examples: strategy=id
+                  strategy=date&column=BIRTH_DATE
+                  strategy=cell&column=geom
+
+    Returns:
+    partitioning (dict) - A dictionary containing all the information found in
+                          the definition string, or None for an empty string
+    """
+    if not partitioning_string:
+        return None
+    partitioning = {'definition': partitioning_string}
+    for field in partitioning_string.split('&'):
+        field = field.split('=')
+        partitioning[field[0]] = field[1]
+    if partitioning['strategy'] not in partition_strategies:
+        raise Exception("invalid partitioning strategy: %s" % partitioning['strategy'])
+    return partitioning
+
+
+def get_partitioning(table_uuid):
+    """
+    Get the partitioning definition of an autogenerated table
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+
+    Returns:
+    partitioning (dict) - The definition as returned by parse_partitioning_string(),
+                          or None if the table isn't partitioned
+    """
+    if table_uuid not in definitions:
+        session = m.get_session()
+        res = session.query(m.METADATA.value).filter(
+            m.METADATA.dataset_uuid == table_uuid,
+            m.METADATA.key == 'partitioning'
+        ).first()
+        session.close()
+        definitions[table_uuid] = parse_partitioning_string(res[0]) if res else None
+    return definitions[table_uuid]
+
+
+def save_partitioning(session, table_uuid, partitioning):
+    """
+    Add the partitioning definition of a new table to the metadata table
+
+    Parameters:
+    session - The SQLAlchemy session the dataset is being created in
+    table_uuid (str) - The uuid of the new table
+    partitioning (dict) - The definition as returned by parse_partitioning_string()
+    """
+    session.add(m.METADATA(
+        dataset_uuid=table_uuid,
+        key='partitioning',
+        value=partitioning['definition']
+    ))
+    definitions[table_uuid] = partitioning
+
+
+def get_partition_by(partitioning):
+    """
+    Get the PARTITION BY clause of a partitioned table, for postgresql_partition_by
+    """
+    if partitioning['strategy'] == 'id':
+        return 'RANGE (id)'
+    elif partitioning['strategy'] == 'date':
+        return 'RANGE (%s)' % partition_key_column
+    return 'LIST (%s)' % partition_key_column
+
+
+def get_year_bucket(year):
+    """
+    Get the partition_key of the date partition holding a year
+    """
+    return int(year // settings.PARTITION_DATE_INTERVAL * settings.PARTITION_DATE_INTERVAL)
+
+
+def get_cell(lat, lon):
+    """
+    Get the partition_key of the cell partition holding a location. Cells are
+    settings.PARTITION_CELL_SIZE degrees wide, numbered row by row from (-90, -180)
+    """
+    size = settings.PARTITION_CELL_SIZE
+    columns = int(math.ceil(360.0 / size))
+    row = int(math.floor((min(max(lat, -90), 90) + 90) / size))
+    column = int(math.floor((min(max(lon, -180), 180) + 180) / size)) % columns
+    return row * columns + column
+
+
+def get_bbox_cells(bbox):
+    """
+    Get the partition_keys of the cells intersecting a bounding box
+
+    Parameters:
+    bbox (str) - 'min_lon,min_lat,max_lon,max_lat' in EPSG:4326
+
+    Returns:
+    cells (list) - A list of cell numbers
+    """
+    min_lon, min_lat, max_lon, max_lat = [float(x) for x in bbox.split(',')]
+    size = settings.PARTITION_CELL_SIZE
+    cells = set()
+    lat = min_lat
+    while True:
+        lon = min_lon
+        while True:
+            cells.add(get_cell(lat, lon))
+            if lon >= max_lon:
+                break
+            lon = min(lon + size, max_lon)
+        if lat >= max_lat:
+            break
+        lat = min(lat + size, max_lat)
+    return sorted(cells)
+
+
+def add_partition_keys(df, partitioning, geospatial_columns):
+    """
+    Compute the partition_key column of rows about to be inserted into a table
+    partitioned by date or cell
+
+    Parameters:
+    df (pandas.DataFrame) - The rows being inserted
+    partitioning (dict) - The definition as returned by parse_partitioning_string()
+    geospatial_columns (list) - The geospatial columns of the table, as returned
+                                by get_geospatial_columns()
+
+    Returns:
+    keys (pandas.Series) - The partition_key of each row
+    """
+    if partitioning['strategy'] == 'date':
+        years = pd.to_datetime(df[partitioning['column']], errors='coerce').dt.year
+        keys = years.map(lambda y: missing_partition_key if pd.isnull(y) else get_year_bucket(y))
+    else:
+        geo = [c for c in geospatial_columns if c['name'] == partitioning['column']][0]
+        if geo['type'] != 'latlon':
+            raise Exception("cell partitioning needs a latlon geospatial column: %s" % geo['name'])
+        lats = pd.to_numeric(df[geo['lat_col']], errors='coerce')
+        lons = pd.to_numeric(df[geo['lon_col']], errors='coerce')
+        keys = pd.Series([
+            missing_partition_key if pd.isnull(lat) or pd.isnull(lon) else get_cell(lat, lon)
+            for lat, lon in zip(lats, lons)
+        ], index=df.index)
+    return keys.astype(int)
+
+
+def create_partition(table_uuid, schema, name, bounds):
+    """
+    Create a partition of a table if it doesn't exist yet
+
+    Parameters:
+    table_uuid (str) - The uuid of the partitioned table
+    schema (str) - The schema the table lives in
+    name (str) - The name of the partition
+    bounds (str) - The partition bounds, eg. FOR VALUES IN (3) or DEFAULT
+    """
+    m.engine.execute(text('CREATE TABLE IF NOT EXISTS %s.%s PARTITION OF %s.%s %s' % (
+        search.quote_identifier(schema),
+        search.quote_identifier(name),
+        search.quote_identifier(schema),
+        search.quote_identifier(table_uuid),
+        bounds
+    )))
+
+
+def create_default_partition(table_uuid, schema):
+    """
+    Create the partition catching the rows that no other partition accepts
+    """
+    create_partition(table_uuid, schema, '%s_default' % table_uuid, 'DEFAULT')
+
+
+def ensure_partitions(table_uuid, schema, partitioning, rows, keys=None):
+    """
+    Create the partitions needed by rows about to be inserted into a partitioned
+    table, so they don't all end up in the default partition
+
+    Parameters:
+    table_uuid (str) - The uuid of the partitioned table
+    schema (str) - The schema the table lives in
+    partitioning (dict) - The definition as returned by parse_partitioning_string()
+    rows (int) - The number of rows about to be inserted
+    keys (pandas.Series) - optional. The partition_keys of the rows for the date
+                           and cell strategies, as returned by add_partition_keys()
+    """
+    if partitioning['strategy'] == 'id':
+        # Ids come from the serial sequence, so the new rows get the next ones
+        last_id = m.engine.execute(text(
+            'SELECT last_value FROM %s' % m.engine.execute(text(
+                'SELECT pg_get_serial_sequence(:table, :column)'
+            ), table='%s.%s' % (
+                search.quote_identifier(schema), search.quote_identifier(table_uuid)
+            ), column='id').scalar()
+        )).scalar()
+        interval = settings.PARTITION_ID_INTERVAL
+        for start in range(last_id // interval * interval, last_id + rows + 1, interval):
+            create_partition(table_uuid, schema, '%s_p%d' % (table_uuid, start // interval),
+                             'FOR VALUES FROM (%d) TO (%d)' % (start, start + interval))
+    elif partitioning['strategy'] == 'date':
+        for key in sorted(set(keys) - set([missing_partition_key])):
+            create_partition(table_uuid, schema, '%s_p%d' % (table_uuid, key),
+                             'FOR VALUES FROM (%d) TO (%d)' % (key, key + settings.PARTITION_DATE_INTERVAL))
+    else:
+        for key in sorted(set(keys) - set([missing_partition_key])):
+            create_partition(table_uuid, schema, '%s_p%d' % (table_uuid, key),
+                             'FOR VALUES IN (%d)' % key)
+
+
+def get_time_filter(t, table_uuid, column, start=None, end=None):
+    """
+    Build a filter on the partition_key of a table partitioned by date, letting
+    postgres skip the partitions outside a date range
+
+    Parameters:
+    t - The automapped SQLAlchemy class of the table
+    table_uuid (str) - The uuid of the table
+    column (str) - The datetime column the date range applies to
+    start (str or pandas.Timestamp) - optional. The start of the range, eg. 1850-01-01
+    end (str or pandas.Timestamp) - optional. The end of the range
+
+    Returns:
+    filter - An SQLAlchemy filter expression, or None if it wouldn't prune anything
+    """
+    partitioning = get_partitioning(table_uuid)
+    if partitioning is None or partitioning['strategy'] != 'date' or partitioning['column'] != column:
+        return None
+    key = getattr(t, partition_key_column)
+    filters = []
+    if start is not None:
+        filters.append(key >= get_year_bucket(pd.Timestamp(start).year))
+    if end is not None:
+        filters.append(key <= get_year_bucket(pd.Timestamp(end).year))
+    if not filters:
+        # Rows without a date never match a date range
+        return key != missing_partition_key
+    return filters[0] if len(filters) == 1 else filters[0] & filters[1]
+
+
+def get_bbox_filter(t, table_uuid, geospatial_column, bbox):
+    """
+    Build a filter on the partition_key of a table partitioned by cell, letting
+    postgres skip the partitions outside a bounding box
+
+    Parameters:
+    t - The automapped SQLAlchemy class of the table
+    table_uuid (str) - The uuid of the table
+    geospatial_column (dict) - The geospatial column the bounding box applies to
+    bbox (str) - 'min_lon,min_lat,max_lon,max_lat' in EPSG:4326
+
+    Returns:
+    filter - An SQLAlchemy filter expression, or None if it wouldn't prune anything
+    """
+    partitioning = get_partitioning(table_uuid)
+    if partitioning is None or partitioning['strategy'] != 'cell' or \
+            partitioning['column'] != geospatial_column['name'] or int(geospatial_column['srid']) != 4326:
+        # Cells are computed from the raw coordinates, they only line up with
+        # EPSG:4326 bounding boxes for EPSG:4326 columns
+        return None
+    return getattr(t, partition_key_column).in_(get_bbox_cells(bbox))
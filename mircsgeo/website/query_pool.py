@@ -0,0 +1,84 @@
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+import website.metrics as metrics
+import website.models as m
+
+pool = None
+pool_lock = threading.Lock()
+# One slot per worker. A function only goes to the pool if it can take a slot
+workers = None
+
+
+def get_pool_size():
+    """
+    Get the number of worker threads. Every busy worker holds a database
+    connection, so there are never more workers than connections the engine
+    keeps open.
+    """
+    engine_size = getattr(m.engine.pool, 'size', None)
+    if engine_size is None:
+        return settings.QUERY_POOL_SIZE
+    return max(1, min(settings.QUERY_POOL_SIZE, engine_size()))
+
+
+def get_pool():
+    """
+    Get the thread pool shared by every request, creating it on first use
+    """
+    global pool, workers
+    if pool is None:
+        with pool_lock:
+            if pool is None:
+                size = get_pool_size()
+                workers = threading.BoundedSemaphore(size)
+                pool = ThreadPool(size)
+    return pool
+
+
+def run_concurrently(*functions):
+    """
+    Run independent functions, usually database queries, at the same time and
+    wait for all of them. The database driver releases the GIL while waiting
+    on postgres, so the queries really do overlap. Each function must open its
+    own session, since sessions can't be shared between threads.
+
+    The first function runs in the request's own thread. The others go to the
+    shared pool, or also run in the request's thread when every worker is busy,
+    so a burst of requests never queues behind the pool.
+
+    Parameters:
+    functions (list) - Functions taking no arguments
+
+    Returns:
+    results (list) - The return value of each function, in order
+    """
+    view = metrics.get_request_state()[0]
+    read_engine = m.get_engine()
+
+    def run(function):
+        # Label the sql run by the worker thread with the view it runs for, and
+        # read from the same database as the request
+        metrics.start_request(view)
+        m.use_engine(read_engine)
+        try:
+            return function(), metrics.export_request_state()
+        finally:
+            m.use_engine(None)
+            metrics.end_request()
+            workers.release()
+
+    shared = get_pool()
+    results = [None]
+    for f in functions[1:]:
+        results.append(shared.apply_async(run, (f,)) if workers.acquire(False) else None)
+
+    values = [f() if r is None else None for f, r in zip(functions, results)]
+    for i, r in enumerate(results):
+        if r is not None:
+            values[i], state = r.get()
+            # Count the sql and spans of the workers in the request's totals and Server-Timing
+            metrics.merge_request_state(state)
+    return values
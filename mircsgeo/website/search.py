@@ -0,0 +1,189 @@
+from django.conf import settings
+from sqlalchemy import text, String
+
+import website.models as m
+
+
+def quote_identifier(name):
+    """
+    Quote a table or column name for use in a raw SQL statement
+
+    Parameters:
+    name (str) - The identifier to be quoted
+
+    Returns:
+    quoted (str) - The identifier wrapped in double quotes with any embedded
+                   double quotes escaped
+    """
+    return '"%s"' % name.replace('"', '""')
+
+
+def get_search_index_name(table_name):
+    """
+    Get the name of the full-text index of an autogenerated table
+
+    Parameters:
+    table_name (str) - The uuid of an autogenerated database table
+
+    Returns:
+    index_name (str) - The name of the tsvector index on that table
+    """
+    return '%s_search_idx' % table_name
+
+
+def get_trigram_index_name(table_name):
+    """
+    Get the name of the trigram index of an autogenerated table
+    """
+    return '%s_search_trgm_idx' % table_name
+
+
+def get_search_document_sql(columns):
+    """
+    Build the SQL expression concatenating the searchable columns of a table.
+    The exact same expression has to be used when creating the index and when
+    querying it, otherwise postgres will not use the index.
+
+    Parameters:
+    columns (list) - A list of string column names
+
+    Returns:
+    document (str) - An immutable SQL expression usable in an index definition
+    """
+    return " || ' ' || ".join(
+        ["coalesce(%s, '')" % quote_identifier(c) for c in columns]
+    )
+
+
+def get_search_vector_sql(columns):
+    """
+    Build the tsvector SQL expression indexed for a table
+
+    Parameters:
+    columns (list) - A list of string column names
+
+    Returns:
+    vector (str) - A to_tsvector() SQL expression over the given columns
+    """
+    return "to_tsvector('%s'::regconfig, %s)" % (
+        settings.SEARCH_TEXT_CONFIG,
+        get_search_document_sql(columns)
+    )
+
+
+def get_searchable_columns(table):
+    """
+    Get the names of the string columns of an autogenerated table
+
+    Parameters:
+    table - The automapped SQLAlchemy class of the table
+
+    Returns:
+    columns (list) - A list of column names, in table order
+    """
+    return [c.name for c in table.__table__.columns
+            if c.name != 'id' and isinstance(c.type, String)]
+
+
+def create_search_index(table_name, schema, columns):
+    """
+    Create a full-text index (and optionally a trigram index) over the string
+    columns of an autogenerated table. The indexes are on expressions, so rows
+    added later by appends are indexed by postgres without any extra work.
+
+    Parameters:
+    table_name (str) - The uuid of an autogenerated database table
+    schema (str) - The schema the table lives in
+    columns (list) - The names of the string columns to be indexed
+
+    Returns:
+    Nothing
+    """
+    if not columns:
+        return
+    qualified_name = '%s.%s' % (quote_identifier(schema), quote_identifier(table_name))
+    m.engine.execute(text('CREATE INDEX %s ON %s USING GIN (%s)' % (
+        quote_identifier(get_search_index_name(table_name)),
+        qualified_name,
+        get_search_vector_sql(columns)
+    )))
+    if settings.SEARCH_TRIGRAM_INDEX:
+        m.engine.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        m.engine.execute(text('CREATE INDEX %s ON %s USING GIN ((lower(%s)) gin_trgm_ops)' % (
+            quote_identifier(get_trigram_index_name(table_name)),
+            qualified_name,
+            get_search_document_sql(columns)
+        )))
+
+
+def get_indexed_tables(schema, index_name_function):
+    """
+    Get the uuids of all the autogenerated tables that have a search index
+
+    Parameters:
+    schema (str) - The schema the tables live in
+    index_name_function (function) - get_search_index_name or get_trigram_index_name
+
+    Returns:
+    tables (list) - A list of table uuids
+    """
+    res = m.get_engine().execute(
+        text('SELECT tablename, indexname FROM pg_indexes WHERE schemaname = :schema'),
+        schema=schema
+    )
+    return [r[0] for r in res if r[1] == index_name_function(r[0])]
+
+
+def search(query, schema, limit=50, fuzzy=False):
+    """
+    Search every indexed dataset for rows matching a query and return the best
+    ranked hits across all of them
+
+    Parameters:
+    query (str) - The text being searched for, eg. a person's name
+    schema (str) - The schema the autogenerated tables live in
+    limit (int) - The maximum number of hits returned
+    fuzzy (bool) - Use trigram word similarity instead of full-text matching.
+                   Requires settings.SEARCH_TRIGRAM_INDEX
+
+    Returns:
+    hits (list) - A list of (dataset_uuid, row id, rank) tuples ordered by rank
+    """
+    index_name_function = get_trigram_index_name if fuzzy else get_search_index_name
+    subqueries = []
+    for table_name in get_indexed_tables(schema, index_name_function):
+        if not hasattr(m.Base.classes, table_name):
+            continue
+        columns = get_searchable_columns(getattr(m.Base.classes, table_name))
+        if fuzzy:
+            document = 'lower(%s)' % get_search_document_sql(columns)
+            subquery = (
+                "(SELECT '%(table)s' AS dataset_uuid, id, "
+                "word_similarity(lower(:query), %(document)s) AS rank "
+                "FROM %(schema)s.%(qtable)s WHERE lower(:query) <%% %(document)s "
+                "ORDER BY rank DESC LIMIT :limit)"
+            )
+        else:
+            document = get_search_vector_sql(columns)
+            subquery = (
+                "(SELECT '%(table)s' AS dataset_uuid, id, "
+                "ts_rank(%(document)s, plainto_tsquery('%(config)s'::regconfig, :query)) AS rank "
+                "FROM %(schema)s.%(qtable)s "
+                "WHERE %(document)s @@ plainto_tsquery('%(config)s'::regconfig, :query) "
+                "ORDER BY rank DESC LIMIT :limit)"
+            )
+        subqueries.append(subquery % {
+            'table': table_name,
+            'qtable': quote_identifier(table_name),
+            'schema': quote_identifier(schema),
+            'document': document,
+            'config': settings.SEARCH_TEXT_CONFIG,
+        })
+    if not subqueries:
+        return []
+
+    statement = 'SELECT * FROM (%s) hits ORDER BY rank DESC LIMIT :limit' % (
+        ' UNION ALL '.join(subqueries)
+    )
+    res = m.get_engine().execute(text(statement), query=query, limit=limit)
+    return [(r[0], r[1], float(r[2])) for r in res]
@@ -0,0 +1,176 @@
+import datetime
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from django.conf import settings
+from sqlalchemy import event
+
+import website.metrics as metrics
+import website.models as m
+
+# Table names of the autogenerated dataset tables are uuids without dashes. They
+# are only quoted when they start with a digit
+dataset_pattern = re.compile(r'(?:"|\b)([0-9a-f]{32})(?![0-9a-f])(?:_[a-z]+)?"?')
+
+# Slow queries waiting to be explained and stored by the recorder thread
+pending = queue.Queue(maxsize=1000)
+
+recorder = None
+recorder_lock = threading.Lock()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('slow_query_start_time', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info['slow_query_start_time'].pop()
+    if duration < settings.SLOW_QUERY_THRESHOLD:
+        return
+    dataset_uuid = get_dataset_uuid(statement)
+    if dataset_uuid is None:
+        return
+    try:
+        pending.put_nowait({
+            'dataset_uuid': dataset_uuid,
+            'view': metrics.get_request_state()[0],
+            'statement': statement,
+            'parameters': None if executemany else parameters,
+            'duration': duration,
+            'recorded': datetime.datetime.now(),
+        })
+    except queue.Full:
+        # Never slow requests down to keep up with recording
+        return
+    start_recorder()
+
+
+def get_dataset_uuid(statement, datasets=None):
+    """
+    Find the dataset a statement runs against
+
+    Parameters:
+    statement (str) - The SQL statement
+    datasets - optional. The known dataset uuids. Defaults to the reflected tables
+
+    Returns:
+    dataset_uuid (str) - The uuid of the first known dataset table in the statement, or None
+    """
+    if datasets is None:
+        datasets = m.Base.classes
+    for match in dataset_pattern.finditer(statement):
+        if match.group(1) in datasets:
+            return match.group(1)
+    return None
+
+
+def explain(statement, parameters):
+    """
+    Run EXPLAIN (ANALYZE, BUFFERS) on a statement. Only SELECT statements are
+    explained, since ANALYZE actually runs the statement again.
+
+    Parameters:
+    statement (str) - The SQL statement, as sent to the database driver
+    parameters - The parameters sent with the statement
+
+    Returns:
+    plan (str) - The text of the query plan, or None if it wasn't explained
+    """
+    if not statement.lstrip().upper().startswith('SELECT'):
+        return None
+    # Use a raw driver connection so the explain itself isn't timed and recorded
+    connection = m.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SET LOCAL statement_timeout = %d' % settings.SLOW_QUERY_EXPLAIN_TIMEOUT)
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters)
+        plan = '\n'.join(r[0] for r in cursor.fetchall())
+    except Exception as e:
+        plan = 'EXPLAIN failed: %s' % e
+    finally:
+        connection.rollback()
+        connection.close()
+    return plan
+
+
+def record(query):
+    """
+    Store a slow query, explaining a sample of them first
+
+    Parameters:
+    query (dict) - A slow query queued by after_cursor_execute()
+    """
+    if random.random() < settings.SLOW_QUERY_EXPLAIN_SAMPLE_RATE:
+        query['plan'] = explain(query['statement'], query['parameters'])
+    query['parameters'] = json.dumps(query['parameters'], default=str)
+    # This insert doesn't name a dataset table, so it is never recorded itself
+    m.engine.execute(m.SLOW_QUERIES.__table__.insert(), query)
+
+
+def run_recorder():
+    while True:
+        query = pending.get()
+        try:
+            record(query)
+        except Exception:
+            # A failure to record one query shouldn't stop the recorder
+            pass
+
+
+def start_recorder():
+    """
+    Start the thread storing slow queries, if it isn't running yet
+    """
+    global recorder
+    if recorder is not None:
+        return
+    with recorder_lock:
+        if recorder is None:
+            recorder = threading.Thread(target=run_recorder, name='slow_query_recorder')
+            recorder.daemon = True
+            recorder.start()
+
+
+def instrument_engine(engine):
+    """
+    Attach the slow query hooks to an SQLAlchemy engine. Engines that are
+    already instrumented are left alone.
+
+    Parameters:
+    engine - The SQLAlchemy engine
+    """
+    if event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        return
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def get_slow_queries(table_uuid, limit=20):
+    """
+    Get the slowest recorded queries of a dataset
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    limit (int) - optional. The maximum number of queries returned
+
+    Returns:
+    queries (list) - A list of SLOW_QUERIES objects, slowest first
+    """
+    session = m.get_session()
+    queries = session.query(
+        m.SLOW_QUERIES
+    ).filter(
+        m.SLOW_QUERIES.dataset_uuid == table_uuid
+    ).order_by(
+        m.SLOW_QUERIES.duration.desc()
+    ).limit(limit).all()
+    session.close()
+    return queries
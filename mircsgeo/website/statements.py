@@ -0,0 +1,102 @@
+import threading
+
+from django.conf import settings
+from sqlalchemy.util import LRUCache
+
+import website.models as m
+import website.table_generator as table_generator
+
+# Guards the caches below, views run in several threads
+lock = threading.Lock()
+
+# table_uuid -> the resolved metadata of a dataset, see get_dataset_info()
+datasets = {}
+
+# (table_uuid, name, variant) -> a statement built once with bind parameters
+statements = {}
+
+# The compiled SQL of the cached statements, handed to SQLAlchemy as its
+# compiled_cache so they are only compiled once per dialect
+compiled = LRUCache(settings.STATEMENT_CACHE_SIZE)
+
+# The models.schema_version the caches were filled at
+cached_version = None
+
+
+def check_version():
+    """
+    Empty the caches if the database schema was reflected again since they were
+    filled, eg. after a dataset was created or dropped
+    """
+    global cached_version
+    if cached_version != m.schema_version:
+        with lock:
+            datasets.clear()
+            statements.clear()
+            compiled.clear()
+            cached_version = m.schema_version
+
+
+def get_dataset_info(table_uuid):
+    """
+    Get the metadata of a dataset needed to query it, resolved once
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+
+    Returns:
+    info (dict) - A dictionary containing:
+                    * class - the automapped SQLAlchemy class of the table
+                    * table - its SQLAlchemy Table object
+                    * geospatial_columns - as returned by get_geospatial_columns()
+                    * geometry_column_names - as returned by get_geometry_column_names()
+    """
+    check_version()
+    info = datasets.get(table_uuid)
+    if info is None:
+        t = getattr(m.Base.classes, table_uuid)
+        geospatial_columns = table_generator.get_geospatial_columns(table_uuid)
+        info = {
+            'class': t,
+            'table': t.__table__,
+            'geospatial_columns': geospatial_columns,
+            'geometry_column_names': table_generator.get_geometry_column_names(geospatial_columns),
+        }
+        with lock:
+            datasets[table_uuid] = info
+    return info
+
+
+def get_statement(table_uuid, name, build, variant=None):
+    """
+    Get a statement of a dataset, building it the first time. Values that change
+    from request to request have to be bind parameters, given when the statement
+    is run on the engine returned by get_engine().
+
+    Parameters:
+    table_uuid (str) - The uuid of an autogenerated database table
+    name (str) - The name of the statement, eg. page
+    build (function) - Builds the statement from the dictionary returned by
+                       get_dataset_info()
+    variant - optional. Tells apart statements of the same name whose structure
+              depends on the request, eg. whether geometries are simplified
+
+    Returns:
+    statement - An SQLAlchemy selectable
+    """
+    check_version()
+    key = (table_uuid, name, variant)
+    statement = statements.get(key)
+    if statement is None:
+        statement = build(get_dataset_info(table_uuid))
+        with lock:
+            statements[key] = statement
+    return statement
+
+
+def get_engine():
+    """
+    Get the engine the current thread reads from, reusing the compiled SQL of
+    the cached statements
+    """
+    return m.get_engine().execution_options(compiled_cache=compiled)
@@ -0,0 +1,139 @@
+//Upload a file in chunks so a dropped connection only loses the chunk in flight.
+//The upload id is kept in localStorage so a reloaded page resumes the same upload.
+//onPreview is called with the file preview as soon as the server can parse one,
+//onProgress with the received and total sizes, and onComplete once the file is stored.
+function chunkedUpload(file, chunkSize, csrfToken, onPreview, onProgress, onComplete) {
+  var storageKey = 'upload:' + file.name + ':' + file.size + ':' + file.lastModified;
+  var previewShown = false;
+  var retries = 0;
+  var maxRetries = 5;
+
+  function showPreview(data) {
+    if(data['preview'] && !previewShown) {
+      previewShown = true;
+      onPreview(data['preview']);
+    }
+  }
+
+  //Get the hex sha256 digest of a chunk, or '' if the browser can't compute it
+  function checksum(blob, callback) {
+    if(!window.crypto || !window.crypto.subtle) {
+      callback('');
+      return;
+    }
+    var reader = new FileReader();
+    reader.onload = function() {
+      window.crypto.subtle.digest('SHA-256', reader.result).then(function(digest) {
+        var hex = '';
+        var bytes = new Uint8Array(digest);
+        for(var i=0; i<bytes.length; i++) {
+          hex += ('0' + bytes[i].toString(16)).slice(-2);
+        }
+        callback(hex);
+      }, function() {
+        callback('');
+      });
+    };
+    reader.readAsArrayBuffer(blob);
+  }
+
+  //Wait a little and ask the server where to carry on from
+  function retry(uploadId) {
+    retries += 1;
+    if(retries > maxRetries) {
+      alert('The upload of ' + file.name + ' failed. Select the file again to resume it.');
+      return;
+    }
+    setTimeout(function() {
+      $.getJSON('/upload_status/' + uploadId, function(data) {
+        sendChunk(uploadId, data['received']);
+      }).fail(function() {
+        retry(uploadId);
+      });
+    }, 1000 * retries);
+  }
+
+  function sendChunk(uploadId, offset) {
+    onProgress(offset, file.size);
+    if(offset >= file.size) {
+      complete(uploadId);
+      return;
+    }
+    var blob = file.slice(offset, offset + chunkSize);
+    checksum(blob, function(digest) {
+      var formData = new FormData();
+      formData.append('chunk', blob, file.name);
+      $.ajax({
+        url: '/upload_chunk/' + uploadId + '?offset=' + offset + '&length=' + blob.size + '&checksum=' + digest,
+        type: 'POST',
+        data: formData,
+        cache: false,
+        contentType: false,
+        processData: false,
+        dataType: 'json',
+        headers: {'X-CSRFToken': csrfToken},
+        success: function(data) {
+          retries = 0;
+          showPreview(data);
+          sendChunk(uploadId, data['received']);
+        },
+        error: function(xhr) {
+          if(xhr.status === 409) {
+            //The server already has a different part of the file, carry on from there
+            sendChunk(uploadId, xhr.responseJSON['received']);
+          } else if(xhr.status === 404) {
+            //The server forgot this upload, start over
+            localStorage.removeItem(storageKey);
+            start();
+          } else {
+            retry(uploadId);
+          }
+        }
+      });
+    });
+  }
+
+  function complete(uploadId) {
+    $.ajax({
+      url: '/complete_upload/' + uploadId,
+      type: 'POST',
+      dataType: 'json',
+      headers: {'X-CSRFToken': csrfToken},
+      success: function(data) {
+        localStorage.removeItem(storageKey);
+        showPreview(data);
+        onComplete(data);
+      },
+      error: function(xhr) {
+        retry(uploadId);
+      }
+    });
+  }
+
+  function start() {
+    $.ajax({
+      url: '/start_upload',
+      type: 'POST',
+      data: {'filename': file.name, 'size': file.size},
+      dataType: 'json',
+      headers: {'X-CSRFToken': csrfToken},
+      success: function(data) {
+        localStorage.setItem(storageKey, data['uploadId']);
+        sendChunk(data['uploadId'], data['received']);
+      }
+    });
+  }
+
+  //Resume an earlier upload of the same file if there is one
+  var uploadId = localStorage.getItem(storageKey);
+  if(uploadId !== null) {
+    $.getJSON('/upload_status/' + uploadId, function(data) {
+      sendChunk(uploadId, data['received']);
+    }).fail(function() {
+      localStorage.removeItem(storageKey);
+      start();
+    });
+  } else {
+    start();
+  }
+}
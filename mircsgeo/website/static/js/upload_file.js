@@ -1,85 +1,157 @@
 $( document ).ready(function() {
   $('#fileUploadForm #id_file_upload').change( function() {
-    $('.dimmer').dimmer('show', function(){
-      //Get form data
-      var formData = new FormData($('#fileUploadForm')[0]);
-      console.log(formData);
-      $.ajax({
-        url: '/store_file',
-        type: 'POST',
-        data: formData,
-        async: false,
-        cache: false,
-        contentType: false,
-        processData: false,
-        dataType: 'json',
-        success: function(data) {
-          var dataTable = $('#uploadedDataTable');
-          populateDataTable(
-            dataTable,
-            data['columns'],
-            data['rows'],
-            data['datatypes'],
-            data['possibleDatatypes']
-          );
-          $('#primaryKeyPicker').show();
-          // Add an event handler to get the entered datatypes from the table and
-          // append them to the form before submission
-          $('#primaryKeyPicker').find( "#fileUploadForm" ).submit(function( event ) {
-            var datatypes = dataTable.find('.ui.dropdown').dropdown('get value');
-            var input = $('<input>').attr({'type':'hidden','name':'datatypes'}).val(datatypes);
-            $(this).append(input);
+    var uploadForm = $('#fileUploadForm');
+    //The form can't be submitted until the whole file has arrived
+    var submitButton = $('#primaryKeyPicker').find('input[type=submit]');
+    submitButton.addClass('disabled').prop('disabled', true);
+    $('#uploadProgress').show();
+    $('.dimmer').dimmer('show');
+    //Send the file in chunks, the preview shows up as soon as the first ones arrive
+    chunkedUpload(
+      this.files[0],
+      Number(uploadForm.attr('data-chunk-size')),
+      uploadForm.find('input[name=csrfmiddlewaretoken]').val(),
+      function(data) {
+        $('.dimmer').dimmer('hide');
+        showPreview(data);
+      },
+      function(received, size) {
+        $('#uploadProgress').progress({percent: Math.floor(100 * received / Math.max(size, 1))});
+      },
+      function() {
+        submitButton.removeClass('disabled').prop('disabled', false);
+      }
+    );
+    return false;
+  });
+
+  //Show the first rows of the file
+  function showPreview(data) {
+    var dataTable = $('#uploadedDataTable');
+    populateDataTable(
+      dataTable,
+      data['columns'],
+      data['rows'],
+      data['datatypes'],
+      data['possibleDatatypes']
+    );
+    $('#primaryKeyPicker').show();
+    updatePartitioningOptions(data);
+    // Add an event handler to get the entered datatypes from the table and
+    // append them to the form before submission
+    $('#primaryKeyPicker').find( "#fileUploadForm" ).submit(function( event ) {
+      var datatypes = dataTable.find('.ui.dropdown').dropdown('get value');
+      var input = $('<input>').attr({'type':'hidden','name':'datatypes'}).val(datatypes);
+      $(this).append(input);
+
+      var geospatial_columns = $("#geospatialColumnsContainer").find('.geospatialColumnForm');
+      geospatial_col_return = [];
+      for(var i=0; i<geospatial_columns.length; i++) {
+        geospatial_col_return.push($(geospatial_columns[i]).serialize());
+      }
+      var input = $('<input>').attr({'type':'hidden','name':'geospatial_columns'}).val(geospatial_col_return);
+      $(this).append(input);
+    });
+
+    $('#Geocolumns').click(function( event ) {
+      if(!$('#GeospatialCol_name').length){
+        //generate the form
+        var form = $("<form class='ui form geospatialColumnForm'></form>")
+        form.append($("<label for='GeospatialCol_name'> GeoSpatial Column Name: <label/>"));
+        //Create column name and default to geom
+        var GeospatialCol_name = $("<div class=\"field\"><input type='text' id='GeospatialCol_name' name='name' value='geom'></div>");
+        form.append(GeospatialCol_name);
 
-            var geospatial_columns = $("#geospatialColumnsContainer").find('.geospatialColumnForm');
-            geospatial_col_return = [];
-            for(var i=0; i<geospatial_columns.length; i++) {
-              geospatial_col_return.push($(geospatial_columns[i]).serialize());
-            }
-            var input = $('<input>').attr({'type':'hidden','name':'geospatial_columns'}).val(geospatial_col_return);
-            $(this).append(input);
-          });
+        //Create the geocolumn type picker, latlon builds points from two columns
+        //while the others parse geometries out of a single text column
+        var GeoCol_type = $("<select id='GeoCol_type' name='type'></select>");
+        GeoCol_type.append($("<option></option>").attr("value","latlon").text("Latitude / Longitude"));
+        GeoCol_type.append($("<option></option>").attr("value","wkt").text("WKT"));
+        GeoCol_type.append($("<option></option>").attr("value","wkb").text("WKB (hex)"));
+        GeoCol_type.append($("<option></option>").attr("value","geojson").text("GeoJSON"));
+        GeoCol_type.append($("<option></option>").attr("value","place").text("Place Name (gazetteer)"));
+        form.append($("<label for='GeoCol_type'> Geometry Source</label>"));
+        form.append($('<div class=\"field\"></div>').append(GeoCol_type));
 
-          $('#Geocolumns').click(function( event ) {
-            if(!$('#GeospatialCol_name').length){
-              //generate the form
-              var form = $("<form class='ui form geospatialColumnForm'></form>")
-              form.append($("<label for='GeospatialCol_name'> GeoSpatial Column Name: <label/>"));
-              //Create column name and default to geom
-              var GeospatialCol_name = $("<div class=\"field\"><input type='text' id='GeospatialCol_name' name='name' value='geom'></div>");
-              form.append(GeospatialCol_name);
+        //Create lat/Lon select columns
+        var lat_col = $( "<select id='lat_col' name='lat_col'></select>");
+        var lon_col = $("<select id='lon_col' name='lon_col'></select>");
+        var source_col = $("<select id='source_col' name='source_col' disabled></select>");
+        var place_col = $("<select id='place_col' name='place_col' disabled></select>");
+        //Iterate through columns and append to lat/lon selector
+        $.each(data['columns'],function(key,value){
+          lat_col.append($("<option></option>").attr("value",value).text(value));
+          lon_col.append($("<option></option>").attr("value",value).text(value));
+          source_col.append($("<option></option>").attr("value",value).text(value));
+          place_col.append($("<option></option>").attr("value",value).text(value));
+        });
+        var latlonFields = $('<div class="latlonFields"></div>');
+        //Append label to Lat selector as Select Latitude
+        latlonFields.append($("<label for='lat_col'> Select Latitude</label>"));
+        latlonFields.append($('<div class=\"field\"></div>').append(lat_col));
+        //Append label to Lon selector as Select Longitude
+        latlonFields.append($("<label for='lon_col'> Select Longitude</label>"));
+        latlonFields.append($('<div class=\"field\"></div>').append(lon_col));
+        form.append(latlonFields);
 
-              //Create lat/Lon select columns
-              var lat_col = $( "<select id='lat_col' name='lat_col'></select>");
-              var lon_col = $("<select id='lon_col' name='lon_col'></select>");
-              //Iterate through columns and append to lat/lon selector
-              $.each(data['columns'],function(key,value){
-                lat_col.append($("<option></option>").attr("value",value).text(value));
-                lon_col.append($("<option></option>").attr("value",value).text(value));
-              });
-              //Append label to Lat selector as Select Latitude
-              form.append($("<label for='lat_col'> Select Latitude</label>"));
-              form.append($('<div class=\"field\"></div>').append(lat_col));
-              //Append label to Lon selector as Select Longitude
-              form.append($("<label for='lon_col'> Select Longitude</label>"));
-              form.append($('<div class=\"field\"></div>').append(lon_col));
-              //Append label for srid as SRID
-              form.append($("<label for='srid'> SRID: </label>"));
-              //Default srid to 4326
-              var srid = $("<div class=\"field\"><input type='text' id='srid' name='srid' value='4326'></input></div>");
-              form.append(srid);
-              //Create geocolumn type and set as latlon
-              var GeoCol_type = $( "<input></input>",{'type':'hidden', 'id': 'GeoCol_type', 'name': 'type', 'value': 'latlon'});
-              form.append(GeoCol_type);
+        //Source column and geometry type of WKT, WKB and GeoJSON columns
+        var sourceFields = $('<div class="sourceFields"></div>').hide();
+        sourceFields.append($("<label for='source_col'> Select Geometry Column</label>"));
+        sourceFields.append($('<div class=\"field\"></div>').append(source_col));
+        var geometry_type = $("<select id='geometry_type' name='geometry_type' disabled></select>");
+        $.each(['GEOMETRY', 'POINT', 'LINESTRING', 'POLYGON', 'MULTIPOINT', 'MULTILINESTRING', 'MULTIPOLYGON'], function(key, value) {
+          geometry_type.append($("<option></option>").attr("value",value).text(value));
+        });
+        sourceFields.append($("<label for='geometry_type'> Geometry Type</label>"));
+        sourceFields.append($('<div class=\"field\"></div>').append(geometry_type));
+        form.append(sourceFields);
 
-              $(form).appendTo("#geospatialColumnsContainer").hide().fadeIn('slow');
-              $('select').dropdown();
-            }
+        //Place names are located with the gazetteer when the table is created
+        var placeFields = $('<div class="placeFields"></div>').hide();
+        placeFields.append($("<label for='place_col'> Select Place Name Column</label>"));
+        placeFields.append($('<div class=\"field\"></div>').append(place_col));
+        form.append(placeFields);
+
+        //Only the fields of the picked type are serialized with the form
+        GeoCol_type.change(function() {
+          var latlon = $(this).val() === 'latlon';
+          var place = $(this).val() === 'place';
+          latlonFields.toggle(latlon).find('select').prop('disabled', !latlon);
+          placeFields.toggle(place).find('select').prop('disabled', !place);
+          sourceFields.toggle(!latlon && !place).find('select').prop('disabled', latlon || place);
+          updatePartitioningOptions(data);
+        });
+        //Append label for srid as SRID
+        form.append($("<label for='srid'> SRID: </label>"));
+        //Default srid to 4326
+        var srid = $("<div class=\"field\"><input type='text' id='srid' name='srid' value='4326'></input></div>");
+        form.append(srid);
+
+        $(form).appendTo("#geospatialColumnsContainer").hide().fadeIn('slow');
+        $('select').dropdown();
+        updatePartitioningOptions(data);
+      }
 
-          });
-        }
-      });
-      $('.dimmer').dimmer('hide');
     });
-    return false;
-  });
+  }
+
+  //Offer partitioning by id, by each detected date column and by location
+  //once a geospatial column has been added
+  function updatePartitioningOptions(data) {
+    var select = $('#partitioning');
+    select.find('option').not('[value=""]').remove();
+    select.append($('<option></option>').attr('value', 'strategy=id').text('Partitioned by id'));
+    $.each(data['columns'], function(i, column) {
+      if(data['datatypes'][i] === 'datetime') {
+        select.append($('<option></option>').attr('value', 'strategy=date&column=' + column)
+                                            .text('Partitioned by ' + column));
+      }
+    });
+    //Cells are computed from latitudes and longitudes, geocoded ones included
+    if($('#GeospatialCol_name').length && $.inArray($('#GeoCol_type').val(), ['latlon', 'place']) !== -1) {
+      select.append($('<option></option>').attr('value', 'strategy=cell&column=' + $('#GeospatialCol_name').val())
+                                          .text('Partitioned by location'));
+    }
+    select.dropdown('refresh');
+  }
 });
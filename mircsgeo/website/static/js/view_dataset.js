@@ -2,15 +2,28 @@
 
 $( document ).ready(function() {
   var group = null;
+  var nearbyGroup = null;
+  //Decimal places of the coordinates requested from the server, about 10cm
+  var coordinatePrecision = 6;
   var map = L.map('dataMap');
-  //Initiate map and dataset for display to page
-  $.getJSON('/get_dataset_page/' + getTableFromURL() + '/0/', function(data) {
+  //Show the records nearest to a feature when its popup link is clicked
+  map.on('popupopen', function(event) {
+    $(event.popup._container).find('a.nearbyRecords').click(function() {
+      var url = '/get_nearest_features/' + getTableFromURL() + '/?row_id=' + $(this).attr('data-id') +
+                '&precision=' + coordinatePrecision;
+      $.getJSON(url, function(data) {
+        if(nearbyGroup !== null) {
+          nearbyGroup.clearLayers();
+        }
+        nearbyGroup = populateMap(map, data, '#3992FF');
+      });
+    });
+  });
+  //Initiate map and dataset for display to page, and populate the map
+  $.getJSON('/get_dataset_page_features/' + getTableFromURL() + '/0/?precision=' + coordinatePrecision, function(data) {
     insertDatasetPage(data, 0);
     initMap(map, data);
-  });
-  //Populate map with json data
-  $.getJSON('/get_dataset_geojson/' + getTableFromURL() + '/0/', function(data) {
-    group = populateMap(map, data);
+    group = populateMap(map, data['features']);
   });
 
   //Create and poplulate dataset for display on page
@@ -44,15 +57,12 @@ $( document ).ready(function() {
           }
         }
       }
-      //Get map points from get request in url
-      $.getJSON('/get_dataset_geojson/' + getTableFromURL() + '/' + target_page + '/', function(data) {
+      //Get table data and map points from get request in url
+      $.getJSON('/get_dataset_page_features/' + getTableFromURL() + '/' + target_page + '/?precision=' + coordinatePrecision, function(data) {
         if(group !== null) {
           group.clearLayers();
         }
-        group = populateMap(map, data);
-      });
-      //Get table data from get request in url
-      $.getJSON('/get_dataset_page/' + getTableFromURL() + '/' + target_page + '/', function(data) {
+        group = populateMap(map, data['features']);
         insertDatasetPage(data, target_page);
       });
     });
@@ -133,11 +143,11 @@ $( document ).ready(function() {
     return map;
   }
   //Add data to map
-  function populateMap(map, data) {
+  function populateMap(map, data, fillColor) {
     //Set up marker display settings
     var geojsonMarkerOptions = {
       radius: 8,
-      fillColor: "#FF9639",
+      fillColor: fillColor || "#FF9639",
       color: "#000",
       weight: 1,
       opacity: 1,
@@ -163,6 +173,8 @@ $( document ).ready(function() {
       $.each(feature.keys, function(key, val){
         popupText += "<strong>"+val  + "</strong>: " + feature.properties[val] +"<br/>";
       });
+      //Link to the records nearest to this one
+      popupText += "<a class='nearbyRecords' data-id='" + feature.properties.id + "'>Show nearby records</a>";
       layer.bindPopup(popupText, pOptions);
 
     }
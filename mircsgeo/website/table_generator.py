@@ -1,21 +1,33 @@
+import hashlib
+
 import numpy as np
 import pandas as pd
 
+from django.conf import settings
 from sqlalchemy import create_engine, MetaData, Table, Column, Integer, \
                        String, Float, DateTime, ForeignKeyConstraint, ForeignKey,\
-                       Enum, UniqueConstraint, Boolean
+                       Enum, UniqueConstraint, Boolean, Index, text
 from geoalchemy2 import Geometry
 
+import website.frames as frames
+import website.history as history
 import website.models as m
+import website.partitioning as partitions
+import website.search as search
 
 # Pandas to human readable mapping
 type_mappings = {
     'int': 'integer',
     'float': 'float',
     'datetime': 'datetime',
-    'object': 'string'
+    'object': 'string',
+    'category': 'string'
 }
 
+# Source formats of the geospatial columns. latlon columns are built from a
+# latitude and a longitude column, the others are parsed from a single text column
+geospatial_column_types = ('latlon', 'wkt', 'wkb', 'geojson')
+
 # Human readable to alchemy mapping
 alchemy_types = {
     'integer': Integer,
@@ -25,7 +37,7 @@ alchemy_types = {
 }
 
 
-def to_sql(df, datatypes, table_name, schema, geospatial_columns=None):
+def to_sql(df, datatypes, table_name, schema, geospatial_columns=None, partitioning=None):
     """
     Create a database table based on a DataFrame and load it with data
 
@@ -37,17 +49,20 @@ def to_sql(df, datatypes, table_name, schema, geospatial_columns=None):
     schema (str) - The schema the table will be created into
     geospatial_columns(list) - A list of geospatial columns of the type returned
                                by get_geospatial_columns()
+    partitioning (dict) - optional. How to partition the table, as returned by
+                          partitioning.parse_partitioning_string()
 
     Returns:
     table - The SQLAlchemy table object that was generated
+    missing_geometries (int) - The number of rows loaded without a geometry, see insert_df()
     """
-    create_table(df, datatypes, table_name, schema, geospatial_columns)
+    create_table(df, datatypes, table_name, schema, geospatial_columns, partitioning)
     table = getattr(m.Base.classes, table_name)
-    insert_df(df, table, geospatial_columns)
-    return table
+    missing_geometries = insert_df(df, table, geospatial_columns)
+    return table, missing_geometries
 
 
-def create_table(df, datatypes, table_name, schema, geospatial_columns=None):
+def create_table(df, datatypes, table_name, schema, geospatial_columns=None, partitioning=None):
     """
     Create a database table based on a DataFrame
 
@@ -58,53 +73,344 @@ def create_table(df, datatypes, table_name, schema, geospatial_columns=None):
     schema (str) - The schema the table will be created into
     geospatial_columns (list) - A list of geospatial columns of the type returned
                                 from get_geospatial_columns()
+    partitioning (dict) - optional. How to partition the table, as returned by
+                          partitioning.parse_partitioning_string(). Defaults to
+                          a single table
 
     Returns:
     table - The generated SQLAlchemy table object
     """
+    # Remember which columns hold text so they can be indexed for searching
+    string_columns = [c for i, c in enumerate(df.columns) if datatypes[i] == 'string']
     datatypes = get_alchemy_types(datatypes)
-    columns = [Column('id', Integer, primary_key=True)]
+    columns = [Column('id', Integer, primary_key=True, autoincrement=True)]
+    table_kwargs = {}
+    if partitioning is not None:
+        # The partition key has to be part of the primary key
+        if partitioning['strategy'] != 'id':
+            columns.append(Column(partitions.partition_key_column, Integer, primary_key=True, autoincrement=False))
+        table_kwargs['postgresql_partition_by'] = partitions.get_partition_by(partitioning)
     for i, c in enumerate(df.columns):
         columns.append(
             Column(c, datatypes[i])
         )
     if geospatial_columns is not None:
         for c in geospatial_columns:
-            if c['type'] == 'latlon':
-                columns.append(
-                    Column(c['name'], Geometry('POINT', srid=c['srid']))
-                )
-    table = Table(table_name, m.m, *columns, schema=schema)
+            # latlon columns hold points. WKT, WKB and GeoJSON columns can hold any
+            # type of geometry unless the definition names one, eg. MULTIPOLYGON
+            columns.append(
+                Column(c['name'], Geometry(get_geometry_type(c), srid=c['srid']))
+            )
+            # A copy of the geometry in the display SRID, so maps never reproject
+            if get_display_column_name(c) is not None:
+                columns.append(Column(
+                    get_display_column_name(c),
+                    Geometry(get_geometry_type(c), srid=int(c['display_srid']))
+                ))
+    # Index the datetime columns so they can be queried by time range
+    for i, c in enumerate(df.columns):
+        if datatypes[i] is DateTime:
+            columns.append(Index(
+                get_datetime_index_name(table_name, c),
+                c,
+                postgresql_using=settings.DATETIME_INDEX_METHOD
+            ))
+    table = Table(table_name, m.m, *columns, schema=schema, **table_kwargs)
     m.m.create_all(m.engine)
+    if partitioning is not None:
+        partitions.create_default_partition(table_name, schema)
+    search.create_search_index(table_name, schema, string_columns)
+    # Keep the versions of the rows replaced or removed later on
+    history.enable_history(table_name, schema)
     m.refresh()
     return table
 
 
-def insert_df(df, table, geospatial_columns=None):
+def insert_df(df, table, geospatial_columns=None, transaction_type=None):
     """
-    Load a DataFrame into an autogenerated database table
+    Load a DataFrame into an autogenerated database table. The rows are copied
+    into a staging table with COPY and moved over with a single INSERT ... SELECT,
+    so values are cast and geometries are built by postgres in one pass instead
+    of row by row in python.
 
     Arguments:
     table - The SQLAlchemy table object into which data will be loaded
     geospatial_columns (list) - A list of geospatial columns found in the dataset.
                                 Should be of the form returned by get_geospatial_columns()
+    transaction_type (str) - optional. Log the rows as a dataset transaction of this
+                             type, in the same database transaction as the insert
+
+    Returns:
+    missing_geometries (int) - The number of rows loaded without a geometry, because
+                               their source value was empty or couldn't be parsed
+    """
+    t = table.__table__
+    # A shallow copy is enough to add columns, the values aren't duplicated
+    df = df.copy(deep=False)
+    partitioning = partitions.get_partitioning(t.name)
+    if partitioning is not None:
+        # Make sure every row has a partition to go to
+        keys = None
+        if partitioning['strategy'] != 'id':
+            keys = partitions.add_partition_keys(df, partitioning, geospatial_columns)
+            df[partitions.partition_key_column] = keys
+        partitions.ensure_partitions(t.name, t.schema, partitioning, len(df), keys)
+    create_geometry_parser()
+
+    # Every staging column is text, postgres casts them to the column types.
+    # Each geometry is built once, in a subquery, and reprojected from there
+    staging = 'staging_%s' % t.name
+    columns = [search.quote_identifier(c) for c in df.columns]
+    values = [get_cast_sql(t, c) for c in df.columns]
+    geometries = []
+    for i, c in enumerate(geospatial_columns or []):
+        geometry = 'staged_geometry_%d' % i
+        geometries.append('%s AS %s' % (get_geometry_sql(c), geometry))
+        columns.append(search.quote_identifier(c['name']))
+        values.append(geometry)
+        if get_display_column_name(c) is not None:
+            columns.append(search.quote_identifier(get_display_column_name(c)))
+            values.append('ST_Transform(%s, %d)' % (geometry, int(c['display_srid'])))
+
+    with m.engine.begin() as connection:
+        stage_df(connection, df, staging)
+        geometry_checks = ['%s IS NULL' % search.quote_identifier(c['name']) for c in geospatial_columns or []]
+        params = {}
+        log = ''
+        if transaction_type is not None:
+            # The ids of the inserted rows are logged by the same statement
+            log = (
+                ', logged AS (INSERT INTO %s.dataset_transactions '
+                '(id, dataset_uuid, transaction_type, rows_affected, affected_row_ids) '
+                'SELECT :transaction_id, :dataset_uuid, :transaction_type, count(*), array_agg(id ORDER BY id) '
+                'FROM inserted HAVING count(*) > 0)'
+            ) % search.quote_identifier(settings.DATABASES['default']['SCHEMA'])
+            params = {
+                'transaction_id': history.start_transaction(connection),
+                'dataset_uuid': t.name,
+                'transaction_type': transaction_type,
+            }
+        missing_geometries = connection.execute(text(
+            'WITH inserted AS ('
+            'INSERT INTO %s.%s (%s) SELECT %s FROM (SELECT %s FROM %s) staged ORDER BY staging_order RETURNING %s'
+            ')%s SELECT count(*) FROM inserted WHERE %s' % (
+                search.quote_identifier(t.schema), search.quote_identifier(t.name),
+                ', '.join(columns), ', '.join(values),
+                ', '.join(['*'] + geometries), search.quote_identifier(staging),
+                ', '.join(['id'] + [search.quote_identifier(c['name']) for c in geospatial_columns or []]),
+                log, ' OR '.join(geometry_checks) or 'false'
+            )
+        ), **params).scalar()
+    return missing_geometries
+
+
+def stage_df(connection, df, staging):
+    """
+    Copy a DataFrame into a temporary table of text columns with COPY. The rows
+    are converted to CSV a chunk at a time while they are copied, so categorical
+    columns are only expanded to text chunk by chunk. The table also gets a
+    staging_order column numbering the rows in DataFrame order, and is dropped at
+    the end of the transaction.
+
+    Parameters:
+    connection - An SQLAlchemy connection with an open transaction
+    df (pandas.DataFrame) - The rows to stage
+    staging (str) - The name of the temporary table
+    """
+    connection.execute(text('CREATE TEMP TABLE %s (staging_order serial, %s) ON COMMIT DROP' % (
+        search.quote_identifier(staging),
+        ', '.join('%s text' % search.quote_identifier(c) for c in df.columns)
+    )))
+    cursor = connection.connection.cursor()
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+        search.quote_identifier(staging),
+        ', '.join(search.quote_identifier(c) for c in df.columns)
+    ), frames.CsvReader(df), size=settings.COPY_BUFFER_SIZE)
+
+
+def get_cast_sql(table, column, alias=None):
+    """
+    Build the SQL expression casting a text column of a staging table to the type
+    of the matching column of an autogenerated table
+
+    Parameters:
+    table - The SQLAlchemy Table object of the autogenerated table
+    column (str) - The name of the column
+    alias (str) - optional. The name the staging table is referred to by
+
+    Returns:
+    sql (str) - The SQL expression
+    """
+    source = search.quote_identifier(column)
+    if alias is not None:
+        source = '%s.%s' % (alias, source)
+    column_type = table.columns[column].type.compile(dialect=m.engine.dialect)
+    if isinstance(table.columns[column].type, Integer):
+        # Integer columns with missing values come out of pandas as floats
+        return 'CAST(CAST(%s AS numeric) AS %s)' % (source, column_type)
+    return 'CAST(%s AS %s)' % (source, column_type)
+
+
+def get_geometry_type(geospatial_column):
+    """
+    Get the geometry type of a geospatial column, eg. POINT for latlon columns
+    """
+    if geospatial_column['type'] == 'latlon':
+        return 'POINT'
+    return geospatial_column.get('geometry_type', 'GEOMETRY').upper()
+
+
+def add_display_srid(geospatial_column):
+    """
+    Give a new geospatial column a copy in settings.DISPLAY_SRID, unless it is
+    already in that SRID. The display SRID is added to the column definition, so
+    the copy is found again by get_display_column_name().
+
+    Parameters:
+    geospatial_column (dict) - The column, as returned by parse_geospatial_column_string()
+
+    Returns:
+    geospatial_column (dict) - The same column
+    """
+    if settings.DISPLAY_SRID and int(geospatial_column['srid']) != settings.DISPLAY_SRID:
+        geospatial_column['display_srid'] = str(settings.DISPLAY_SRID)
+        geospatial_column['column_definition'] += '&display_srid=%d' % settings.DISPLAY_SRID
+    return geospatial_column
+
+
+def get_display_column_name(geospatial_column):
+    """
+    Get the name of the column holding a geospatial column reprojected to its
+    display SRID
+
+    Returns:
+    name (str) - eg. geom_display, or None if the column has no display copy
+    """
+    if 'display_srid' not in geospatial_column:
+        return None
+    return '%s_display' % geospatial_column['name']
+
+
+def get_geometry_column_names(geospatial_columns):
+    """
+    Get the names of every geometry column of a table, display copies included
+    """
+    names = []
+    for c in geospatial_columns:
+        names.append(c['name'])
+        if get_display_column_name(c) is not None:
+            names.append(get_display_column_name(c))
+    return names
+
+
+def get_geometry_sql(geospatial_column):
+    """
+    Build the SQL expression creating the geometry of a geospatial column from
+    the text columns of a staging table
+
+    Parameters:
+    geospatial_column (dict) - The column, as returned by parse_geospatial_column_string().
+                               Geometries that don't match its geometry_type are left out
 
     Returns:
-    Nothing
-    """
-    insert_dict = df.to_dict('records')
-    for row in insert_dict:
-        for c in row:
-            if pd.isnull(row[c]):
-                row[c] = None
-        if geospatial_columns is not None:
-            for c in geospatial_columns:
-                row[c['name']] = 'SRID=%s;POINT(%s %s)' % (c['srid'], row[c['lon_col']], row[c['lat_col']])
-    m.engine.execute(
-        table.__table__.insert(),
-        insert_dict
+    sql (str) - The SQL expression
+    """
+    srid = int(geospatial_column['srid'])
+    if geospatial_column['type'] == 'latlon':
+        return 'ST_SetSRID(ST_MakePoint(CAST(%s AS double precision), CAST(%s AS double precision)), %d)' % (
+            search.quote_identifier(geospatial_column['lon_col']),
+            search.quote_identifier(geospatial_column['lat_col']),
+            srid
+        )
+    geometry = '%s.parse_geometry(%s, %s, %d)' % (
+        search.quote_identifier(settings.DATABASES['default']['SCHEMA']),
+        search.quote_identifier(geospatial_column['source_col']),
+        "'%s'" % geospatial_column['type'],
+        srid
+    )
+    geometry_type = get_geometry_type(geospatial_column)
+    if geometry_type == 'GEOMETRY':
+        return geometry
+    # Geometries that don't fit the column type are treated like unparseable ones
+    return "(SELECT g FROM (SELECT %s AS g) parsed WHERE GeometryType(g) = '%s')" % (
+        geometry, geometry_type
     )
-    return
+
+
+def create_geometry_parser():
+    """
+    Create the parse_geometry SQL function used to load WKT, hex encoded WKB
+    and GeoJSON geospatial columns. It returns NULL for values that can't be
+    parsed instead of failing the whole load. It is looked up every time rather
+    than remembered, since the database may have been recreated since.
+    """
+    schema = search.quote_identifier(settings.DATABASES['default']['SCHEMA'])
+    if m.engine.execute(text('SELECT to_regprocedure(:name) IS NOT NULL'),
+                        name='%s.parse_geometry(text, text, integer)' % schema).scalar():
+        return
+    m.engine.execute(text('''
+        CREATE OR REPLACE FUNCTION %s.parse_geometry(source text, source_type text, srid integer)
+        RETURNS geometry AS $$
+        BEGIN
+            IF source IS NULL OR source = '' THEN
+                RETURN NULL;
+            ELSIF source_type = 'wkt' THEN
+                RETURN ST_SetSRID(ST_GeomFromText(source), srid);
+            ELSIF source_type = 'wkb' THEN
+                RETURN ST_SetSRID(ST_GeomFromWKB(decode(source, 'hex')), srid);
+            ELSE
+                RETURN ST_SetSRID(ST_GeomFromGeoJSON(source), srid);
+            END IF;
+        EXCEPTION WHEN OTHERS THEN
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql IMMUTABLE
+    ''' % schema).execution_options(autocommit=True))
+
+
+def get_index_name(table_name, columns, suffix):
+    """
+    Build the name of an index on an autogenerated table. Names over the 63 bytes
+    postgres keeps get the columns shortened and a hash of them, so long columns
+    sharing a prefix don't end up with the same index name.
+
+    Parameters:
+    table_name (str) - The name of the table
+    columns (str) - The columns of the index, joined with underscores
+    suffix (str) - eg. time_idx
+
+    Returns:
+    index_name (str) - eg. <uuid>_SURNAME_GIVEN_NAME_idx
+    """
+    name = '%s_%s_%s' % (table_name, columns, suffix)
+    if len(name.encode('utf-8')) <= 63:
+        return name
+    digest = hashlib.md5(columns.encode('utf-8')).hexdigest()[:8]
+    prefix = '%s_' % table_name
+    suffix = '_%s_%s' % (digest, suffix)
+    # The limit is in bytes
+    columns = columns.encode('utf-8')[:63 - len(prefix) - len(suffix)].decode('utf-8', 'ignore')
+    return prefix + columns + suffix
+
+
+def get_datetime_index_name(table_name, column):
+    """
+    Get the name of the index created on a datetime column of an autogenerated table
+    """
+    return get_index_name(table_name, column, 'time_idx')
+
+
+def get_datetime_columns(table):
+    """
+    Get the names of the datetime columns of an autogenerated table
+
+    Parameters:
+    table - The automapped SQLAlchemy class of the table
+
+    Returns:
+    columns (list) - A list of column names, in table order
+    """
+    return [c.name for c in table.__table__.columns if isinstance(c.type, DateTime)]
 
 
 def get_geospatial_columns(table_uuid):
@@ -141,6 +447,13 @@ def parse_geospatial_column_string(geospatial_column_string):
                                      or pulled from the column_definition column of the
                                      geospatial_columns table.
         example: name=geom&lat_col=LATITUDE&lon_col=LONGITUDE&srid=4326&type=latlon
+        WKT, hex encoded WKB and GeoJSON columns name their source column instead, and
+        optionally the geometry type they hold:
+        example: name=parcel&source_col=PARCEL_WKT&srid=4326&type=wkt&geometry_type=MULTIPOLYGON
+        Columns located by place name name the column to geocode instead:
+        example: name=geom&place_col=PARISH&srid=4326&type=place
+        Columns stored with a copy in the display SRID also name it:
+        example: name=geom&lat_col=NORTHING&lon_col=EASTING&srid=27700&type=latlon&display_srid=4326
 
     Returns:
     geospatial_column (dict) - A dictionary containing all the information foud in the defintion string
@@ -155,6 +468,16 @@ def parse_geospatial_column_string(geospatial_column_string):
             # "exampleone=7&exampletwo=8" -> {"exampleone":7, "exampletwo":8}
             geospatial_column[field[0]] = field[1]
 
+        if geospatial_column.get('type') == 'place':
+            # Place names are geocoded into latitude and longitude columns by
+            # geocoding.geocode_df(), the geometry is then built like a latlon one
+            geospatial_column['type'] = 'latlon'
+            geospatial_column.setdefault('lat_col', '%s_latitude' % geospatial_column['name'])
+            geospatial_column.setdefault('lon_col', '%s_longitude' % geospatial_column['name'])
+
+        if geospatial_column.get('type') not in geospatial_column_types:
+            raise Exception("invalid geospatial column type: %s" % geospatial_column.get('type'))
+
         # Append the dictionary to geospatial_columns (for the to_sql function)
     return geospatial_column
 
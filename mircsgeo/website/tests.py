@@ -1,3 +1,644 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopUpload
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+
+import website.benchmark as benchmark
+import website.bulk_edits as bulk_edits
+import website.formats as formats
+import website.geocoding as geocoding
+import website.history as history
+import website.index_builds as index_builds
+import website.linkage as linkage
+import website.metrics as metrics
+import website.middleware as middleware
+import website.models as m
+import website.partitioning as partitioning
+import website.query_pool as query_pool
+import website.search as search
+import website.slow_queries as slow_queries
+import website.uploads as uploads
+import website.views as views
+
+
+class NormalizeStatementTests(SimpleTestCase):
+
+    def test_quoted_dataset_table(self):
+        statement = 'SELECT count(*) FROM mircs."0123456789abcdef0123456789abcdef" WHERE id > 5'
+        self.assertEqual(metrics.normalize_statement(statement),
+                         'SELECT count(*) FROM mircs."<dataset>" WHERE id > ?')
+
+    def test_unquoted_dataset_table(self):
+        statement = 'SELECT count(*) FROM mircs.abcdef0123456789abcdef0123456789 WHERE id > 5'
+        self.assertEqual(metrics.normalize_statement(statement),
+                         'SELECT count(*) FROM mircs."<dataset>" WHERE id > ?')
+
+    def test_datasets_share_a_label(self):
+        self.assertEqual(
+            metrics.normalize_statement('SELECT * FROM mircs."0123456789abcdef0123456789abcdef_history"'),
+            metrics.normalize_statement('SELECT * FROM mircs.fedcba9876543210fedcba9876543210_history')
+        )
+
+
+class MetricsTests(SimpleTestCase):
+
+    def tearDown(self):
+        metrics.end_request()
+
+    @override_settings(METRICS_BUCKETS=[0.1, 1])
+    def test_histogram(self):
+        metrics.observe('test_histogram_seconds', {'view': 'page'}, 0.5)
+        metrics.observe('test_histogram_seconds', {'view': 'page'}, 2)
+        lines = metrics.render().splitlines()
+        self.assertIn('test_histogram_seconds_bucket{view="page",le="0.1"} 0', lines)
+        self.assertIn('test_histogram_seconds_bucket{view="page",le="1"} 1', lines)
+        self.assertIn('test_histogram_seconds_bucket{view="page",le="+Inf"} 2', lines)
+        self.assertIn('test_histogram_seconds_count{view="page"} 2', lines)
+
+    def test_label_escaping(self):
+        self.assertEqual(metrics.format_labels((('statement', 'a "b" \\c'),)),
+                         'statement="a \\"b\\" \\\\c"')
+
+    def test_view_comment(self):
+        metrics.start_request('get_dataset_page')
+        statement, parameters = metrics.add_view_comment(None, None, 'SELECT 1', {}, None, False)
+        self.assertEqual(metrics.get_statement_view(statement), 'get_dataset_page')
+        self.assertEqual(metrics.normalize_statement(statement), 'SELECT ?')
+        self.assertIsNone(metrics.get_statement_view('SELECT 1'))
+
+    def test_merge_request_state(self):
+        metrics.start_request('get_dataset_page')
+        metrics.merge_request_state((2, 0.5, [('read_sql', 0.25)]))
+        self.assertEqual(metrics.get_request_state(),
+                         ('get_dataset_page', [('sql', 0.5), ('read_sql', 0.25)]))
+        self.assertEqual(metrics.export_request_state(), (2, 0.5, [('read_sql', 0.25)]))
+        metrics.end_request()
+        self.assertIsNone(metrics.export_request_state())
+
+
+class QueryPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        metrics.start_request('get_dataset_page')
+
+    def tearDown(self):
+        metrics.end_request()
+
+    def test_results_in_order(self):
+        self.assertEqual(query_pool.run_concurrently(lambda: 1, lambda: 2, lambda: 3), [1, 2, 3])
+
+    def test_worker_spans_are_merged(self):
+        def read():
+            with metrics.span('read_sql'):
+                return threading.current_thread().name
+        query_pool.run_concurrently(read, read)
+        spans = [name for name, seconds in metrics.get_request_state()[1]]
+        self.assertEqual(spans.count('read_sql'), 2)
+
+    def test_runs_inline_when_saturated(self):
+        query_pool.get_pool()
+        workers = query_pool.workers
+        query_pool.workers = threading.BoundedSemaphore(1)
+        query_pool.workers.acquire()
+        try:
+            names = query_pool.run_concurrently(lambda: threading.current_thread().name,
+                                                lambda: threading.current_thread().name)
+        finally:
+            query_pool.workers = workers
+        self.assertEqual(names, [threading.current_thread().name] * 2)
+
+
+class SlowQueryDatasetTests(SimpleTestCase):
+    datasets = set(['0123456789abcdef0123456789abcdef', 'abcdef0123456789abcdef0123456789'])
+
+    def test_quoted_dataset_table(self):
+        statement = 'SELECT * FROM mircs."0123456789abcdef0123456789abcdef" WHERE id > 5'
+        self.assertEqual(slow_queries.get_dataset_uuid(statement, self.datasets),
+                         '0123456789abcdef0123456789abcdef')
+
+    def test_unquoted_dataset_table(self):
+        statement = 'SELECT * FROM mircs.abcdef0123456789abcdef0123456789 WHERE id > 5'
+        self.assertEqual(slow_queries.get_dataset_uuid(statement, self.datasets),
+                         'abcdef0123456789abcdef0123456789')
+
+    def test_unknown_uuid(self):
+        statement = "SELECT * FROM mircs.datasets WHERE uuid = 'fedcba9876543210fedcba9876543210'"
+        self.assertIsNone(slow_queries.get_dataset_uuid(statement, self.datasets))
+
+
+@override_settings(PARTITION_DATE_INTERVAL=10, PARTITION_CELL_SIZE=10)
+class PartitioningTests(SimpleTestCase):
+
+    def test_parse_partitioning_string(self):
+        self.assertEqual(partitioning.parse_partitioning_string('strategy=date&column=BIRTH_DATE'), {
+            'definition': 'strategy=date&column=BIRTH_DATE',
+            'strategy': 'date',
+            'column': 'BIRTH_DATE'
+        })
+        self.assertIsNone(partitioning.parse_partitioning_string(''))
+        with self.assertRaises(Exception):
+            partitioning.parse_partitioning_string('strategy=hash')
+
+    def test_year_bucket(self):
+        self.assertEqual(partitioning.get_year_bucket(1859), 1850)
+        self.assertEqual(partitioning.get_year_bucket(1860), 1860)
+
+    def test_cell(self):
+        self.assertEqual(partitioning.get_cell(-90, -180), 0)
+        self.assertEqual(partitioning.get_cell(0, 0), 9 * 36 + 18)
+        # The antimeridian wraps around to the first column
+        self.assertEqual(partitioning.get_cell(5, 180), partitioning.get_cell(5, -180))
+
+    def test_bbox_cells(self):
+        self.assertEqual(partitioning.get_bbox_cells('0,0,15,5'), [342, 343])
+        self.assertEqual(partitioning.get_bbox_cells('1,1,2,2'), [342])
+
+    def test_date_partition_keys(self):
+        df = pd.DataFrame({'BIRTH_DATE': ['1851-03-01', None, '1999-12-31']})
+        keys = partitioning.add_partition_keys(df, {'strategy': 'date', 'column': 'BIRTH_DATE'}, [])
+        self.assertEqual(keys.tolist(), [1850, partitioning.missing_partition_key, 1990])
+
+    def test_cell_partition_keys(self):
+        df = pd.DataFrame({'LAT': [1.0, None], 'LON': [1.0, 2.0]})
+        geospatial_columns = [{'name': 'geom', 'type': 'latlon', 'lat_col': 'LAT', 'lon_col': 'LON'}]
+        keys = partitioning.add_partition_keys(df, {'strategy': 'cell', 'column': 'geom'}, geospatial_columns)
+        self.assertEqual(keys.tolist(), [342, partitioning.missing_partition_key])
+
+
+class BenchmarkTests(SimpleTestCase):
+
+    def test_generated_dataset_is_reproducible(self):
+        df = benchmark.generate_dataset(100, extra_columns=1, date_columns=3)
+        self.assertTrue(df.equals(benchmark.generate_dataset(100, extra_columns=1, date_columns=3)))
+        self.assertFalse(df.equals(benchmark.generate_dataset(100, extra_columns=1, date_columns=3, seed=1)))
+        self.assertEqual(len(df.index), 100)
+        for column in ('BIRTH_DATE', 'DEATH_DATE', 'MARRIAGE_DATE', 'NOTE_0'):
+            self.assertIn(column, df.columns)
+
+    def test_uniform_points_stay_in_bbox(self):
+        df = benchmark.generate_dataset(100, distribution='uniform', bbox=(-66.0, 43.5, -59.7, 47.0))
+        self.assertTrue(df.LONGITUDE.between(-66.0, -59.7).all())
+        self.assertTrue(df.LATITUDE.between(43.5, 47.0).all())
+
+    def test_measure(self):
+        result = benchmark.measure('noop', lambda: None, 10, repeat=3)
+        self.assertEqual(result['operation'], 'noop')
+        self.assertEqual(result['runs'], 3)
+        self.assertEqual(sorted(result['latency_ms']), ['mean', 'p50', 'p95', 'p99'])
+
+    def test_compare(self):
+        def report(*results):
+            return {'results': [{'size': size, 'operation': operation, 'latency_ms': {'p50': p50}}
+                                for size, operation, p50 in results]}
+        comparison = benchmark.compare(report((1000, 'page', 30.0), (1000, 'export', 5.0)),
+                                       report((1000, 'page', 20.0), (1000, 'create_table', 50.0)))
+        self.assertEqual(comparison, [(1000, 'page', 20.0, 30.0, 1.5)])
+
+
+class UploadTests(SimpleTestCase):
+    upload_id = '0123456789abcdef0123456789abcdef'
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root)
+
+    def send_chunk(self, offset, data, checksum=None):
+        handler = uploads.StagingUploadHandler(self.upload_id, offset, length=len(data), checksum=checksum)
+        handler.new_file('chunk', 'chunk', 'application/octet-stream', len(data))
+        handler.receive_data_chunk(data, 0)
+        return handler.file_complete(len(data))
+
+    def test_chunks_are_appended(self):
+        self.send_chunk(0, b'a,b\n')
+        chunk = self.send_chunk(4, b'1,2\n', hashlib.sha256(b'1,2\n').hexdigest())
+        self.assertFalse(chunk.corrupt)
+        self.assertEqual(uploads.get_received_size(self.upload_id), 8)
+
+    def test_out_of_step_chunk_is_rejected(self):
+        self.send_chunk(0, b'a,b\n')
+        with self.assertRaises(StopUpload):
+            self.send_chunk(0, b'a,b\n')
+        self.assertEqual(uploads.get_received_size(self.upload_id), 4)
+
+    def test_corrupt_chunk_is_cut_off(self):
+        self.send_chunk(0, b'a,b\n')
+        chunk = self.send_chunk(4, b'1,2\n', hashlib.sha256(b'1,3\n').hexdigest())
+        self.assertTrue(chunk.corrupt)
+        self.assertEqual(uploads.get_received_size(self.upload_id), 4)
+
+    def test_finish_removes_the_lock(self):
+        self.send_chunk(0, b'a,b\n1,2\n')
+        path = os.path.join(self.media_root, 'upload.csv')
+        self.assertIsNone(uploads.finish(self.upload_id, path, '.csv'))
+        self.assertFalse(os.path.exists(uploads.get_lock_path(self.upload_id)))
+        self.assertFalse(os.path.exists(uploads.get_staging_path(self.upload_id)))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'a,b\n1,2\n')
+
+    def test_invalid_offset(self):
+        for query in ('length=4', 'offset=a&length=4', 'offset=-4&length=4'):
+            request = RequestFactory().post('/upload_chunk/%s?%s' % (self.upload_id, query))
+            request.session = {'uploads': {self.upload_id: {}}}
+            response = views.upload_chunk(request, self.upload_id)
+            self.assertEqual(response.status_code, 400)
+
+
+class IndexNameTests(SimpleTestCase):
+    table_uuid = 'abcdef0123456789abcdef0123456789'
+
+    def test_short_names(self):
+        self.assertEqual(index_builds.get_key_index_name(self.table_uuid, ['SURNAME', 'GIVEN_NAME']),
+                         'abcdef0123456789abcdef0123456789_SURNAME_GIVEN_NAME_idx')
+        self.assertEqual(index_builds.get_advised_index_name(self.table_uuid, ['SURNAME']),
+                         'abcdef0123456789abcdef0123456789_SURNAME_advised_idx')
+
+    def test_long_names_fit_postgres(self):
+        columns = ['PLACE_OF_BIRTH_AS_RECORDED', 'PLACE_OF_DEATH_AS_RECORDED']
+        key = index_builds.get_key_index_name(self.table_uuid, columns)
+        advised = index_builds.get_advised_index_name(self.table_uuid, columns)
+        for name in (key, advised):
+            self.assertLessEqual(len(name.encode('utf-8')), 63)
+            self.assertEqual(index_builds.get_stored_index_name(name), name)
+        self.assertNotEqual(key, advised)
+        # Columns sharing a long prefix still get different names
+        self.assertNotEqual(key, index_builds.get_key_index_name(self.table_uuid, columns[:1] + ['PLACE_OF_DEATH']))
+
+    def test_stored_name_of_old_keys(self):
+        name = '%s_%s_idx' % (self.table_uuid, 'X' * 40)
+        self.assertEqual(index_builds.get_stored_index_name(name), name[:63])
+
+    def test_filter_pattern(self):
+        pattern = index_builds.get_filter_pattern(self.table_uuid)
+        statement = ('SELECT * FROM mircs.%s WHERE %s."SURNAME" = %%(param_1)s ORDER BY %s.id' %
+                     (self.table_uuid, self.table_uuid, self.table_uuid))
+        found = set(c for match in pattern.finditer(statement) for c in match.groups() if c)
+        self.assertEqual(found, set(['SURNAME', 'id']))
+        quoted = index_builds.get_filter_pattern('0123456789abcdef0123456789abcdef')
+        match = quoted.search('WHERE "0123456789abcdef0123456789abcdef"."BIRTH_DATE" >= 1850')
+        self.assertEqual(match.group(1), 'BIRTH_DATE')
+
+
+class ReplicaRoutingTests(SimpleTestCase):
+    replica = object()
+
+    def setUp(self):
+        self.replica_engines = m.replica_engines
+        self.has_replayed = m.has_replayed
+        m.replica_engines = [self.replica]
+        self.replayed = True
+        m.has_replayed = lambda engine, lsn: self.replayed
+
+    def tearDown(self):
+        m.replica_engines = self.replica_engines
+        m.has_replayed = self.has_replayed
+        m.use_engine(None)
+
+    def route(self, method, view, session=None):
+        request = getattr(RequestFactory(), method)('/')
+        request.session = session or {}
+        middleware.ReplicaRoutingMiddleware().process_view(request, view, (), {})
+        return m.get_engine()
+
+    def test_engine_is_per_thread(self):
+        m.use_engine(self.replica)
+        engines = []
+        thread = threading.Thread(target=lambda: engines.append(m.get_engine()))
+        thread.start()
+        thread.join()
+        self.assertIs(m.get_engine(), self.replica)
+        self.assertEqual(engines, [m.engine])
+        m.use_engine(None)
+        self.assertIs(m.get_engine(), m.engine)
+
+    def test_read_only_views_use_replicas(self):
+        self.assertIs(self.route('get', middleware.read_only(lambda request: None)), self.replica)
+        m.use_engine(None)
+        self.assertIs(self.route('post', middleware.read_only(lambda request: None)), m.engine)
+        self.assertIs(self.route('get', lambda request: None), m.engine)
+
+    @override_settings(REPLICA_READ_YOUR_WRITES_SECONDS=60)
+    def test_reads_wait_for_own_writes(self):
+        self.replayed = False
+        view = middleware.read_only(lambda request: None)
+        session = {'write_lsn': '0/3000148', 'write_time': time.time()}
+        self.assertIs(self.route('get', view, session), m.engine)
+        self.assertIsNone(m.choose_read_engine('0/3000148'))
+        self.assertIs(m.choose_read_engine(), self.replica)
+        # Long after the write every replica has caught up
+        session = {'write_lsn': '0/3000148', 'write_time': time.time() - 120}
+        self.assertIs(self.route('get', view, session), self.replica)
+        self.assertNotIn('write_lsn', session)
+
+
+class BulkEditTests(SimpleTestCase):
+    table_uuid = '0123456789abcdef0123456789abcdef'
+
+    def test_post_required(self):
+        for view in (views.remove_rows, views.modify_rows):
+            self.assertEqual(view(RequestFactory().get('/'), self.table_uuid).status_code, 405)
+
+    def test_invalid_ids(self):
+        request = RequestFactory().post('/', {'ids': '1,a'})
+        self.assertEqual(views.remove_rows(request, self.table_uuid).status_code, 400)
+
+    def test_missing_corrections(self):
+        request = RequestFactory().post('/', {'index_name': 'key_idx'})
+        self.assertEqual(views.modify_rows(request, self.table_uuid).status_code, 400)
+        request = RequestFactory().post('/', {'file': SimpleUploadedFile('corrections.csv', b'id\n1\n')})
+        self.assertEqual(views.modify_rows(request, self.table_uuid).status_code, 400)
+
+    def test_invalid_file_type(self):
+        request = RequestFactory().post('/', {
+            'index_name': 'key_idx',
+            'file': SimpleUploadedFile('corrections.txt', b'id\n1\n')
+        })
+        self.assertEqual(views.modify_rows(request, self.table_uuid).status_code, 400)
+
+    def test_changes_are_logged_by_the_statement(self):
+        delete = 'DELETE FROM mircs.t WHERE id = ANY(:ids) RETURNING id'
+        statement = bulk_edits.log_changes(delete)
+        self.assertTrue(statement.startswith('WITH changed AS (%s) ' % delete))
+        # Nothing is logged when no row changed
+        self.assertIn('HAVING count(*) > 0', statement)
+
+
+class AsOfTests(SimpleTestCase):
+    table = Table(
+        '0123456789abcdef0123456789abcdef', MetaData(),
+        Column('id', Integer, primary_key=True),
+        Column('SURNAME', String),
+        Column('BIRTH_DATE', DateTime),
+        schema='mircs'
+    )
+
+    def test_statement(self):
+        statement = history.get_as_of_statement(self.table)
+        sql = str(statement)
+        self.assertEqual([c.name for c in statement.columns], ['id', 'SURNAME', 'BIRTH_DATE'])
+        self.assertEqual(sql.count('"id", "SURNAME", "BIRTH_DATE"'), 2)
+        self.assertIn('FROM "mircs"."0123456789abcdef0123456789abcdef_history"', sql)
+        self.assertEqual(set(statement.compile().params), set(['as_of', 'max_id']))
+
+    def test_condition_applies_to_both_sides(self):
+        sql = str(history.get_as_of_statement(self.table, 'id > :start AND id <= :end'))
+        self.assertEqual(sql.count('AND id > :start AND id <= :end'), 2)
+
+    def test_as_of_parameter(self):
+        self.assertIsNone(views.get_as_of(RequestFactory().get('/')))
+        self.assertEqual(views.get_as_of(RequestFactory().get('/', {'as_of': '12'})), 12)
+        self.assertIs(views.get_as_of(RequestFactory().get('/', {'as_of': 'latest'})), False)
+
+
+@override_settings(DENSITY_MAX_RESOLUTION=256)
+class DensityTests(SimpleTestCase):
+    table_uuid = '0123456789abcdef0123456789abcdef'
+
+    def get(self, **params):
+        params.setdefault('bbox', '-66,43.5,-59.7,47')
+        return views.get_dataset_density(RequestFactory().get('/', params), self.table_uuid)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(views.get_dataset_density(RequestFactory().get('/'), self.table_uuid).status_code, 400)
+        for params in ({'bbox': '-66,43.5,-59.7'}, {'bbox': 'a,b,c,d'}, {'shape': 'triangle'},
+                       {'resolution': 'fine'}, {'resolution': '0'}, {'resolution': '257'},
+                       {'bucket': 'month'}, {'precision': 'a'}):
+            self.assertEqual(self.get(**params).status_code, 400, params)
+
+    def test_mercator_bbox(self):
+        min_x, min_y, max_x, max_y = views.get_mercator_bbox('-180,-90,0,0')
+        self.assertAlmostEqual(min_x, -20037508.34, places=1)
+        self.assertAlmostEqual(min_y, -20037508.34, places=1)
+        self.assertAlmostEqual(max_x, 0)
+        self.assertAlmostEqual(max_y, 0)
+
+
+@override_settings(SEARCH_TEXT_CONFIG='simple')
+class SearchTests(SimpleTestCase):
+
+    def test_quote_identifier(self):
+        self.assertEqual(search.quote_identifier('SURNAME'), '"SURNAME"')
+        self.assertEqual(search.quote_identifier('a"b'), '"a""b"')
+
+    def test_search_vector(self):
+        self.assertEqual(search.get_search_vector_sql(['SURNAME', 'GIVEN_NAME']),
+                         "to_tsvector('simple'::regconfig, "
+                         "coalesce(\"SURNAME\", '') || ' ' || coalesce(\"GIVEN_NAME\", ''))")
+
+    def test_searchable_columns(self):
+        class Row(object):
+            __table__ = Table('t', MetaData(), Column('id', Integer, primary_key=True),
+                              Column('SURNAME', String), Column('BIRTH_DATE', DateTime),
+                              Column('PARISH', String))
+        self.assertEqual(search.get_searchable_columns(Row), ['SURNAME', 'PARISH'])
+
+    def test_empty_query(self):
+        response = views.search_datasets(RequestFactory().get('/', {'q': '  '}))
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {'hits': []})
+
+    def test_invalid_limit(self):
+        response = views.search_datasets(RequestFactory().get('/', {'q': 'Smith', 'limit': 'ten'}))
+        self.assertEqual(response.status_code, 400)
+
+
+class LinkageTests(SimpleTestCase):
+
+    def test_normalize_name(self):
+        self.assertEqual(linkage.normalize_name(u'Jos\xe9  O\'Brien'), 'jose o brien')
+
+    def test_soundex(self):
+        self.assertEqual(linkage.soundex('robert'), 'R163')
+        self.assertEqual(linkage.soundex('rupert'), 'R163')
+        self.assertEqual(linkage.soundex('ashcraft'), 'A261')
+        self.assertEqual(linkage.soundex('pfister'), 'P236')
+        self.assertEqual(linkage.soundex('john smith'), linkage.soundex('smyth'))
+        self.assertEqual(linkage.soundex(''), '')
+
+    def test_name_similarity(self):
+        similarities = linkage.name_similarity_chunk([('smith', 'smith'), ('smith', 'smyth'), ('abc', 'xyz')])
+        t1, t2 = linkage.trigrams('smith'), linkage.trigrams('smyth')
+        self.assertEqual(similarities[0], 1.0)
+        self.assertAlmostEqual(similarities[1], len(t1 & t2) / float(len(t1 | t2)))
+        self.assertEqual(similarities[2], 0.0)
+        self.assertEqual(len(linkage.name_similarity_chunk([])), 0)
+
+    def test_blocking_passes(self):
+        self.assertEqual(linkage.get_blocking_passes(['phonetic', 'year', 'year_shifted']),
+                         [['phonetic', 'year'], ['phonetic', 'year_shifted']])
+        self.assertEqual(linkage.get_blocking_passes(['phonetic']), [['phonetic']])
+        self.assertEqual(linkage.get_blocking_passes(['year', 'year_shifted', 'cell']),
+                         [['year', 'cell'], ['year_shifted', 'cell']])
+        self.assertEqual(linkage.get_blocking_passes(['cell']), [['cell']])
+
+    @override_settings(LINKAGE_YEAR_BUCKET=5, LINKAGE_MAX_BLOCK_PAIRS=4)
+    def test_candidate_pairs(self):
+        df1 = pd.DataFrame({'id': [1, 2, 3], 'name': ['john smith', 'mary roy', ''],
+                            'date': pd.to_datetime(['1850-01-01', '1850-01-01', '1850-01-01'])})
+        df2 = pd.DataFrame({'id': [10, 11, 12], 'name': ['jon smyth', 'mary roy', 'john smith'],
+                            'date': pd.to_datetime(['1852-06-01', '1870-01-01', '1849-12-31'])})
+        keys = linkage.add_blocking_keys(df1)
+        self.assertEqual(keys, linkage.add_blocking_keys(df2))
+        pairs = linkage.get_candidate_pairs(df1, df2, linkage.get_blocking_passes(keys))
+        # Records without a name are never compared, nor are records decades apart
+        self.assertEqual(sorted(map(tuple, pairs.values.tolist())), [(1, 10), (1, 12)])
+
+    @override_settings(LINKAGE_DATE_TOLERANCE_DAYS=3650, LINKAGE_DISTANCE_TOLERANCE_KM=50)
+    def test_score_pairs(self):
+        df1 = pd.DataFrame({'id': [1, 2], 'name': ['john smith', ''],
+                            'date': pd.to_datetime(['1850-01-01', '1850-01-01'])})
+        df2 = pd.DataFrame({'id': [10], 'name': ['john smith'], 'date': pd.to_datetime(['1850-01-01'])})
+        pairs = linkage.score_pairs(pd.DataFrame({'id1': [1, 2], 'id2': [10, 10]}), df1, df2)
+        self.assertEqual(pairs['score'].tolist(), [1.0, 1.0])
+        df2['date'] = pd.to_datetime(['1855-01-01'])
+        pairs = linkage.score_pairs(pd.DataFrame({'id1': [1, 2], 'id2': [10, 10]}), df1, df2)
+        date_similarity = 1 - 1826 / 3650.0
+        self.assertAlmostEqual(pairs['score'].tolist()[0], (0.6 + 0.25 * date_similarity) / 0.85)
+        # A missing name is left out of the average instead of counting as a mismatch
+        self.assertAlmostEqual(pairs['score'].tolist()[1], date_similarity)
+
+
+@override_settings(GAZETTEER_FUZZY_CANDIDATES=20, GAZETTEER_FUZZY_CUTOFF=0.85,
+                   GAZETTEER_TRIGRAM_MAX_NAMES=5000, GAZETTEER_FUZZY_POOL=2000)
+class GazetteerTests(SimpleTestCase):
+    gazetteer = geocoding.Gazetteer(
+        [u'Antigonish', u'Arichat', u'Pictou', u'Antigonish', u'St. Andrews'],
+        [45.62, 45.51, 45.68, 0, 45.07],
+        [-61.99, -61.03, -62.71, 0, -67.05]
+    )
+
+    def test_exact_match(self):
+        self.assertEqual(len(self.gazetteer), 4)
+        # The first entry of a name wins
+        self.assertEqual(self.gazetteer.lookup('ANTIGONISH'), (45.62, -61.99))
+        self.assertEqual(self.gazetteer.lookup('St Andrews'), (45.07, -67.05))
+
+    def test_place_before_comma(self):
+        self.assertEqual(self.gazetteer.lookup('Pictou, Nova Scotia'), (45.68, -62.71))
+
+    def test_fuzzy_match(self):
+        self.assertEqual(self.gazetteer.lookup('Antigonishe'), (45.62, -61.99))
+        self.assertIsNone(self.gazetteer.lookup('Halifax'))
+        self.assertIsNone(self.gazetteer.lookup('  '))
+
+    @override_settings(GAZETTEER_TRIGRAM_MAX_NAMES=1)
+    def test_common_trigrams_are_skipped(self):
+        # Every trigram of the misspelling is shared by several names or by none
+        gazetteer = geocoding.Gazetteer([u'Mabou', u'Mabou Mines'], [46.07, 46.08], [-61.39, -61.40])
+        self.assertIsNone(gazetteer.fuzzy_match('mabo'))
+        self.assertEqual(gazetteer.lookup('Mabou'), (46.07, -61.39))
+
+    @override_settings(GAZETTEER_PATH='gazetteer.csv')
+    def test_geocode_df(self):
+        loaded = geocoding.gazetteer, geocoding.gazetteer_path
+        geocoding.gazetteer, geocoding.gazetteer_path = self.gazetteer, 'gazetteer.csv'
+        try:
+            df = pd.DataFrame({'PARISH': ['Pictou', None, 'Halifax', 'Pictou']})
+            added = geocoding.geocode_df(df, [{'place_col': 'PARISH', 'lat_col': 'LAT', 'lon_col': 'LON'}])
+        finally:
+            geocoding.gazetteer, geocoding.gazetteer_path = loaded
+        self.assertEqual(added, ['LAT', 'LON'])
+        self.assertEqual(df['LAT'].tolist()[::3], [45.68, 45.68])
+        self.assertTrue(df['LAT'].iloc[1:3].isnull().all())
+
+
+class FormatTests(SimpleTestCase):
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'id': np.array([1, 2], dtype=np.int64),
+            'SURNAME': ['Smith', None],
+            'BIRTH_DATE': pd.to_datetime(['1850-01-01', None])
+        }, columns=['id', 'SURNAME', 'BIRTH_DATE'])
+
+    def test_requested_format(self):
+        self.assertEqual(formats.get_requested_format(RequestFactory().get('/')), 'json')
+        self.assertEqual(formats.get_requested_format(RequestFactory().get('/', {'format': 'csv'})), 'csv')
+        self.assertIsNone(formats.get_requested_format(RequestFactory().get('/', {'format': 'xml'})))
+        request = RequestFactory().get('/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(formats.get_requested_format(request),
+                         'msgpack' if formats.is_available('msgpack') else 'json')
+
+    def test_pack_column(self):
+        packed = formats.pack_column(self.df['id'])
+        self.assertEqual(packed['dtype'], '<i8')
+        self.assertEqual(np.frombuffer(packed['data'], dtype=packed['dtype']).tolist(), [1, 2])
+        self.assertEqual(formats.pack_column(self.df['SURNAME']), ['Smith', None])
+
+    def test_geometries_are_hex_wkb(self):
+        class Geometry(object):
+            desc = '0101000000000000000000F03F0000000000000040'
+        df = formats.prepare_geometries(pd.DataFrame({'geom': [Geometry(), None]}))
+        self.assertEqual(df['geom'].tolist(), [Geometry.desc, None])
+
+    def test_csv_header_once(self):
+        self.assertEqual(''.join(formats.iter_csv([self.df[['id']], self.df[['id']]])), 'id\n1\n2\n1\n2\n')
+
+    @unittest.skipUnless(formats.is_available('msgpack'), 'msgpack is not installed')
+    def test_msgpack(self):
+        unpacked = formats.msgpack.unpackb(formats.to_msgpack(self.df, {'pageCount': 3}), raw=False)
+        self.assertEqual(unpacked['pageCount'], 3)
+        self.assertEqual(unpacked['columns'], ['id', 'SURNAME', 'BIRTH_DATE'])
+        dates = unpacked['data']['BIRTH_DATE']
+        self.assertEqual(pd.to_datetime(np.frombuffer(dates['data'], dtype=dates['dtype']))[0],
+                         pd.Timestamp('1850-01-01'))
+
+    @unittest.skipUnless(formats.is_available('arrow'), 'pyarrow is not installed')
+    def test_arrow(self):
+        class Row(object):
+            __table__ = Table('t', MetaData(), Column('id', Integer, primary_key=True),
+                              Column('SURNAME', String), Column('BIRTH_DATE', DateTime))
+        schema = formats.get_arrow_schema(Row)
+        stream = b''.join(formats.iter_arrow([self.df, self.df], schema, {'pageCount': 3}))
+        table = formats.pa.ipc.open_stream(stream).read_all()
+        self.assertEqual(table.num_rows, 4)
+        self.assertEqual(table.column_names, ['id', 'SURNAME', 'BIRTH_DATE'])
+        self.assertEqual(json.loads(table.schema.metadata[b'mircs'].decode('utf-8')), {'pageCount': 3})
+
+
+@override_settings(TIME_BUCKETS={'year': 1, 'decade': 10, 'century': 100})
+class TimeParameterTests(SimpleTestCase):
+    table_uuid = '0123456789abcdef0123456789abcdef'
+
+    def test_invalid_histogram_parameters(self):
+        for params in ({'bucket': 'month'}, {'bbox': '-66,43.5'}, {'bbox': 'a,b,c,d'}):
+            request = RequestFactory().get('/', params)
+            self.assertEqual(views.get_dataset_time_histogram(request, self.table_uuid).status_code, 400)
+
+    def test_invalid_range_parameters(self):
+        for params in ({'start': 'yesterday'}, {'end': ''}, {'start': '1850-01-01', 'end': '1850-13-01'},
+                       {'bbox': '-66,43.5,-59.7,47,0'}, {'precision': 'high'}):
+            request = RequestFactory().get('/', params)
+            self.assertEqual(views.get_dataset_time_range(request, self.table_uuid).status_code, 400)
+
+    def test_bbox(self):
+        self.assertTrue(views.is_valid_bbox('-66,43.5,-59.7,47'))
+        self.assertFalse(views.is_valid_bbox('-66,43.5,-59.7'))
+        self.assertFalse(views.is_valid_bbox('west,south,east,north'))
+
+
+@override_settings(NEAREST_FEATURES_LIMIT=100)
+class NearestFeatureTests(SimpleTestCase):
+    table_uuid = '0123456789abcdef0123456789abcdef'
+
+    def test_invalid_parameters(self):
+        for params in ({'k': 'ten', 'lat': '45', 'lon': '-61'}, {'k': '0', 'lat': '45', 'lon': '-61'},
+                       {'max_distance': 'far', 'lat': '45', 'lon': '-61'}, {'row_id': 'first'},
+                       {'lat': '45'}, {'lat': 'north', 'lon': '-61'}, {'lat': '45', 'lon': '-61', 'srid': 'wgs84'}):
+            request = RequestFactory().get('/', params)
+            self.assertEqual(views.get_nearest_features(request, self.table_uuid).status_code, 400, params)
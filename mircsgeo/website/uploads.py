@@ -0,0 +1,248 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import pandas as pd
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+
+def get_staging_path(upload_id):
+    """
+    Get the path of the partial file an upload is streamed into
+
+    Parameters:
+    upload_id (str) - The id given to the upload by start_upload
+
+    Returns:
+    path (str) - The absolute path of the partial file
+    """
+    directory = os.path.join(os.path.dirname(__file__), settings.MEDIA_ROOT, 'staging')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, '%s.part' % upload_id)
+
+
+def get_lock_path(upload_id):
+    """
+    Get the path of the file locked while a chunk of an upload is being written
+    """
+    return get_staging_path(upload_id)[:-len('.part')] + '.lock'
+
+
+def lock_upload(upload_id, blocking=True):
+    """
+    Take the lock serializing the writes to the staging file of an upload, so a
+    retried chunk can't be appended while the original is still streaming in
+
+    Parameters:
+    upload_id (str) - The id of the upload
+    blocking (bool) - optional. Wait for the lock instead of giving up
+
+    Returns:
+    lock (file) - The locked file, closing it releases the lock. None if the
+                  lock is held elsewhere and blocking is False
+    """
+    lock = open(get_lock_path(upload_id), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        lock.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock
+
+
+def remove_expired(max_age=None):
+    """
+    Delete the staging files of uploads that haven't received a chunk for
+    settings.UPLOAD_STAGING_EXPIRY seconds, eg. abandoned by their user
+
+    Parameters:
+    max_age (int) - optional. The age in seconds after which a staging file expires
+    """
+    max_age = settings.UPLOAD_STAGING_EXPIRY if max_age is None else max_age
+    directory = os.path.dirname(get_staging_path('expiry'))
+    now = time.time()
+    for filename in os.listdir(directory):
+        if not filename.endswith('.part'):
+            continue
+        upload_id = filename[:-len('.part')]
+        try:
+            if now - os.path.getmtime(os.path.join(directory, filename)) < max_age:
+                continue
+        except OSError:
+            # Finished or removed in the meantime
+            continue
+        lock = lock_upload(upload_id, blocking=False)
+        if lock is None:
+            # A chunk is being written
+            continue
+        try:
+            for path in (get_staging_path(upload_id), get_lock_path(upload_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+        finally:
+            lock.close()
+
+
+def get_received_size(upload_id):
+    """
+    Get the number of bytes of an upload that have been received and verified
+    """
+    path = get_staging_path(upload_id)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+class StagedChunk(object):
+    """
+    Stands in for an uploaded file in request.FILES once a chunk has been
+    written to its staging file
+    """
+
+    def __init__(self, size, checksum, corrupt=False):
+        self.size = size
+        self.checksum = checksum
+        self.corrupt = corrupt
+
+
+class StagingUploadHandler(FileUploadHandler):
+    """
+    Stream the chunk of an upload straight into its staging file under
+    MEDIA_ROOT instead of buffering it in memory or a temporary file.
+    The chunk is only accepted if it starts where the staging file ends, and
+    is cut off again if its length or checksum don't match. The upload is
+    locked from the check until then, see lock_upload().
+    """
+
+    def __init__(self, upload_id, offset, length=None, checksum=None, request=None):
+        super(StagingUploadHandler, self).__init__(request)
+        self.upload_id = upload_id
+        self.offset = offset
+        self.length = length
+        self.checksum = checksum
+        self.rejected = False
+        self.file = None
+        self.lock = None
+
+    def new_file(self, *args, **kwargs):
+        super(StagingUploadHandler, self).new_file(*args, **kwargs)
+        path = get_staging_path(self.upload_id)
+        self.lock = lock_upload(self.upload_id)
+        if get_received_size(self.upload_id) != self.offset:
+            # The client is out of step, eg. it is retrying a chunk that already arrived
+            self.rejected = True
+            self.release()
+            raise StopUpload()
+        self.file = open(path, 'ab')
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        self.hash.update(raw_data)
+        self.size += len(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.file.close()
+        checksum = self.hash.hexdigest()
+        corrupt = (self.length is not None and self.size != self.length) or \
+            bool(self.checksum and self.checksum != checksum)
+        try:
+            if corrupt:
+                truncate(self.upload_id, self.offset)
+        finally:
+            self.release()
+        return StagedChunk(self.size, checksum, corrupt)
+
+    def abort(self):
+        """
+        Drop what arrived of a chunk whose connection dropped midway
+        """
+        if self.lock is None:
+            return
+        try:
+            if self.file is not None:
+                self.file.close()
+            truncate(self.upload_id, self.offset)
+        finally:
+            self.release()
+
+    def release(self):
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+
+def truncate(upload_id, size):
+    """
+    Cut a staging file back to a given size, dropping a rejected chunk
+    """
+    with open(get_staging_path(upload_id), 'ab') as f:
+        f.truncate(size)
+
+
+def read_preview(upload_id, complete=False):
+    """
+    Parse the beginning of a staged CSV upload, so a preview can be shown
+    while the rest of the file is still uploading
+
+    Parameters:
+    upload_id (str) - The id of the upload
+    complete (bool) - optional. Whether every chunk has been received
+
+    Returns:
+    df (pandas.DataFrame) - The first rows of the file, or None if not enough of
+                            it has arrived yet
+    """
+    with open(get_staging_path(upload_id), 'rb') as f:
+        head = f.read(settings.UPLOAD_PREVIEW_BYTES)
+    if not complete:
+        # Leave out the last line, it is probably cut in half
+        head = head[:head.rfind(b'\n') + 1]
+        if head.count(b'\n') <= settings.UPLOAD_PREVIEW_ROWS:
+            return None
+    return pd.read_csv(StringIO(head.decode('utf-8', 'replace')))
+
+
+def finish(upload_id, path, filetype):
+    """
+    Move a fully received upload to where create_table and append_dataset
+    expect it, as a CSV file
+
+    Parameters:
+    upload_id (str) - The id of the upload
+    path (str) - The path the CSV file should be stored at
+    filetype (str) - The extension of the uploaded file
+
+    Returns:
+    df (pandas.DataFrame) - The parsed file for an Excel upload, which had to be
+                            read whole to be converted. None for a CSV upload
+    """
+    staging_path = get_staging_path(upload_id)
+    # Wait for a chunk that is still being written, eg. a retry racing the completion
+    lock = lock_upload(upload_id)
+    try:
+        if filetype.lower() == '.csv':
+            shutil.move(staging_path, path)
+            return None
+        elif filetype.lower() == '.xlsx':
+            df = pd.read_excel(staging_path)
+            df.to_csv(path, index=False)
+            os.remove(staging_path)
+            return df
+        raise Exception("invalid file type uploaded: %s" % filetype)
+    finally:
+        os.remove(get_lock_path(upload_id))
+        lock.close()
@@ -8,14 +8,30 @@ urlpatterns = [
     url(r'^home$', views.home, name='home'),
     url(r'^upload_file$', views.upload_file, name='upload_file'),
     url(r'^store_file$', views.store_file, name='store_file'),
+    url(r'^start_upload$', views.start_upload, name='start_upload'),
+    url(r'^upload_status/(?P<upload_id>[0-9a-f]{32})$', views.upload_status, name='upload_status'),
+    url(r'^upload_chunk/(?P<upload_id>[0-9a-f]{32})$', views.upload_chunk, name='upload_chunk'),
+    url(r'^complete_upload/(?P<upload_id>[0-9a-f]{32})$', views.complete_upload, name='complete_upload'),
     url(r'^test_response$', views.test_response, name='test_response'),
     url(r'^create_table$', views.create_table, name='create_table'),
     url(r'^view/(?P<table>[^/]+)/$', views.view_dataset, name='view_dataset'),
     url(r'^manage/join/(?P<table>[^/]+)$', views.join_datasets, name='join_datasets'),
     url(r'^add_dataset_key/(?P<table>[^/]+)/$', views.add_dataset_key, name='add_dataset_key'),
+    url(r'^get_index_builds/(?P<table>[^/]+)/$', views.get_index_builds, name='get_index_builds'),
+    url(r'^create_advised_indexes/(?P<table>[^/]+)/$', views.create_advised_indexes, name='create_advised_indexes'),
+    url(r'^remove_rows/(?P<table>[^/]+)/$', views.remove_rows, name='remove_rows'),
+    url(r'^modify_rows/(?P<table>[^/]+)/$', views.modify_rows, name='modify_rows'),
     url(r'^get_dataset_keys/(?P<table>[^/]+)/$', views.get_dataset_keys, name='get_dataset_keys'),
     url(r'^manage/(?P<table>[^/]+)$', views.manage_dataset, name='manage_dataset'),
     url(r'^manage/append/(?P<table>[^/]+)$', views.append_dataset, name='append_dataset'),
     url(r'^get_dataset_page/(?P<table>[^/]+)/(?P<page_number>[0-9]+)/$', views.get_dataset_page, name='get_dataset_page'),
-    url(r'^get_dataset_geojson/(?P<table>[^/]+)/(?P<page_number>[0-9]+)/$', views.get_dataset_geojson, name="get_dataset_geojson")
+    url(r'^get_dataset_geojson/(?P<table>[^/]+)/(?P<page_number>[0-9]+)/$', views.get_dataset_geojson, name="get_dataset_geojson"),
+    url(r'^get_dataset_page_features/(?P<table>[^/]+)/(?P<page_number>[0-9]+)/$', views.get_dataset_page_features, name='get_dataset_page_features'),
+    url(r'^export/(?P<table>[^/]+)/$', views.export_dataset, name='export_dataset'),
+    url(r'^get_nearest_features/(?P<table>[^/]+)/$', views.get_nearest_features, name='get_nearest_features'),
+    url(r'^get_dataset_time_histogram/(?P<table>[^/]+)/$', views.get_dataset_time_histogram, name='get_dataset_time_histogram'),
+    url(r'^get_dataset_time_range/(?P<table>[^/]+)/$', views.get_dataset_time_range, name='get_dataset_time_range'),
+    url(r'^get_dataset_density/(?P<table>[^/]+)/$', views.get_dataset_density, name='get_dataset_density'),
+    url(r'^metrics$', views.get_metrics, name='metrics'),
+    url(r'^search$', views.search_datasets, name='search_datasets')
 ]
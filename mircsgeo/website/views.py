@@ -1,10 +1,11 @@
 from django.shortcuts import render, redirect
 from django.template import RequestContext
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.conf import settings
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.contrib import messages
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.schema import Index
-from sqlalchemy import func, or_
+from sqlalchemy import func, and_, case, or_, not_, select, bindparam, literal_column, Boolean, Integer, Float
 import geoalchemy2.functions as geofunc
 
 import json
@@ -13,6 +14,7 @@ import math
 
 import website.models as m
 from .forms import Uploadfile, AddDatasetKey
+from .middleware import read_only, cache_by_dataset_version
 
 import pandas as pd
 
@@ -22,10 +24,24 @@ import uuid
 import datetime
 
 import website.table_generator as table_generator
+import website.search as search
+import website.metrics as metrics
+import website.slow_queries as slow_queries
+import website.query_pool as query_pool
+import website.uploads as uploads
+import website.index_builds as index_builds
+import website.partitioning as partitioning
+import website.formats as formats
+import website.bulk_edits as bulk_edits
+import website.geocoding as geocoding
+import website.frames as frames
+import website.statements as statements
+import website.history as history
 
 schema = "mircs"
 
 
+@read_only
 def home(request):
     """
     Render a view listing all datasets found in the datasets table in the DB
@@ -60,7 +76,10 @@ def upload_file(request):
         # File upload form
         form = Uploadfile()
     # Render the upload file page
-    return render(request, 'upload_file.html', {'form': form})
+    return render(request, 'upload_file.html', {
+        'form': form,
+        'chunk_size': settings.UPLOAD_CHUNK_SIZE
+    })
 
 
 def store_file(request):
@@ -87,38 +106,170 @@ def store_file(request):
             )
 
             # Parse the file using the relevant pandas read_* function
-            if request.session['filetype'].lower() == '.csv':
-                df = pd.read_csv(request.FILES['file_upload'])
-            elif request.session['filetype'].lower() == '.xlsx':
-                df = pd.read_excel(request.FILES['file_upload'])
-            else:
-                # TODO: Add a proper error handler for invalid file uploads. Probably inform the user somehow
-                raise Exception("invalid file type uploaded: %s" % request.session['filetype'])
+            with metrics.span('parse'):
+                if request.session['filetype'].lower() == '.csv':
+                    df = frames.read_csv(request.FILES['file_upload'])
+                elif request.session['filetype'].lower() == '.xlsx':
+                    df = pd.read_excel(request.FILES['file_upload'])
+                else:
+                    # TODO: Add a proper error handler for invalid file uploads. Probably inform the user somehow
+                    raise Exception("invalid file type uploaded: %s" % request.session['filetype'])
+            frames.report_memory('parse', df)
             # Store the file as a csv
-            df.to_csv(absolute_path, index=False)
+            with metrics.span('store'):
+                df.to_csv(absolute_path, index=False)
 
             # Convert dates and times to proper datetime format
-            df = convert_time_columns(df)
+            with metrics.span('convert'):
+                df = convert_time_columns(df)
+            frames.report_memory('convert', df)
 
-            # Return the columns and the first 10 rows of the file as a JSON object
-            columns = df.columns.tolist()
-            rows = df[0:10].values.tolist()
+            return JsonResponse(get_file_preview(df))
+    else:
+        return None
 
-            # Get the autopicked datatypes for the columns
-            datatypes = table_generator.get_readable_types_from_dataframe(df)
-            possible_datatypes = table_generator.type_mappings.values()
 
-            # Convert np.NaN objects to 'null' so rows is JSON serializable
-            rows = convert_nans(rows)
+def start_upload(request):
+    """
+    Start a chunked upload. Large files are sent in chunks by upload_chunk so
+    a dropped connection only loses the chunk in flight.
 
-            return JsonResponse({
-                'columns': columns,
-                'rows': rows,
-                'datatypes': datatypes,
-                'possibleDatatypes': possible_datatypes
-            })
-    else:
-        return None
+    POST Parameters:
+    filename (str) - The name of the file being uploaded
+    size (int) - The size of the file in bytes
+
+    Returns:
+    JsonResponse (str) - A JSON string containing the uploadId used by the other upload views
+    """
+    # Make room by dropping the uploads that were given up on
+    uploads.remove_expired()
+    upload_id = uuid.uuid4().hex
+    # Remember the uploads of this user so nobody else can write to them
+    session_uploads = request.session.setdefault('uploads', {})
+    session_uploads[upload_id] = {
+        'filename': request.POST['filename'],
+        'size': int(request.POST['size']),
+        'preview_sent': False,
+    }
+    request.session.modified = True
+    return JsonResponse({'uploadId': upload_id, 'received': 0})
+
+
+def upload_status(request, upload_id):
+    """
+    Return how much of a chunked upload has been received, so the client can resume it
+    """
+    if upload_id not in request.session.get('uploads', {}):
+        return JsonResponse({'error': 'unknown upload'}, status=404)
+    return JsonResponse({'uploadId': upload_id, 'received': uploads.get_received_size(upload_id)})
+
+
+@csrf_exempt
+def upload_chunk(request, upload_id):
+    """
+    Receive a chunk of a chunked upload, streaming it straight to the staging
+    file of the upload. The upload handlers have to be replaced before the
+    CSRF check reads the request body, hence the csrf_exempt wrapper around
+    the protected view.
+
+    GET Parameters:
+    offset (int) - The position of the chunk in the file
+    length (int) - The size of the chunk in bytes
+    checksum (str) - optional. The hex sha256 digest of the chunk
+    """
+    if upload_id not in request.session.get('uploads', {}):
+        return JsonResponse({'error': 'unknown upload'}, status=404)
+    try:
+        offset = int(request.GET['offset'])
+        length = int(request.GET['length'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'offset and length have to be integers'}, status=400)
+    if offset < 0 or length < 0:
+        return JsonResponse({'error': 'offset and length can\'t be negative'}, status=400)
+    request.upload_handlers = [uploads.StagingUploadHandler(
+        upload_id,
+        offset,
+        length=length,
+        checksum=request.GET.get('checksum'),
+        request=request
+    )]
+    return receive_upload_chunk(request, upload_id)
+
+
+@csrf_protect
+def receive_upload_chunk(request, upload_id):
+    """
+    Check a chunk written by upload_chunk and return the new size of the upload.
+    Once enough of a CSV file has arrived, the response also contains the same
+    preview store_file returns.
+    """
+    upload = request.session['uploads'][upload_id]
+    # Already checked by upload_chunk
+    offset = request.upload_handlers[0].offset
+
+    try:
+        chunk = request.FILES.get('chunk')
+    except Exception:
+        # The connection dropped in the middle of the chunk, drop what arrived of it
+        request.upload_handlers[0].abort()
+        raise
+    if chunk is None:
+        # The chunk didn't start where the staging file ends. Tell the client where to resume
+        return JsonResponse({'received': uploads.get_received_size(upload_id)}, status=409)
+
+    if chunk.corrupt:
+        # The upload handler already cut the chunk off again
+        return JsonResponse({'error': 'corrupt chunk', 'received': offset}, status=400)
+
+    received = uploads.get_received_size(upload_id)
+    response = {'uploadId': upload_id, 'received': received}
+    filetype = os.path.splitext(upload['filename'])[1]
+    if not upload['preview_sent'] and filetype.lower() == '.csv':
+        with metrics.span('parse'):
+            df = uploads.read_preview(upload_id, received >= upload['size'])
+        if df is not None:
+            response['preview'] = get_file_preview(convert_time_columns(df))
+            upload['preview_sent'] = True
+            request.session.modified = True
+    return JsonResponse(response)
+
+
+def complete_upload(request, upload_id):
+    """
+    Finish a chunked upload once every chunk has arrived. The file is stored
+    where store_file would have stored it, so create_table and append_dataset
+    work the same for both kinds of upload.
+
+    Returns:
+    JsonResponse (str) - A JSON string containing the preview, if it hasn't been sent yet
+    """
+    upload = request.session.get('uploads', {}).get(upload_id)
+    if upload is None:
+        return JsonResponse({'error': 'unknown upload'}, status=404)
+    received = uploads.get_received_size(upload_id)
+    if received != upload['size']:
+        return JsonResponse({'error': 'incomplete upload', 'received': received}, status=409)
+
+    # Store the same session values as store_file
+    request.session['real_filename'] = upload['filename']
+    request.session['temp_filename'] = str(uuid.uuid4())
+    request.session['filetype'] = os.path.splitext(upload['filename'])[1]
+    absolute_path = os.path.join(
+        os.path.dirname(__file__),
+        settings.MEDIA_ROOT,
+        request.session['temp_filename']
+    )
+    with metrics.span('store'):
+        df = uploads.finish(upload_id, absolute_path, request.session['filetype'])
+
+    response = {'uploadId': upload_id, 'received': received}
+    if not upload['preview_sent']:
+        if df is None:
+            df = pd.read_csv(absolute_path, nrows=settings.UPLOAD_PREVIEW_ROWS)
+        response['preview'] = get_file_preview(convert_time_columns(df))
+    del request.session['uploads'][upload_id]
+    request.session.modified = True
+    return JsonResponse(response)
 
 
 def create_table(request):
@@ -146,6 +297,8 @@ def create_table(request):
             geospatial_columns.append(table_generator.parse_geospatial_column_string(col))
 
         for c in geospatial_columns:
+            # Keep a copy of the geometries in the display SRID, so maps never reproject
+            table_generator.add_display_srid(c)
             # Add geospatial columns to the session
             geo_col = m.GEOSPATIAL_COLUMNS(
                 dataset_uuid=table_uuid,
@@ -154,6 +307,14 @@ def create_table(request):
             )
             session.add(geo_col)
 
+        # Very large datasets can be split into partitions, by id, date or location
+        # Spaces in its column name are replaced like in the column names of the table
+        partitioned_by = partitioning.parse_partitioning_string(
+            post_data.get('partitioning', [''])[0].replace(' ', '_')
+        )
+        if partitioned_by is not None:
+            partitioning.save_partitioning(session, table_uuid, partitioned_by)
+
         # Figure out the path to the file that was originally uploaded
         absolute_path = os.path.join(
             os.path.dirname(__file__),
@@ -163,10 +324,14 @@ def create_table(request):
                                               # the file
         )
         # Use pandas to read the uploaded file as a CSV
-        df = pd.read_csv(absolute_path)
+        df = frames.read_csv(absolute_path)
+        frames.report_memory('parse', df)
         df = convert_time_columns(df)
+        frames.report_memory('convert', df)
         # Replace spaces with underscores in the column names to be used in the db table
         df.columns = [x.replace(" ", "_") for x in df.columns]
+        # Locate the rows of geospatial columns built from place names
+        datatypes += ['float'] * len(geocoding.geocode_df(df, geospatial_columns))
 
         # Create a new dataset to be added
         dataset = m.DATASETS(
@@ -192,7 +357,9 @@ def create_table(request):
         session.commit()
 
         # Generate a database table based on the data found in the CSV file
-        table_generator.to_sql(df, datatypes, table_uuid, schema, geospatial_columns)
+        missing_geometries = table_generator.to_sql(df, datatypes, table_uuid, schema,
+                                                    geospatial_columns, partitioned_by)[1]
+        report_missing_geometries(request, missing_geometries)
 
         session.close()
         return redirect('/')
@@ -200,6 +367,7 @@ def create_table(request):
         return None
 
 
+@read_only
 def view_dataset(request, table):
     """
     Return a page drawing the requested dataset using an html table
@@ -218,7 +386,7 @@ def view_dataset(request, table):
                  # The [0] gets the filename out of the list
     session.close
 
-    db = Session().connection()
+    db = m.get_engine()
     # Get the first 100 rows of data out of the database for the requested dataset
     df = pd.read_sql("SELECT * FROM " + schema + ".\"" + table + "\" LIMIT 100",
                      db, params={'schema': schema, 'table': table})
@@ -268,12 +436,26 @@ def manage_dataset(request, table):
         )
     ).all()
 
+    # Get the slowest queries recorded against the table
+    queries = slow_queries.get_slow_queries(table)
+    # Get the index builds of the table and the indexes worth adding
+    builds = index_builds.get_index_builds(table)
+    suggestions = index_builds.advise_indexes(table)
+    # The columns rows can be removed by, leaving out the id and geometries
+    geometry_columns = set(table_generator.get_geometry_column_names(table_generator.get_geospatial_columns(table)))
+    columns = [c.name for c in getattr(m.Base.classes, table).__table__.columns
+               if c.name != 'id' and c.name not in geometry_columns]
+
     # Render the data management page
     return render(request, 'manage_dataset.html', {
         'tablename': file_name,
         'table': table,
         'keys': keys,
-        'joins': joins
+        'columns': columns,
+        'joins': joins,
+        'slow_queries': queries,
+        'index_builds': builds,
+        'index_suggestions': suggestions
     })
 
 
@@ -300,43 +482,27 @@ def append_dataset(request, table):
                                               # the file
         )
         # Use pandas to read the uploaded file as a CSV
-        df = pd.read_csv(absolute_path)
+        df = frames.read_csv(absolute_path)
+        frames.report_memory('parse', df)
         df = convert_time_columns(df)
+        frames.report_memory('convert', df)
         # Replace spaces with underscores in the column names to be used in the db table
         df.columns = [x.replace(" ", "_") for x in df.columns]
 
-        # Get a session
-        session = m.get_session()
         # Store the table uuid
         table_uuid = table
 
         # Get the table model
         table = getattr(m.Base.classes, table)
 
-        # Get the current highest row id in the table
-        query = session.query(func.max(table.id).label("last_id"))
-        idMax = query.one()
-
         geospatial_columns = table_generator.get_geospatial_columns(table_uuid)
+        geocoding.geocode_df(df, geospatial_columns)
 
-        # Append the to the table with a batch insert
-        table_generator.insert_df(df, table, geospatial_columns)
-
-        # Get the new highest row id in the table
-        newIdMax = query.one()
-
-        # Create entry in transaction table for append
-        transaction = m.DATASET_TRANSACTIONS(
-            dataset_uuid=table_uuid,
-            transaction_type=m.transaction_types[1],
-            rows_affected=len(df.index),
-            affected_row_ids=range(idMax[0]+1, newIdMax[0]+1),
-        )
-        session.add(transaction)
-        session.commit()
-
-        # Close the session
-        session.close()
+        # Append the to the table with a batch insert, logged as an add transaction
+        # along with the ids of the new rows in the same database transaction
+        missing_geometries = table_generator.insert_df(df, table, geospatial_columns,
+                                                       transaction_type=m.transaction_types[1])
+        report_missing_geometries(request, missing_geometries)
 
         return redirect('/manage/' + table_uuid)
     else:
@@ -345,10 +511,77 @@ def append_dataset(request, table):
         # Render the append dataset page
         return render(request, 'append_dataset.html', {
             'form': form,
-            'table': table
+            'table': table,
+            'chunk_size': settings.UPLOAD_CHUNK_SIZE
         })
 
 
+def remove_rows(request, table):
+    """
+    Delete rows of a dataset by id or by filter, logged as a remove transaction
+
+    Parameters:
+    table (str) - The uuid of the table
+
+    POST Parameters:
+    ids (str) - optional. A comma separated list of row ids
+    filter_<column> (str) - optional. Only remove rows whose column equals this value
+
+    Returns:
+    JsonResponse (str) - A JSON string containing:
+                                * transaction - the id of the logged transaction
+                                * rowsAffected - the number of rows removed
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    try:
+        ids = [int(i) for i in request.POST.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return JsonResponse({'error': 'ids have to be integers'}, status=400)
+    filters = dict((k[len('filter_'):], v) for k, v in request.POST.items() if k.startswith('filter_'))
+    try:
+        transaction_id, rows_affected = bulk_edits.remove_rows(table, ids, filters)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'transaction': transaction_id, 'rowsAffected': rows_affected})
+
+
+def modify_rows(request, table):
+    """
+    Patch rows of a dataset from an uploaded correction file joined on one of
+    its keys, logged as a modify transaction
+
+    Parameters:
+    table (str) - The uuid of the table
+
+    POST Parameters:
+    index_name (str) - The name of the dataset key to join the corrections on
+    file - A CSV or Excel file holding the key columns and the columns to patch
+
+    Returns:
+    JsonResponse (str) - A JSON string containing:
+                                * transaction - the id of the logged transaction
+                                * rowsAffected - the number of rows changed
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    if 'file' not in request.FILES or not request.POST.get('index_name'):
+        return JsonResponse({'error': 'a correction file and a key are required'}, status=400)
+    f = request.FILES['file']
+    filetype = os.path.splitext(f.name)[1].lower()
+    if filetype == '.csv':
+        df = pd.read_csv(f)
+    elif filetype == '.xlsx':
+        df = pd.read_excel(f)
+    else:
+        return JsonResponse({'error': 'invalid file type uploaded: %s' % filetype}, status=400)
+    try:
+        transaction_id, rows_affected = bulk_edits.modify_rows(table, df, request.POST['index_name'])
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'transaction': transaction_id, 'rowsAffected': rows_affected})
+
+
 def add_dataset_key(request, table):
     """
     Add a key to a dataset
@@ -359,34 +592,9 @@ def add_dataset_key(request, table):
         post_data = dict(request.POST)
         dataset_columns = post_data['dataset_columns']
 
-        # Get the table
-        t = getattr(m.Base.classes, table)
-
-        # Get the column objects for each selected column in the POST parameter
-        column_objects = []
-        for col in dataset_columns:
-            column_objects.append(getattr(t.__table__.columns, col))
-
-        # Build up a standard name for the index
-        index_name = '%s_' % table
-        for col in dataset_columns:
-            index_name += '%s_' % col
-        index_name += 'idx'
-
-        # Create an sqlalchemy Index object
-        index = Index(index_name, *column_objects)
-        index.create(m.engine)
-
-        # Create an entry in dataset_keys
-        session = m.get_session()
-        dataset_key = m.DATASET_KEYS(
-            dataset_uuid=table,
-            index_name=index_name,
-            dataset_columns=dataset_columns
-        )
-        session.add(dataset_key)
-        session.commit()
-        session.close()
+        # Build the index in the background, without locking writes to the table.
+        # The key is added to dataset_keys once its index is ready
+        index_builds.start_index_build(table, dataset_columns)
 
         # Redirect to the manage_dataset page
         return redirect('/manage/' + table)
@@ -398,6 +606,35 @@ def add_dataset_key(request, table):
         return render(request, 'add_dataset_key.html', {'form': form})
 
 
+def get_index_builds(request, table):
+    """
+    Returns JSON containing the index builds of a dataset and the progress of
+    the running ones
+
+    Parameters:
+    table (str) - The uuid of the table being requested
+
+    Returns:
+    JsonResponse({'builds': builds}) (str) - A JSON string containing a list of builds
+    """
+    return JsonResponse({'builds': index_builds.get_index_builds(table)})
+
+
+def create_advised_indexes(request, table):
+    """
+    Start building the indexes suggested by the index advisor for a dataset
+
+    Parameters:
+    table (str) - The uuid of the table
+    """
+    if request.method == 'POST':
+        index_builds.create_advised_indexes(table, min_seconds=0)
+    # Redirect to the manage_dataset page
+    return redirect('/manage/' + table)
+
+
+@read_only
+@cache_by_dataset_version
 def get_dataset_page(request, table, page_number):
     """"
     Get the data for a specific page of a dataset
@@ -406,6 +643,12 @@ def get_dataset_page(request, table, page_number):
     table (str) - The uuid of the table being requested
     page_number (int) - The page being requested
 
+    GET Parameters:
+    format (str) - optional. json, arrow or msgpack. The format can also be asked
+                   for with the Accept header. Defaults to json
+    as_of (int) - optional. The id of a dataset transaction. The rows are returned
+                  as they were once it was done
+
     Returns:
     JsonResponse (str) - A JSON string containing:
                                 * median latitude for the current page
@@ -413,41 +656,228 @@ def get_dataset_page(request, table, page_number):
                                 * pageCount - total number of pages in dataset
                                 * rows - a list of rows of data for the current page
                                 * columns - a list of columns in the dataset
+                         An Arrow IPC stream of the page, with the other keys as
+                         JSON in the 'mircs' schema metadata, or a MessagePack map
+                         of column arrays (see formats.to_msgpack()) with the
+                         other keys alongside
     """
-    # Determines the id range and number of pages needed to display the table
-    id_range, page_count = get_pagination_id_range(table, page_number)
+    format_name = formats.get_requested_format(request)
+    if format_name not in ('json', 'arrow', 'msgpack'):
+        return HttpResponse('Unsupported format', status=406)
+
+    as_of = get_as_of(request)
+    if as_of is False:
+        return HttpResponse('Invalid as_of transaction', status=400)
+    if as_of is not None and not history.has_history(table):
+        return HttpResponse('No history is kept for this dataset', status=400)
+
+    # Determines the id range needed to display the page
+    id_range = get_page_id_range(page_number)
+
+    def read_page():
+        # Query the table for rows within the correct range
+        params = {'start': id_range[0], 'end': id_range[1]}
+        if as_of is None:
+            statement = statements.get_statement(table, 'page', lambda d: select([d['table']]).where(and_(
+                d['table'].c.id > bindparam('start'),
+                d['table'].c.id <= bindparam('end')
+            )))
+        else:
+            statement = statements.get_statement(table, 'page_as_of', lambda d: history.get_as_of_statement(
+                d['table'], 'id > :start AND id <= :end'
+            ))
+            params.update(as_of=as_of, max_id=history.get_max_id(table, as_of))
+
+        # Get a DataFrame with the results of the query
+        with metrics.span('read_sql'):
+            return pd.read_sql(statement, statements.get_engine(), params=params)
+
+    # Count the pages while the page itself is being read
+    page_count, df = query_pool.run_concurrently(
+        lambda: get_page_count(table, as_of),
+        read_page
+    )
 
-    # Get a session
-    session = m.get_session()
+    page_info = {
+        'pageCount': page_count,
+        'lat': df.LATITUDE.median(),
+        'lon': df.LONGITUDE.median()
+    }
+    # Columnar formats go straight from the arrays behind the DataFrame
+    if format_name == 'arrow':
+        with metrics.span('serialize'):
+            t = statements.get_dataset_info(table)['class']
+            body = b''.join(formats.iter_arrow([df], formats.get_arrow_schema(t), page_info))
+        return HttpResponse(body, content_type=formats.content_types[format_name])
+    elif format_name == 'msgpack':
+        with metrics.span('serialize'):
+            body = formats.to_msgpack(df, page_info)
+        return HttpResponse(body, content_type=formats.content_types[format_name])
 
-    # Get the object for the table we're working with
-    table = getattr(m.Base.classes, table)
+    # Convert everything to the correct formats for displaying
+    with metrics.span('convert'):
+        columns = df.columns.tolist()
+        rows = df.values.tolist()
+        rows = convert_nans(rows)
 
-    # Query the table for rows within the correct range
-    query = session.query(
-        table
-    ).filter(
-        table.id > id_range[0],
-        table.id <= id_range[1]
-    )
+    with metrics.span('serialize'):
+        return JsonResponse(dict(page_info, columns=columns, rows=rows))
+
+
+@read_only
+@cache_by_dataset_version
+def get_dataset_page_features(request, table, page_number):
+    """
+    Get the rows of a page of a dataset along with their geojson features. This
+    replaces calling get_dataset_page and get_dataset_geojson for the same page:
+    the rows, their geometry and the row count come back from a single query,
+    and the rows and features are built in a single pass.
+
+    Parameters:
+    table (str) - The uuid of the table being requested
+    page_number (int) - The page being requested
+
+    GET Parameters:
+    precision, simplify - optional. See get_geometry_json()
+
+    Returns:
+    JsonResponse (str) - A JSON string containing:
+                                * median latitude for the current page
+                                * median longitude for the current page
+                                * pageCount - total number of pages in dataset
+                                * rows - a list of rows of data for the current page
+                                * columns - a list of columns in the dataset
+                                * features - a list of geojson features for the current page
+    """
+    if get_geometry_params(request) is None:
+        return HttpResponse('precision has to be an integer and simplify a number', status=400)
+    # Determines the id range needed to display the page
+    id_range = get_page_id_range(page_number)
+    dataset = statements.get_dataset_info(table)
+    geospatial_columns = dataset['geospatial_columns']
+    geo_column_names = dataset['geometry_column_names']
+
+    def build(d):
+        # Count the rows in a scalar subquery so it travels with the page
+        row_count = select([func.count(d['table'].c.id)]).as_scalar()
+        geometry = get_map_geometry(d['class'], d['geospatial_columns'][0])
+        return select([
+            d['table'],
+            get_geometry_json(request, geometry, bind=True).label('geometry'),
+            row_count.label('row_count')
+        ]).where(and_(
+            d['table'].c.id > bindparam('start'),
+            d['table'].c.id <= bindparam('end')
+        ))
+    statement = statements.get_statement(table, 'page_features', build, 'simplify' in get_geometry_params(request))
 
     # Get a DataFrame with the results of the query
-    df = pd.read_sql(query.statement, query.session.bind)
+    with metrics.span('read_sql'):
+        data = pd.read_sql(statement, statements.get_engine(), params=dict(
+            get_geometry_params(request), start=id_range[0], end=id_range[1]
+        ))
+
+    if len(data.index):
+        dataset_count = data['row_count'].iloc[0]
+        page_count = int(math.ceil(dataset_count / settings.DATASET_ITEMS_PER_PAGE))
+    else:
+        page_count = get_page_count(table)
+
+    with metrics.span('convert'):
+        columns = [c for c in data.columns if c not in ('geometry', 'row_count')]
+        # Median location of the page, to center the map on
+        median_lat = None
+        median_lon = None
+        if geospatial_columns[0].get('type') == 'latlon':
+            median_lat = data[geospatial_columns[0]['lat_col']].median()
+            median_lon = data[geospatial_columns[0]['lon_col']].median()
+
+        rows = convert_nans(data[columns].values.tolist())
+        property_indexes = [i for i, c in enumerate(columns) if c not in geo_column_names]
+        features = []
+        for row, geometry in zip(rows, data['geometry'].tolist()):
+            properties = dict((columns[i], row[i]) for i in property_indexes)
+            features.append({
+                'type': 'Feature',
+                'properties': properties,
+                'geometry': json.loads(geometry),
+                'keys': sorted(properties.keys())
+            })
 
-    # Convert everything to the correct formats for displaying
-    columns = df.columns.tolist()
-    rows = df.values.tolist()
-    rows = convert_nans(rows)
-    median_lat = df.LATITUDE.median()
-    median_lon = df.LONGITUDE.median()
+    with metrics.span('serialize'):
+        return JsonResponse({
+            'columns': columns,
+            'rows': rows,
+            'features': features,
+            'pageCount': page_count,
+            'lat': median_lat,
+            'lon': median_lon
+        })
 
-    return JsonResponse({
-        'columns': columns,
-        'rows': rows,
-        'pageCount': page_count,
-        'lat': median_lat,
-        'lon': median_lon
-    })
+
+@read_only
+def export_dataset(request, table):
+    """
+    Stream every row of a dataset as a download. The rows are read and converted
+    chunk by chunk, so the whole dataset never sits in memory.
+
+    Parameters:
+    table (str) - The uuid of the table being exported
+
+    GET Parameters:
+    format (str) - optional. csv, arrow or msgpack. The format can also be asked
+                   for with the Accept header. Defaults to csv
+    as_of (int) - optional. The id of a dataset transaction. The dataset is
+                  exported as it was once it was done
+
+    Returns:
+    StreamingHttpResponse - A CSV file, an Arrow IPC stream with one record batch
+                            per chunk, or a sequence of MessagePack maps of column
+                            arrays, one per chunk
+    """
+    format_name = formats.get_requested_format(request, default='csv')
+    if format_name not in ('csv', 'arrow', 'msgpack'):
+        return HttpResponse('Unsupported format', status=406)
+
+    session = m.get_session()
+    file_name = session.query(m.DATASETS.original_filename).filter(m.DATASETS.uuid == table).one()[0]
+    session.close()
+    as_of = get_as_of(request)
+    if as_of is False:
+        return HttpResponse('Invalid as_of transaction', status=400)
+    if as_of is not None and not history.has_history(table):
+        return HttpResponse('No history is kept for this dataset', status=400)
+    t = getattr(m.Base.classes, table)
+    params = {}
+    if as_of is None:
+        statement = t.__table__.select().order_by(t.id)
+    else:
+        statement = history.get_as_of_statement(t.__table__)
+        params = {'as_of': as_of, 'max_id': history.get_max_id(table, as_of)}
+    # The response is streamed after the middleware has run, so hold on to the
+    # engine this request was routed to
+    engine = m.get_engine()
+
+    def read_chunks():
+        # Stream the results from postgres instead of fetching them all at once
+        connection = engine.connect().execution_options(stream_results=True)
+        try:
+            for df in pd.read_sql(statement, connection, params=params, chunksize=settings.EXPORT_CHUNK_ROWS):
+                yield df
+        finally:
+            connection.close()
+
+    if format_name == 'arrow':
+        content = formats.iter_arrow(read_chunks(), formats.get_arrow_schema(t))
+    elif format_name == 'msgpack':
+        content = formats.iter_msgpack(read_chunks())
+    else:
+        content = formats.iter_csv(read_chunks())
+    response = StreamingHttpResponse(content, content_type=formats.content_types[format_name])
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+        os.path.splitext(file_name)[0].replace('"', ''), formats.extensions[format_name]
+    )
+    return response
 
 
 def join_datasets(request, table):
@@ -495,6 +925,7 @@ def join_datasets(request, table):
         return render(request, 'join_datasets.html', context)
 
 
+@read_only
 def get_dataset_keys(request, table):
     """
     Returns JSON containing a list of table keys that have been added for a
@@ -527,55 +958,498 @@ def get_dataset_keys(request, table):
     return JsonResponse({'keys': keys})
 
 
+@read_only
+@cache_by_dataset_version
 def get_dataset_geojson(request, table, page_number):
     """
     Returns geojson created from the geospatial columns of a given page of a table
+
+    GET Parameters:
+    precision, simplify - optional. See get_geometry_json()
     """
-    # Get the range of database IDs included in the current page of data as well
-    # as the total number of pages
-    id_range, page_count = get_pagination_id_range(table, page_number)
+    if get_geometry_params(request) is None:
+        return HttpResponse('precision has to be an integer and simplify a number', status=400)
+    # Get the range of database IDs included in the current page of data
+    id_range = get_page_id_range(page_number)
+
+    # Get geospatial columns
+    geo_column_names = statements.get_dataset_info(table)['geometry_column_names'] + ['geometry']
+
+    def build(d):
+        # Note: we're just grabbing the first geospatial column right now. it is explicitly labeled 'geometry'
+        #       a picker for geo columns might be desirable someday
+        geometry = get_map_geometry(d['class'], d['geospatial_columns'][0])
+        return select([
+            d['table'],
+            get_geometry_json(request, geometry, bind=True).label('geometry')
+        ]).where(and_(
+            d['table'].c.id > bindparam('start'),
+            d['table'].c.id <= bindparam('end')
+        ))
+    statement = statements.get_statement(table, 'geojson', build, 'simplify' in get_geometry_params(request))
+
+    # Get a DataFrame with the results of the query
+    with metrics.span('read_sql'):
+        data = pd.read_sql(statement, statements.get_engine(), params=dict(
+            get_geometry_params(request), start=id_range[0], end=id_range[1]
+        ))
+
+    # Build some properly formatted geojson to pass into leaflet
+    with metrics.span('convert'):
+        geojson = convert_to_features(data, geo_column_names)
+    with metrics.span('serialize'):
+        return JsonResponse(geojson, safe=False)
+
+
+@read_only
+def get_nearest_features(request, table):
+    """
+    Returns geojson for the features nearest to a point or to a row of a dataset.
+    The nearest features of each dataset are found with the GiST index on its
+    geospatial column, so the whole table is never scanned.
+
+    Parameters:
+    table (str) - The uuid of the table the search starts from
+
+    GET Parameters:
+    lat, lon (float) - The point to search around. Not needed if row_id is given
+    srid (int) - optional. The SRID of lat and lon, 4326 by default
+    row_id (int) - optional. Search around the feature of table with this id instead
+    datasets (str) - optional. A comma separated list of the dataset uuids to search.
+                     Defaults to table
+    k (int) - optional. The number of features to return
+    max_distance (float) - optional. Leave out features further than this, in meters
+    filter_<column> (str) - optional. Only return features where column equals the value
+
+    Returns:
+    JsonResponse (str) - A JSON list of features, nearest first. The properties of each
+                         feature include its dataset and its distance in meters
+    """
+    if get_geometry_params(request) is None:
+        return HttpResponse('precision has to be an integer and simplify a number', status=400)
+    try:
+        k = min(int(request.GET.get('k', 10)), settings.NEAREST_FEATURES_LIMIT)
+    except ValueError:
+        return HttpResponse('k has to be an integer', status=400)
+    if k < 1:
+        return HttpResponse('k has to be positive', status=400)
+    datasets = request.GET.get('datasets', table).split(',')
+    max_distance = request.GET.get('max_distance')
+    if max_distance is not None:
+        try:
+            max_distance = float(max_distance)
+        except ValueError:
+            return HttpResponse('max_distance has to be a number', status=400)
+    filters = dict((key[len('filter_'):], value) for key, value in request.GET.items()
+                   if key.startswith('filter_'))
+
+    # Figure out the point being searched around
+    row_id = request.GET.get('row_id')
+    if row_id is not None:
+        try:
+            row_id = int(row_id)
+        except ValueError:
+            return HttpResponse('row_id has to be an integer', status=400)
+    else:
+        try:
+            lon = float(request.GET['lon'])
+            lat = float(request.GET['lat'])
+            srid = int(request.GET.get('srid', 4326))
+        except KeyError:
+            return HttpResponse('Either row_id or lat and lon are required', status=400)
+        except ValueError:
+            return HttpResponse('lat and lon have to be numbers and srid an integer', status=400)
+    for dataset in set(datasets + [table]):
+        if not hasattr(m.Base.classes, dataset):
+            return HttpResponse('Unknown dataset %s' % dataset, status=404)
+    if row_id is not None and not table_generator.get_geospatial_columns(table):
+        return HttpResponse('%s has no geospatial column to search around' % table, status=400)
 
     # Get a session
     session = m.get_session()
 
+    if row_id is not None:
+        t = getattr(m.Base.classes, table)
+        geo_column = getattr(t, table_generator.get_geospatial_columns(table)[0]['name'])
+        origin = session.query(func.ST_AsEWKT(geo_column)).filter(t.id == row_id).first()
+        if origin is None:
+            session.close()
+            return HttpResponse('No row %s in %s' % (row_id, table), status=404)
+        origin = func.ST_GeomFromEWKT(origin[0])
+    else:
+        origin = func.ST_SetSRID(func.ST_MakePoint(lon, lat), srid)
+
+    geojson = []
+    for dataset in datasets:
+        t = getattr(m.Base.classes, dataset)
+        geospatial_columns = table_generator.get_geospatial_columns(dataset)
+        # Skip datasets that can't be mapped or can't satisfy the filters
+        if not geospatial_columns or any(f not in t.__table__.columns for f in filters):
+            continue
+        geo_column = getattr(t, geospatial_columns[0]['name'])
+        # Bring the point to the SRID of the column so the index can be used
+        point = geofunc.ST_Transform(origin, int(geospatial_columns[0]['srid']))
+
+        geography = func.Geography(get_map_geometry(t, geospatial_columns[0]))
+        origin_geography = func.Geography(geofunc.ST_Transform(point, 4326))
+        query = session.query(
+            t,
+            get_geometry_json(request, get_map_geometry(t, geospatial_columns[0])).label('geometry'),
+            func.ST_Distance(geography, origin_geography).label('distance')
+        ).filter(
+            *[getattr(t, column) == value for column, value in filters.items()]
+        )
+        if max_distance is not None:
+            # Cut off in the scan itself rather than after the k nearest were picked
+            query = query.filter(func.ST_DWithin(geography, origin_geography, max_distance))
+        if row_id is not None and dataset == table:
+            query = query.filter(t.id != row_id)
+        # <-> orders by distance using the GiST index
+        query = query.order_by(geo_column.op('<->')(point)).limit(k)
+
+        data = pd.read_sql(query.statement, query.session.bind)
+        data['dataset'] = dataset
+        geojson += convert_to_features(data, table_generator.get_geometry_column_names(geospatial_columns) +
+                                       ['geometry'])
+    session.close()
+
+    # Keep the k nearest features across all the datasets
+    geojson = sorted(geojson, key=lambda f: f['properties']['distance'])[:k]
+    return JsonResponse(geojson, safe=False)
+
+
+@read_only
+@cache_by_dataset_version
+def get_dataset_time_histogram(request, table):
+    """
+    Returns the number of rows of a dataset in each time bucket of a datetime
+    column. The counts are aggregated by postgres, so the rows never reach python.
+
+    Parameters:
+    table (str) - The uuid of the table being requested
+
+    GET Parameters:
+    column (str) - optional. The datetime column. Defaults to the first one in the table
+    bucket (str) - optional. One of the keys of settings.TIME_BUCKETS. Defaults to 'year'
+    bbox (str) - optional. Only count rows within 'min_lon,min_lat,max_lon,max_lat'
+
+    Returns:
+    JsonResponse (str) - A JSON string containing:
+                                * column - the datetime column that was aggregated
+                                * bucket - the bucket size that was used
+                                * counts - a list of [first year of bucket, row count] pairs
+    """
+    bucket = request.GET.get('bucket', 'year')
+    if bucket not in settings.TIME_BUCKETS:
+        return HttpResponse('The bucket has to be one of %s' % ', '.join(sorted(settings.TIME_BUCKETS)),
+                            status=400)
+    bucket_size = settings.TIME_BUCKETS[bucket]
+    if 'bbox' in request.GET and not is_valid_bbox(request.GET['bbox']):
+        return HttpResponse('The bbox has to be min_lon,min_lat,max_lon,max_lat', status=400)
+
     t = getattr(m.Base.classes, table)
+    datetime_columns = table_generator.get_datetime_columns(t)
+    column = request.GET.get('column', (datetime_columns or [None])[0])
+    if column is None:
+        return JsonResponse({'column': None, 'bucket': None, 'counts': []})
+    if column not in datetime_columns:
+        return HttpResponse('%s is not a datetime column' % column, status=400)
+    if 'bbox' in request.GET and not table_generator.get_geospatial_columns(table):
+        return HttpResponse('The dataset has no geospatial column', status=400)
 
-    # Get geospatial columns
-    geo = m.GEOSPATIAL_COLUMNS
-    geospatial_columns = session.query(geo.column).filter(geo.dataset_uuid == table).all()
-    geo_column_objects = []
-    geo_column_names = []
-    # Create the geospatial object from the columns
-    for col in geospatial_columns:
-        geo_column_objects.append(geofunc.ST_AsGeoJSON(getattr(t, col[0])))
-        geo_column_names.append(col[0])
-
-    # build up geospatial select functions
-    # Note: we're just grabbing the first geospatial column right now. it is explicitly labeled 'geometry'
-    #       a picker for geo columns might be desirable someday
-    geojson = session.query(t, geo_column_objects[0].label('geometry')).filter(
-        t.id > id_range[0],
-        t.id <= id_range[1]
+    # Get a session
+    session = m.get_session()
+
+    time_column = getattr(t, column)
+    bucket_start = (func.floor(func.date_part('year', time_column) / bucket_size) * bucket_size).label('bucket')
+    query = session.query(
+        bucket_start,
+        func.count(t.id)
+    ).filter(
+        time_column != None
+    ).group_by(bucket_start).order_by(bucket_start)
+    partition_filter = partitioning.get_time_filter(t, table, column)
+    if partition_filter is not None:
+        query = query.filter(partition_filter)
+    if 'bbox' in request.GET:
+        query = query.filter(get_bbox_filter(t, table, request.GET['bbox']))
+    counts = [[int(r[0]), r[1]] for r in query.all()]
+    session.close()
+
+    return JsonResponse({'column': column, 'bucket': bucket, 'counts': counts})
+
+
+@read_only
+@cache_by_dataset_version
+def get_dataset_time_range(request, table):
+    """
+    Returns geojson for the features of a dataset within a date range
+
+    Parameters:
+    table (str) - The uuid of the table being requested
+
+    GET Parameters:
+    start (str) - optional. The start of the range, eg. 1850-01-01
+    end (str) - optional. The end of the range (exclusive)
+    column (str) - optional. The datetime column. Defaults to the first one in the table
+    bbox (str) - optional. Only return features within 'min_lon,min_lat,max_lon,max_lat'
+
+    Returns:
+    JsonResponse (str) - A JSON list of at most settings.DATASET_ITEMS_PER_PAGE
+                         features, ordered by date
+    """
+    if get_geometry_params(request) is None:
+        return HttpResponse('precision has to be an integer and simplify a number', status=400)
+    start = request.GET.get('start')
+    end = request.GET.get('end')
+    try:
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+    except ValueError:
+        start = end = pd.NaT
+    if start is pd.NaT or end is pd.NaT:
+        return HttpResponse('start and end have to be dates, eg. 1850-01-01', status=400)
+    if 'bbox' in request.GET and not is_valid_bbox(request.GET['bbox']):
+        return HttpResponse('The bbox has to be min_lon,min_lat,max_lon,max_lat', status=400)
+
+    t = getattr(m.Base.classes, table)
+    datetime_columns = table_generator.get_datetime_columns(t)
+    column = request.GET.get('column', (datetime_columns or [None])[0])
+    if column is None:
+        return JsonResponse([], safe=False)
+    if column not in datetime_columns:
+        return HttpResponse('%s is not a datetime column' % column, status=400)
+    time_column = getattr(t, column)
+    geospatial_columns = table_generator.get_geospatial_columns(table)
+    if not geospatial_columns:
+        return HttpResponse('The dataset has no geospatial column', status=400)
+
+    # Get a session
+    session = m.get_session()
+
+    query = session.query(
+        t,
+        get_geometry_json(request, get_map_geometry(t, geospatial_columns[0])).label('geometry')
     )
+    if start is not None:
+        query = query.filter(time_column >= start.to_pydatetime())
+    if end is not None:
+        query = query.filter(time_column < end.to_pydatetime())
+    # Skip the partitions outside the date range of a table partitioned by date
+    partition_filter = partitioning.get_time_filter(t, table, column, start, end)
+    if partition_filter is not None:
+        query = query.filter(partition_filter)
+    if 'bbox' in request.GET:
+        query = query.filter(get_bbox_filter(t, table, request.GET['bbox']))
+    query = query.order_by(time_column).limit(settings.DATASET_ITEMS_PER_PAGE)
+
     # Get a DataFrame with the results of the query
-    data = pd.read_sql(geojson.statement, geojson.session.bind)
-    geo_column_names.append('geometry')
+    data = pd.read_sql(query.statement, query.session.bind)
+    session.close()
 
-    # Build some properly formatted geojson to pass into leaflet
-    geojson = []
-    for i, r in data.iterrows():
-        # Geometry and properties are both required for a 'Feature' object.
-        geometry = r['geometry']
-        properties = r.drop(geo_column_names).to_dict()
-        geojson.append({
-            'type': 'Feature',
-            'properties': properties,
-            'geometry': json.loads(geometry),
-            'keys': sorted(properties.keys())
-        })
+    geojson = convert_to_features(data, table_generator.get_geometry_column_names(geospatial_columns) +
+                                  ['geometry'])
     return JsonResponse(geojson, safe=False)
 
 
+@read_only
+@cache_by_dataset_version
+def get_dataset_density(request, table):
+    """
+    Returns the number of features of a dataset in each cell of a hexagon or
+    square grid covering a bounding box, for overview maps of datasets too big
+    to draw point by point. The grid is generated and joined to the GiST index
+    of the geospatial column by postgis, so only the counts reach python.
+
+    Parameters:
+    table (str) - The uuid of the table being requested
+
+    GET Parameters:
+    bbox (str) - The area to cover, 'min_lon,min_lat,max_lon,max_lat' in EPSG:4326
+    shape (str) - optional. 'hexagon' or 'square'. Defaults to 'hexagon'
+    resolution (int) - optional. The number of cells across the longer side of the
+                       bounding box. Defaults to settings.DENSITY_GRID_RESOLUTION, and
+                       can't be over settings.DENSITY_MAX_RESOLUTION
+    split (str) - optional. A column to split the counts of each cell by
+    bucket (str) - optional. If split is a datetime column, one of the keys of
+                   settings.TIME_BUCKETS. Defaults to 'year'
+    precision - optional. See get_geometry_json()
+
+    Returns:
+    JsonResponse (str) - A JSON string containing:
+                                * shape - the shape of the cells
+                                * size - the size of the cells, in EPSG:3857 meters
+                                * split - the column the counts are split by, or None
+                                * cells - a list of GeoJSON features, one for each
+                                          cell holding features. Their properties are
+                                          the count, the i and j indexes of the cell and,
+                                          if split is given, a dictionary of the counts
+                                          of each value
+    """
+    if get_geometry_params(request) is None:
+        return HttpResponse('precision has to be an integer and simplify a number', status=400)
+    if 'bbox' not in request.GET:
+        return HttpResponse('A bbox is required', status=400)
+    if not is_valid_bbox(request.GET['bbox']):
+        return HttpResponse('The bbox has to be min_lon,min_lat,max_lon,max_lat', status=400)
+    shape = request.GET.get('shape', 'hexagon')
+    if shape not in ('hexagon', 'square'):
+        return HttpResponse('Unknown shape %s' % shape, status=400)
+    try:
+        resolution = int(request.GET.get('resolution', settings.DENSITY_GRID_RESOLUTION))
+    except ValueError:
+        resolution = 0
+    if resolution < 1 or resolution > settings.DENSITY_MAX_RESOLUTION:
+        return HttpResponse('The resolution has to be between 1 and %d' % settings.DENSITY_MAX_RESOLUTION,
+                            status=400)
+    bucket = request.GET.get('bucket', 'year')
+    if bucket not in settings.TIME_BUCKETS:
+        return HttpResponse('The bucket has to be one of %s' % ', '.join(sorted(settings.TIME_BUCKETS)),
+                            status=400)
+
+    info = statements.get_dataset_info(table)
+    t = info['class']
+    split = request.GET.get('split')
+    if split is not None and split not in info['table'].columns:
+        return HttpResponse('Unknown column %s' % split, status=400)
+    if not info['geospatial_columns']:
+        return JsonResponse({'shape': shape, 'size': None, 'split': split, 'cells': []})
+
+    # Lay the grid out over the bounding box in a planar SRID
+    bounds = get_mercator_bbox(request.GET['bbox'])
+    size = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) / resolution
+    if size <= 0:
+        return HttpResponse('The bbox is empty', status=400)
+    grid_function = func.ST_HexagonGrid if shape == 'hexagon' else func.ST_SquareGrid
+    grid = grid_function(size, func.ST_MakeEnvelope(*(bounds + [3857]))).alias('grid')
+    cell = literal_column('grid.geom')
+    columns = [literal_column('grid.i').label('i'), literal_column('grid.j').label('j')]
+
+    # Reproject each cell to the indexed column rather than every feature to the grid
+    geometry, srid = get_indexed_geometry(t, info['geospatial_columns'][0])
+    if split is not None:
+        split_column = getattr(t, split)
+        if split in table_generator.get_datetime_columns(t):
+            bucket_size = settings.TIME_BUCKETS[bucket]
+            split_column = func.floor(func.date_part('year', split_column) / bucket_size) * bucket_size
+        columns.append(split_column.label('split'))
+    cell_in_srid = geofunc.ST_Transform(cell, srid)
+    in_cell = func.ST_Intersects(geometry, cell_in_srid)
+    if table_generator.get_geometry_type(info['geospatial_columns'][0]) == 'POINT':
+        # A point on an edge shared by two cells intersects both. Those points are
+        # nudged by a fraction of the cell size, off the edge and into a single cell
+        nudge = size * 1e-6
+        in_cell = and_(in_cell, or_(
+            not_(func.ST_Touches(geometry, cell_in_srid, type_=Boolean)),
+            func.ST_Intersects(func.ST_Translate(geofunc.ST_Transform(geometry, 3857), nudge, nudge * 0.7), cell)
+        ))
+    counts = select(columns + [func.count().label('count')]).select_from(
+        grid.join(info['table'], in_cell)
+    ).where(get_bbox_filter(t, table, request.GET['bbox'])).group_by(*columns).alias('counts')
+
+    # The outline of a cell is rebuilt from its indexes, once per cell rather than per feature
+    outline = (func.ST_Hexagon if shape == 'hexagon' else func.ST_Square)(size, counts.c.i, counts.c.j)
+    statement = select([
+        counts,
+        geofunc.ST_AsGeoJSON(
+            geofunc.ST_Transform(func.ST_SetSRID(outline, 3857), 4326),
+            get_geometry_params(request)['precision']
+        ).label('geometry')
+    ])
+
+    # Get a DataFrame with the results of the query
+    with metrics.span('read_sql'):
+        data = pd.read_sql(statement, m.get_engine())
+
+    with metrics.span('convert'):
+        cells = {}
+        for index, r in data.iterrows():
+            key = (int(r['i']), int(r['j']))
+            if key not in cells:
+                cells[key] = {
+                    'type': 'Feature',
+                    'properties': {'i': key[0], 'j': key[1], 'count': 0},
+                    'geometry': json.loads(r['geometry']),
+                }
+                if split is not None:
+                    cells[key]['properties']['counts'] = {}
+            properties = cells[key]['properties']
+            properties['count'] += int(r['count'])
+            if split is not None:
+                value = r['split']
+                if pd.isnull(value):
+                    value = None
+                else:
+                    # JSON keys can't be numpy scalars
+                    value = value.item() if hasattr(value, 'item') else value
+                if isinstance(value, float) and value.is_integer():
+                    # Date buckets come back as floats
+                    value = int(value)
+                properties['counts'][value] = int(r['count'])
+
+    return JsonResponse({
+        'shape': shape,
+        'size': size,
+        'split': split,
+        'cells': [cells[key] for key in sorted(cells)],
+    })
+
+
+@read_only
+def search_datasets(request):
+    """
+    Search every dataset for rows matching a query string
+
+    GET Parameters:
+    q (str) - The text to search for, eg. a person's name
+    limit (int) - optional. The maximum number of hits to return, between 1 and
+                  settings.SEARCH_RESULTS_LIMIT
+    fuzzy (str) - optional. 'true' to match misspellings using the trigram index
+
+    Returns:
+    JsonResponse (str) - A JSON string containing:
+                                * hits - a list of hits ordered by rank, each containing
+                                  the dataset uuid, its original filename, the row id
+                                  and the rank of the hit
+    """
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'hits': []})
+    try:
+        limit = int(request.GET.get('limit', settings.SEARCH_RESULTS_LIMIT))
+    except ValueError:
+        return HttpResponse('The limit has to be a number', status=400)
+    limit = max(1, min(limit, settings.SEARCH_RESULTS_LIMIT))
+    fuzzy = request.GET.get('fuzzy', 'false').lower() == 'true'
+
+    hits = search.search(query, schema, limit=limit, fuzzy=fuzzy)
+
+    # Look up the filenames of the datasets that had hits
+    session = m.get_session()
+    filenames = dict(session.query(
+        m.DATASETS.uuid,
+        m.DATASETS.original_filename
+    ).filter(
+        m.DATASETS.uuid.in_(set([h[0] for h in hits]) or [''])
+    ).all())
+    session.close()
+
+    return JsonResponse({'hits': [{
+        'dataset': h[0],
+        'filename': filenames.get(h[0]),
+        'id': h[1],
+        'rank': h[2]
+    } for h in hits]})
+
+
+def get_metrics(request):
+    """
+    Returns the request and sql timings recorded by website.metrics in the
+    prometheus text format. The metrics are kept per process.
+    """
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
+
+
 def test_response(request):
     """
     Test function for returns
@@ -583,6 +1457,18 @@ def test_response(request):
     return HttpResponse('yay')
 
 
+def report_missing_geometries(request, missing_geometries):
+    """
+    Warn the user on the next page when rows of their file were loaded without
+    a geometry, because the source value was empty or couldn't be parsed.
+    Requests built without the message middleware, eg. by the benchmarks, are skipped.
+    """
+    if missing_geometries:
+        messages.warning(request, '%d rows were loaded without a geometry, their geospatial '
+                                  'value was empty or could not be parsed' % missing_geometries,
+                         fail_silently=True)
+
+
 def convert_time_columns(df, datetime_identifiers=['time', 'date']):
     """
     Find date columns based on name and convert them to pandas datetime64 objects
@@ -598,7 +1484,7 @@ def convert_time_columns(df, datetime_identifiers=['time', 'date']):
     for c in df.columns:
         for d in datetime_identifiers:
             if d in c.lower():
-                df[c] = pd.to_datetime(df[c])
+                df[c] = frames.to_datetime(df[c])
     return df
 
 
@@ -616,6 +1502,216 @@ def convert_nans(rows):
     return rows
 
 
+def get_file_preview(df):
+    """
+    Build the preview of an uploaded file shown on the upload pages
+
+    Parameters:
+    df (pandas.DataFrame) - The parsed file, or its first rows
+
+    Returns:
+    preview (dict) - A JSON serializable dictionary containing the columns, the
+                     first 10 rows, the autopicked datatypes and the possible datatypes
+    """
+    # Return the columns and the first 10 rows of the file as a JSON object
+    columns = df.columns.tolist()
+    rows = df[0:10].values.tolist()
+
+    # Get the autopicked datatypes for the columns
+    datatypes = table_generator.get_readable_types_from_dataframe(df)
+    possible_datatypes = sorted(set(table_generator.type_mappings.values()))
+
+    # Convert np.NaN objects to 'null' so rows is JSON serializable
+    rows = convert_nans(rows)
+
+    return {
+        'columns': columns,
+        'rows': rows,
+        'datatypes': datatypes,
+        'possibleDatatypes': possible_datatypes
+    }
+
+
+def convert_to_features(data, geo_column_names):
+    """
+    Convert a DataFrame containing a 'geometry' column of GeoJSON strings to a
+    list of GeoJSON Feature objects
+
+    Parameters:
+    data (pandas.DataFrame) - The DataFrame to be converted
+    geo_column_names (list) - The columns to leave out of the feature properties,
+                              including 'geometry'
+
+    Returns:
+    geojson (list) - A list of GeoJSON Feature dictionaries
+    """
+    geojson = []
+    for i, r in data.iterrows():
+        # Geometry and properties are both required for a 'Feature' object.
+        geometry = r['geometry']
+        properties = r.drop(geo_column_names).to_dict()
+        geojson.append({
+            'type': 'Feature',
+            'properties': properties,
+            'geometry': json.loads(geometry),
+            'keys': sorted(properties.keys())
+        })
+    return geojson
+
+
+def get_geometry_json(request, geometry, bind=False):
+    """
+    Build the ST_AsGeoJSON expression of a geometry, honouring the precision and
+    simplify GET parameters of a request. Trimming coordinates to the precision
+    the map can show shrinks geojson payloads several times over.
+
+    Parameters:
+    geometry - An SQLAlchemy geometry expression
+    bind (bool) - optional. Use precision and simplify bind parameters instead of
+                  the values of the request, for statements kept by the statement
+                  cache. Their values are given by get_geometry_params()
+
+    GET Parameters:
+    precision (int) - optional. The number of decimal places of the coordinates.
+                      Defaults to settings.GEOJSON_PRECISION
+    simplify (float) - optional. Simplify lines and polygons with this tolerance,
+                       in the units of the geometry. Points are left alone
+
+    Returns:
+    geojson - An SQLAlchemy expression of the geometry as geojson text
+    """
+    params = get_geometry_params(request)
+    if 'simplify' in params:
+        tolerance = bindparam('simplify', type_=Float) if bind else params['simplify']
+        geometry = case(
+            [(func.GeometryType(geometry).in_(['POINT', 'MULTIPOINT']), geometry)],
+            else_=func.ST_SimplifyPreserveTopology(geometry, tolerance)
+        )
+    precision = bindparam('precision', type_=Integer) if bind else params['precision']
+    return geofunc.ST_AsGeoJSON(geometry, precision)
+
+
+def get_geometry_params(request):
+    """
+    Get the values of the precision and simplify GET parameters of a request,
+    see get_geometry_json()
+
+    Returns:
+    params (dict) - The precision, and the simplify tolerance if there is one.
+                    None if either isn't a number
+    """
+    try:
+        params = {'precision': int(request.GET.get('precision', settings.GEOJSON_PRECISION))}
+        if request.GET.get('simplify'):
+            params['simplify'] = float(request.GET['simplify'])
+    except ValueError:
+        return None
+    return params
+
+
+def get_map_geometry(t, geospatial_column, srid=4326):
+    """
+    Get a geospatial column of a table in the SRID maps are drawn in. The copy
+    kept in the display SRID is used when it matches, so nothing is reprojected.
+    Columns created without a display copy are reprojected on the fly.
+
+    Parameters:
+    t - The automapped SQLAlchemy class of the table
+    geospatial_column (dict) - The column, as returned by get_geospatial_columns()
+    srid (int) - optional. The SRID wanted. Leaflet reads geojson in EPSG:4326
+
+    Returns:
+    geometry - An SQLAlchemy geometry expression
+    """
+    display_column = table_generator.get_display_column_name(geospatial_column)
+    if display_column is not None and int(geospatial_column['display_srid']) == srid:
+        return getattr(t, display_column)
+    if int(geospatial_column['srid']) == srid:
+        return getattr(t, geospatial_column['name'])
+    return geofunc.ST_Transform(getattr(t, geospatial_column['name']), srid)
+
+
+def get_indexed_geometry(t, geospatial_column):
+    """
+    Get the GiST indexed copy of a geospatial column to search with, the one
+    kept in the display SRID if there is one
+
+    Parameters:
+    t - The automapped SQLAlchemy class of the table
+    geospatial_column (dict) - The column, as returned by get_geospatial_columns()
+
+    Returns:
+    geometry - The SQLAlchemy column
+    srid (int) - Its SRID. Shapes searched for have to be reprojected to it
+    """
+    display_column = table_generator.get_display_column_name(geospatial_column)
+    if display_column is not None:
+        return getattr(t, display_column), int(geospatial_column['display_srid'])
+    return getattr(t, geospatial_column['name']), int(geospatial_column['srid'])
+
+
+def is_valid_bbox(bbox):
+    """
+    Check that a bounding box parameter is four comma separated numbers
+
+    Parameters:
+    bbox (str) - 'min_lon,min_lat,max_lon,max_lat' in EPSG:4326
+
+    Returns:
+    valid (bool) - Whether the bounding box can be used
+    """
+    try:
+        return len([float(x) for x in bbox.split(',')]) == 4
+    except ValueError:
+        return False
+
+
+def get_mercator_bbox(bbox):
+    """
+    Convert a bounding box to web mercator (EPSG:3857), the planar SRID density
+    grids are laid out in. Latitudes are clamped to the bounds of the projection.
+
+    Parameters:
+    bbox (str) - 'min_lon,min_lat,max_lon,max_lat' in EPSG:4326
+
+    Returns:
+    bbox (list) - [min_x, min_y, max_x, max_y] in meters
+    """
+    min_lon, min_lat, max_lon, max_lat = [float(x) for x in bbox.split(',')]
+    radius = 6378137.0
+
+    def project(lon, lat):
+        lat = max(min(lat, 85.05112878), -85.05112878)
+        return (math.radians(lon) * radius,
+                math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * radius)
+    return list(project(min_lon, min_lat) + project(max_lon, max_lat))
+
+
+def get_bbox_filter(t, table, bbox):
+    """
+    Build a filter keeping the rows of a table whose geometry intersects a bounding box.
+    The && operator lets postgres answer it with the GiST index of the geometry column.
+
+    Parameters:
+    t - The automapped SQLAlchemy class of the table
+    table (str) - The uuid of the table
+    bbox (str) - 'min_lon,min_lat,max_lon,max_lat' in EPSG:4326
+
+    Returns:
+    filter - An SQLAlchemy filter expression
+    """
+    geospatial_column = statements.get_dataset_info(table)['geospatial_columns'][0]
+    envelope = func.ST_MakeEnvelope(*([float(x) for x in bbox.split(',')] + [4326]))
+    # Only the envelope is reprojected, to the SRID of the display copy if there is one
+    geometry, srid = get_indexed_geometry(t, geospatial_column)
+    bbox_filter = geometry.op('&&')(geofunc.ST_Transform(envelope, srid))
+    # Skip the partitions outside the bounding box of a table partitioned by cell
+    partition_filter = partitioning.get_bbox_filter(t, table, geospatial_column, bbox)
+    if partition_filter is not None:
+        bbox_filter = and_(bbox_filter, partition_filter)
+    return bbox_filter
+
+
 def get_pagination_id_range(table, page_number):
     """
     Determine the range of IDs included in a specific page of data. Pages are
@@ -632,26 +1728,69 @@ def get_pagination_id_range(table, page_number):
                        n / settings.DATASET_ITEMS_PER_PAGE where n is
                        the total number of rows in the dataset
     """
-    # Get a session
-    session = m.get_session()
+    return get_page_id_range(page_number), get_page_count(table)
 
-    # Get the object for the table we're working with
-    table = getattr(m.Base.classes, table)
 
-    # Figure out how many rows are in the dataset and calculate the number of pages
-    dataset_count = session.query(
-        func.count(table.id)
-    ).one()[0]
-    page_count = int(math.ceil(dataset_count / settings.DATASET_ITEMS_PER_PAGE))
+def get_as_of(request):
+    """
+    Get the as_of GET parameter of a request
+
+    Returns:
+    as_of (int) - The id of a dataset transaction, None if the request has no
+                  as_of parameter or False if it isn't a number
+    """
+    if not request.GET.get('as_of'):
+        return None
+    try:
+        return int(request.GET['as_of'])
+    except ValueError:
+        return False
 
-    # Calculate the id range covered by the current page
-    id_range = (
+
+def get_page_id_range(page_number):
+    """
+    Determine the range of IDs included in a specific page of data. This needs no
+    database access, so the page can be queried while the pages are counted.
+
+    Parameters:
+    page_number (int) - The requested page number
+
+    Returns:
+    id_range (tuple) - The start and end of the range of database IDs included
+                       in the requested page
+    """
+    return (
         int(page_number) * settings.DATASET_ITEMS_PER_PAGE,
         (int(page_number) + 1) * settings.DATASET_ITEMS_PER_PAGE
     )
-    session.close()
 
-    return id_range, page_count
+
+def get_page_count(table, as_of=None):
+    """
+    Determine the total number of pages available in a dataset
+
+    Parameters:
+    table (str) - The uuid of the table
+    as_of (int) - optional. Count the rows the dataset had once this transaction was done
+
+    Returns:
+    page_count (int) - n / settings.DATASET_ITEMS_PER_PAGE where n is
+                       the total number of rows in the dataset
+    """
+    # Figure out how many rows are in the dataset and calculate the number of pages
+    if as_of is None:
+        statement = statements.get_statement(table, 'count', lambda d: select([func.count(d['table'].c.id)]))
+        dataset_count = statements.get_engine().execute(statement).scalar()
+    else:
+        statement = statements.get_statement(table, 'count_as_of', lambda d: select([func.count()]).select_from(
+            history.get_as_of_statement(d['table']).alias('as_of')
+        ))
+        dataset_count = statements.get_engine().execute(
+            statement, as_of=as_of, max_id=history.get_max_id(table, as_of)
+        ).scalar()
+    page_count = int(math.ceil(dataset_count / settings.DATASET_ITEMS_PER_PAGE))
+
+    return page_count
 
 
 def Session():